@@ -15,6 +15,7 @@ from wowspyder import Database
 from wowspyder.Battlegroup import Realm
 from wowspyder.GuildCharacter import Guild
 from wowspyder import Logger
+from wowspyder import DeepFetch
 import datetime
 import socket
 
@@ -68,6 +69,16 @@ class QueueManager(object):
             
         return None
         
+    def get_next_character(self, realm):
+        """Returns the next character in the realm queued for a deep
+        fetch, as a DeepFetch, or None.
+        
+        """
+        return DeepFetch.get_next(realm.name, realm.site, self._get_lock_id())
+        
+    def finish_character(self, fetch):
+        DeepFetch.finish(fetch.name, fetch.realm, fetch.site)
+        
     def finish_realm(self, realm):
         realm.last_refresh = datetime.datetime.now()
         realm.lock_id = None
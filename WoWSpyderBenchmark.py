@@ -0,0 +1,401 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+WoWSpyderBenchmark.py
+
+Benchmarks for the download and parsing layers. These run against an
+ArmoryStandIn rather than the Armory, so the numbers are repeatable.
+
+Copyright (c) 2009, Regents of the University of California
+All rights reserved.
+"""
+
+import sys
+import os
+import time
+import threading
+import resource
+import tempfile
+import shutil
+import urllib2
+import StringIO
+import re
+import glob
+from xml.dom import minidom
+from wowspyder import ConnectionPool, XMLDownloader, AsyncDownloader, \
+    ResponseCache, RateLimiter, ArmoryStandIn, GuildCharacter, XMLStream, \
+    ArmoryPage, GuildRoster
+
+_PAGE = "<?xml version=\"1.0\" encoding=\"UTF-8\"?><page>" + \
+    "<character name=\"Moulin\" realm=\"Ravenholdt\"/>" * 50 + "</page>"
+
+def _start_stand_in(connect_latency=0.0, latency=0.0):
+    """Start an Armory stand-in answering every URL with the same page.
+    Loopback connections are free, the Armory's aren't, so connect_latency
+    charges each new connection a round trip.
+
+    """
+    server = ArmoryStandIn.ArmoryStandIn(connect_latency=connect_latency, \
+        latency=latency, default_page=_PAGE).start()
+    return server, server.site_url("us")
+
+def _requests_per_second(opener, url, requests, threads):
+    per_thread = requests / threads
+
+    def worker():
+        for _ in xrange(per_thread):
+            opener.open(url).read()
+
+    workers = [threading.Thread(target=worker) for _ in xrange(threads)]
+    start = time.time()
+
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+
+    return (per_thread * threads) / (time.time() - start)
+
+def benchmark_keep_alive(requests=2000, threads=20, connect_latency=0.05):
+    """Compare a connection per request against pooled keep-alive
+    connections.
+
+    """
+    server, base_url = _start_stand_in(connect_latency=connect_latency)
+    url = base_url + "character-sheet.xml?r=Ravenholdt&n=Moulin"
+
+    closing = urllib2.build_opener(urllib2.HTTPHandler())
+    pooled = urllib2.build_opener(ConnectionPool.KeepAliveHandler(pool_size=threads))
+
+    print "Connection per request: %.1f requests/sec" % \
+        _requests_per_second(closing, url, requests, threads)
+    print "Keep-alive pool:        %.1f requests/sec" % \
+        _requests_per_second(pooled, url, requests, threads)
+
+    ConnectionPool.close_pools()
+    server.stop()
+
+def _in_child(function):
+    """Run function in a forked process, so each run gets a clean
+    heap, and return what it printed.
+
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            result = function()
+        finally:
+            os.write(write_fd, result)
+            os._exit(0)
+
+    os.close(write_fd)
+    output = []
+
+    while True:
+        data = os.read(read_fd, 4096)
+        if not data: break
+        output.append(data)
+
+    os.waitpid(pid, 0)
+    return "".join(output)
+
+def _engine_run(create_engine, base_url, requests, callers):
+    def run():
+        engine = create_engine()
+        per_caller = requests / callers
+
+        def caller(number):
+            for n in xrange(per_caller):
+                # Unique URLs, so the module cache can't answer
+                engine.download_url(base_url + \
+                    "character-sheet.xml?n=%d-%d" % (number, n))
+
+        workers = [threading.Thread(target=caller, args=(n,)) for n in xrange(callers)]
+        start = time.time()
+
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+
+        elapsed = time.time() - start
+        threads = threading.activeCount()
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        engine.close()
+
+        return "%.1f requests/sec, %d threads, max RSS %d KB" % \
+            (per_caller * callers / elapsed, threads, rss)
+
+    return run
+
+def benchmark_engines(requests=2000, concurrency=20, latency=0.02):
+    """Compare the threaded and async download engines at the same
+    concurrency. Both engines are run without a rate limit.
+
+    """
+    RateLimiter.configure(rate=None)
+    server, base_url = _start_stand_in(connect_latency=latency, \
+        latency=latency)
+    directory = tempfile.mkdtemp()
+    cache = lambda name: ResponseCache.ResponseCache(os.path.join(directory, name))
+
+    threaded = lambda: XMLDownloader.XMLDownloaderThreaded( \
+        number_of_threads=concurrency, cache=cache("threaded"))
+    event_loop = lambda: AsyncDownloader.XMLDownloaderAsync( \
+        max_in_flight=concurrency, cache=cache("async"))
+
+    print "Threaded engine: " + _in_child(_engine_run(threaded, base_url, \
+        requests, concurrency))
+    print "Async engine:    " + _in_child(_engine_run(event_loop, base_url, \
+        requests, concurrency))
+
+    shutil.rmtree(directory)
+    server.stop()
+
+def benchmark_startup(threads=20, latency=0.02):
+    """Time how long a threaded downloader takes to start, and to get its
+    first page, which now includes logging in.
+
+    """
+    RateLimiter.configure(rate=None)
+    server, base_url = _start_stand_in(connect_latency=latency, \
+        latency=latency)
+    directory = tempfile.mkdtemp()
+
+    def run():
+        cache = ResponseCache.ResponseCache(os.path.join(directory, "cache"))
+        start = time.time()
+        engine = XMLDownloader.XMLDownloaderThreaded(number_of_threads=threads, \
+            cache=cache)
+        started = time.time()
+        engine.download_url(base_url + "character-sheet.xml?n=Moulin")
+        first = time.time()
+        engine.close()
+
+        return "%d threads started in %.1f ms, first page after %.1f ms" % \
+            (threads, (started - start) * 1000, (first - start) * 1000)
+
+    print "Threaded startup: " + _in_child(run)
+
+    shutil.rmtree(directory)
+    server.stop()
+
+class _DownloadTwice(object):
+    """Wraps a downloader, downloading every page a second time and
+    handing back the second, as Parser._download_url used to.
+
+    """
+    def __init__(self, downloader):
+        self.downloader = downloader
+
+    def download_page(self, url, *args, **kwargs):
+        try:
+            self.downloader.download_page(url, *args, **kwargs)
+        except Exception, e:
+            pass
+
+        return self.downloader.download_page(url, *args, **kwargs)
+
+    def submit(self, url, *args, **kwargs):
+        self.downloader.submit(url, *args, **kwargs).exception()
+        return self.downloader.submit(url, *args, **kwargs)
+
+    def download_many(self, urls, *args, **kwargs):
+        for future in self.downloader.download_many(urls, *args, **kwargs):
+            future.exception()
+
+        return self.downloader.download_many(urls, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.downloader, name)
+
+def _character_requests(name, realm, wrap, ttls):
+    """Crawl a character with a fresh stand-in and an empty cache,
+    returning the requests the stand-in answered and the distinct pages
+    they were for.
+
+    """
+    server = ArmoryStandIn.ArmoryStandIn().start().use()
+    directory = tempfile.mkdtemp()
+    GuildRoster.clear()
+
+    cache = ResponseCache.ResponseCache(os.path.join(directory, "cache"), \
+        ttls=ttls)
+    engine = XMLDownloader.XMLDownloaderThreaded(cache=cache)
+    parser = GuildCharacter.CharacterParser(downloader=wrap(engine))
+    parser.get_character(name, realm, u"us", force_refresh=True)
+    engine.close()
+
+    requests, pages = server.requests, len(server.paths)
+    ConnectionPool.close_pools()
+    shutil.rmtree(directory)
+    server.stop()
+
+    return requests, pages
+
+def benchmark_requests_per_character(name=u"Moulin", realm=u"Ravenholdt"):
+    """Count the requests the Armory sees while a character from the
+    stand-in's fixtures is crawled, against the distinct pages the crawl
+    needs, downloading every page twice as the parsers used to and once
+    as they do now. Each is run with an empty cache, which hides some of
+    the second downloads, and with no cache, which hides none.
+
+    """
+    RateLimiter.configure(rate=None)
+    no_cache = dict((page_type, 0) for page_type in ResponseCache.DEFAULT_TTLS)
+
+    # Run in this process, as the stand-in counts requests here. The
+    # first crawl puts the character's guild and items in the database,
+    # so every run after it needs the same pages.
+    _character_requests(name, realm, lambda engine: engine, None)
+
+    for label, wrap in (("before", _DownloadTwice), \
+        ("after", lambda engine: engine)):
+        for cached, ttls in (("empty cache", None), ("no cache", no_cache)):
+            requests, pages = _character_requests(name, realm, wrap, ttls)
+            print "Requests per character, %-7s %-12s %d requests for " \
+                "%d distinct pages, %.2f requests per page" % (label + ",", \
+                cached + ":", requests, pages, requests / float(max(pages, 1)))
+
+# Each recorded page type, and the elements its parser reads
+_PAGE_TYPES = [
+    ("arena-ladder", ("arenaTeam",)),
+    ("team-info", ("arenaTeam", "character")),
+    ("guild-info", ("guildHeader", "character")),
+    ("character-sheet", ("character", "item")),
+    ("character-talents", ("talentSpec",)),
+    ("character-statistics", ("statistic",)),
+    ("character-achievements", ("achievement",)),
+    ("item-info", ("item", "cost")),
+]
+
+def _recorded_pages(page_type, site="us"):
+    pages = []
+
+    for filename in sorted(glob.glob(os.path.join( \
+        ArmoryStandIn.FIXTURE_DIRECTORY, site, page_type, "*.xml"))):
+        pages.append(open(filename).read())
+
+    return pages
+
+def _large_roster(members=5000):
+    """Return the recorded guild page with its roster grown to members
+    characters, the size of the Armory's largest guilds.
+
+    """
+    page = _recorded_pages("guild-info")[0]
+    characters = re.findall(r"<character [^>]*/>", page)
+    roster = "\n".join([characters[n % len(characters)].replace( \
+        "name=\"", "name=\"%d" % n, 1) for n in xrange(members)])
+
+    # re.sub only takes flags from Python 2.7, so they're compiled in
+    members = re.compile(r"(<members[^>]*>).*(</members>)", re.S)
+
+    return members.sub(lambda m: m.group(1) + roster + m.group(2), page)
+
+def _parse_run(parse, pages, tags, repeat):
+    def run():
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+
+        for _ in xrange(repeat):
+            for page in pages:
+                parse(page, tags)
+
+        elapsed = time.time() - start
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+
+        return "%.3f ms/page, peak +%d KB" % \
+            (elapsed * 1000 / (repeat * len(pages)), peak)
+
+    return run
+
+def _parse_dom(page, tags):
+    xml = minidom.parse(StringIO.StringIO(page))
+
+    for tag in tags:
+        for node in xml.getElementsByTagName(tag):
+            dict(node.attributes.items())
+
+    xml.unlink()
+
+def _parse_stream(page, tags):
+    # The parsers read pages through a ParsedPage, which keeps what it has
+    # read, so that's what is measured
+    parsed = XMLStream.ParsedPage(StringIO.StringIO(page))
+
+    for tag in tags:
+        parsed.all(tag)
+
+def benchmark_parsing(repeat=50):
+    """Compare parse time and peak memory per page, for each recorded
+    page type, building a DOM against reading the page into the
+    XMLStream.ParsedPage the parsers use. Each run is in its own process so
+    the peaks don't hide each other.
+
+    """
+    page_types = [(name, _recorded_pages(name), tags) for name, tags \
+        in _PAGE_TYPES]
+    page_types.append(("guild-info (5000 members)", [_large_roster()], \
+        ("guildHeader", "character")))
+
+    for name, pages, tags in page_types:
+        if not pages: continue
+        # The large roster is slow under minidom, so is run fewer times
+        times = max(1, repeat / (len(pages[0]) / 20000 + 1))
+
+        print "%-26s minidom: %s" % (name, _in_child(_parse_run(_parse_dom, \
+            pages, tags, times)))
+        print "%-26s parsed:  %s" % ("", _in_child(_parse_run(_parse_stream, \
+            pages, tags, times)))
+
+def benchmark_guild_rank(members=500):
+    """Time looking up the rank of every member of a large guild, as the
+    character crawl does, searching the guild's page for each member as
+    it used to against indexing the roster once.
+
+    """
+    page = ArmoryPage.Page("guild-info.xml", \
+        gzip_data=ArmoryPage.gzip_string(_large_roster(members)))
+    names = [attributes["name"] for attributes in \
+        XMLStream.iter_attributes(page.stream(), "character")]
+
+    def searched():
+        start = time.time()
+
+        for name in names:
+            # Every member was a download of the page and a search of it
+            re.search("name=\"" + name + "\".*rank=\"(\d*)\"", \
+                unicode(page.read(), "utf-8")).group(1)
+
+        return "%.1f ms, %d page reads" % ((time.time() - start) * 1000, \
+            len(names))
+
+    def indexed():
+        start = time.time()
+        roster = GuildRoster.GuildRoster(u"Wandering Shadows", \
+            u"Ravenholdt", u"us").add_page(page.parsed())
+
+        for name in names:
+            roster.get_rank(name)
+
+        return "%.1f ms, 1 page read" % ((time.time() - start) * 1000)
+
+    print "Guild ranks for %d members, searched: %s" % (len(names), \
+        _in_child(searched))
+    print "Guild ranks for %d members, indexed:  %s" % (len(names), \
+        _in_child(indexed))
+
+def main():
+    benchmark_keep_alive()
+    benchmark_engines()
+    benchmark_startup()
+    benchmark_requests_per_character()
+    benchmark_parsing()
+    benchmark_guild_rank()
+
+if __name__ == '__main__':
+    main()
@@ -11,13 +11,39 @@ import sys
 import os
 import unittest
 import wowspyder
-from wowspyder import Battlegroup, XMLDownloader, Arena, Team, GuildCharacter
+from wowspyder import Battlegroup, XMLDownloader, Arena, Team, GuildCharacter, \
+    ConnectionPool, AsyncDownloader, ResponseCache, RateLimiter, \
+    ConcurrencyController, SingleFlight, RequestQueue, ArmorySession, \
+    ArmoryPage, ArmoryStandIn, DownloadStats, DownloadFuture, CircuitBreaker, \
+    NegativeCache, RetryPolicy, DeadLetter, XMLStream, GuildRoster, \
+    DeepFetch, FetchProfile, Parser
 
 def main():
     suite = unittest.TestLoader().loadTestsFromModule(wowspyder.XMLDownloader)
     suite.addTest(unittest.TestLoader().loadTestsFromModule(wowspyder.Team))
     suite.addTest(unittest.TestLoader().loadTestsFromModule(wowspyder.GuildCharacter))
     suite.addTest(unittest.TestLoader().loadTestsFromModule(wowspyder.Arena))
+    suite.addTest(unittest.TestLoader().loadTestsFromModule(wowspyder.ConnectionPool))
+    suite.addTest(unittest.TestLoader().loadTestsFromModule(wowspyder.AsyncDownloader))
+    suite.addTest(unittest.TestLoader().loadTestsFromModule(wowspyder.ResponseCache))
+    suite.addTest(unittest.TestLoader().loadTestsFromModule(wowspyder.RateLimiter))
+    suite.addTest(unittest.TestLoader().loadTestsFromModule(wowspyder.ConcurrencyController))
+    suite.addTest(unittest.TestLoader().loadTestsFromModule(wowspyder.SingleFlight))
+    suite.addTest(unittest.TestLoader().loadTestsFromModule(wowspyder.RequestQueue))
+    suite.addTest(unittest.TestLoader().loadTestsFromModule(wowspyder.ArmorySession))
+    suite.addTest(unittest.TestLoader().loadTestsFromModule(wowspyder.ArmoryPage))
+    suite.addTest(unittest.TestLoader().loadTestsFromModule(wowspyder.ArmoryStandIn))
+    suite.addTest(unittest.TestLoader().loadTestsFromModule(wowspyder.DownloadStats))
+    suite.addTest(unittest.TestLoader().loadTestsFromModule(wowspyder.DownloadFuture))
+    suite.addTest(unittest.TestLoader().loadTestsFromModule(wowspyder.CircuitBreaker))
+    suite.addTest(unittest.TestLoader().loadTestsFromModule(wowspyder.NegativeCache))
+    suite.addTest(unittest.TestLoader().loadTestsFromModule(wowspyder.RetryPolicy))
+    suite.addTest(unittest.TestLoader().loadTestsFromModule(wowspyder.DeadLetter))
+    suite.addTest(unittest.TestLoader().loadTestsFromModule(wowspyder.XMLStream))
+    suite.addTest(unittest.TestLoader().loadTestsFromModule(wowspyder.GuildRoster))
+    suite.addTest(unittest.TestLoader().loadTestsFromModule(wowspyder.DeepFetch))
+    suite.addTest(unittest.TestLoader().loadTestsFromModule(wowspyder.FetchProfile))
+    suite.addTest(unittest.TestLoader().loadTestsFromModule(wowspyder.Parser))
     unittest.TextTestRunner(verbosity=2).run(suite)
 
 if __name__ == '__main__':
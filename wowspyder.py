@@ -13,9 +13,12 @@ import datetime
 import QueueManager
 import threading
 from wowspyder import Arena, Database, XMLDownloader, \
-    GuildCharacter, Team
+    GuildCharacter, Team, SingleFlight, DownloadStats, Preferences, NegativeCache, \
+    DeadLetter, Logger
 import gc
 import time
+
+log = Logger.log()
         
 class Widow(threading.Thread):
     def __init__(self, site=None):
@@ -45,14 +48,52 @@ class Widow(threading.Thread):
                 guild.last_refresh = datetime.datetime.now()
                 Database.session().expunge_all()
                 guild = self.qm.get_next_guild(realm)
+                
+            # A stub crawl leaves the characters that need their sheets
+            # queued, to be fetched now the rosters are all done.
+            cp = GuildCharacter.CharacterParser()
+            fetch = self.qm.get_next_character(realm)
+            
+            while fetch:
+                try:
+                    cp.get_character(fetch.name, fetch.realm, fetch.site, \
+                        force_refresh=True)
+                except Exception, e:
+                    log.warning((u"Couldn't fetch character " + fetch.name + \
+                        u". ERROR: " + unicode(e)).encode("utf-8"))
+                    
+                self.qm.finish_character(fetch)
+                Database.session().expunge_all()
+                fetch = self.qm.get_next_character(realm)
 
             self.qm.finish_realm(realm)
+            
+            # Downloads are coalesced across the whole process, so with
+            # more than one Widow running these counts are shared.
+            stats = SingleFlight.get_downloads().reset_stats()
+            log.info((u"Finished realm %s: %d downloads, %d saved by sharing " \
+                u"in-flight requests" % (unicode(realm), stats["calls"], \
+                stats["shared"])).encode("utf-8"))
+            log.info("Downloads for the realm:\n" + DownloadStats.format_summary( \
+                DownloadStats.get_stats().reset()))
             realm = self.qm.get_next_realm()
         
 
 # cflewis | 2009-04-09 | Threading should probably be just for one guild
 # at a time, so then a full object refresh can occur when it's finished.
 def main():
+    interval = Preferences.Preferences().stats_interval
+    if interval: DownloadStats.start_reporting(interval)
+    
+    # Anything the Armory didn't have that has expired will be asked for
+    # again anyway, so there's no need to keep it.
+    NegativeCache.purge()
+    
+    # Work that failed is redone in the background when the Armory is
+    # quiet, rather than waiting for the realm to come round again.
+    retry_interval = Preferences.Preferences().dead_letter_interval
+    if retry_interval: DeadLetter.start_retrying(retry_interval)
+    
     # us_thread = Widow(u"us")
     # us_thread.start()
     
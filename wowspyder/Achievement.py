@@ -11,7 +11,6 @@ import sys
 import os
 import unittest
 from Parser import Parser
-from xml.dom import minidom
 import Database
 import Logger
 import datetime
@@ -20,13 +20,12 @@ import time
 import urllib2
 import Team
 import Database
-import StringIO
-from xml.dom import minidom
 from sqlalchemy import and_
 from sqlalchemy.ext.declarative import declarative_base
 import Preferences
 import datetime
 from Parser import Parser
+import DeadLetter
 
 log = Logger.log()
 
@@ -37,21 +36,16 @@ class ArenaParser(Parser):
     themselves don't hold much interesting data.
     
     """
+    entity = "realm"
+    
     def __init__(self, downloader=None):
         log.debug("Creating arena with downloader " + str(downloader))
         Parser.__init__(self, downloader=downloader)
         self._tp = Team.TeamParser(downloader=self._downloader)
         
-    def _check_download(self, source, exception):
-        if exception:
-            log.error("Unable to download file for arena")
-            raise exception
-            
-        if re.search("arenaLadderPagedResult.*?filterValue=\"\"", source):
-            log.error("Realm was invalid or not returned")
-            raise IOError("Realm requested was invalid or not returned")
-            
-        return source
+    def _is_missing(self, parsed):
+        # The Armory leaves the filter blank when it doesn't know the realm
+        return parsed.attribute("arenaLadderPagedResult", "filterValue") == ""
         
     def get_arena_teams(self, battlegroup, realm, site, get_characters=False, \
         ladders=[2,3,5], max_pages=None):
@@ -71,16 +65,15 @@ class ArenaParser(Parser):
             except Exception, e:
                 log.warning("Couldn't get arena page for ladder " + 
                     str(ladder_number) + ", continuing. ERROR: " + str(e))
+                self._defer("arena", [battlegroup, realm, site, ladder_number, \
+                    None, get_characters], e)
                 continue
             
             if not max_pages: 
-                try:
-                    max_pages = WoWSpyderLib.get_max_pages(source)
-                except AttributeError, e:
-                    # cflewis | 2009-04-22 | This means that
-                    # this arena will be skipped, but it's better than
-                    # crashing
-                    max_pages = 0
+                # cflewis | 2009-04-22 | No page count means that
+                # this arena will be skipped, but it's better than
+                # crashing
+                max_pages = source.parsed().max_pages or 0
         
             for page in range(1, (max_pages + 1)):
                 log.debug(battlegroup + " " + realm + \
@@ -88,39 +81,70 @@ class ArenaParser(Parser):
                     + str(max_pages))
                 
                 try:
-                    source = self._download_url( \
-                        WoWSpyderLib.get_arena_url(battlegroup, realm, site, page=page, \
-                            ladder_number=ladder_number))
+                    # The first page is the one already downloaded
+                    teams = self._get_arena_page(battlegroup, realm, site, \
+                        ladder_number, page, get_characters, \
+                        source=(page == 1 and source or None))
                 except Exception, e:
                     log.warning("Couldn't get arena page, continuing... ERROR: " + str(e))
+                    self._defer("arena", [battlegroup, realm, site, \
+                        ladder_number, page, get_characters], e)
                     continue
                 
-                teams = self._parse_arena_file(StringIO.StringIO(source), site, get_characters=get_characters)
                 all_teams.append(teams)
                 
         return WoWSpyderLib.merge(all_teams)
+        
+    def _get_arena_page(self, battlegroup, realm, site, ladder_number, page, \
+            get_characters=False, source=None):
+        """Download and parse one page of a ladder, unless source, the page
+        already downloaded, is given.
+        
+        """
+        if source is None:
+            source = self._download_url( \
+                WoWSpyderLib.get_arena_url(battlegroup, realm, site, page=page, \
+                    ladder_number=ladder_number))
+        
+        return self._parse_arena_file(source.parsed(), site, \
+            get_characters=get_characters)
+        
+    def redo(self, battlegroup, realm, site, ladder_number, page, \
+            get_characters):
+        """Redo an arena page that failed, or the whole ladder if page is
+        None.
+        
+        """
+        if page is None:
+            return self.get_arena_teams(battlegroup, realm, site, \
+                get_characters=get_characters, ladders=[ladder_number])
+                
+        return self._get_arena_page(battlegroup, realm, site, ladder_number, \
+            page, get_characters)
             
-    def _parse_arena_file(self, xml_file_object, site, get_characters=False):
-        """Parse the XML of an arena page"""
-        xml = minidom.parse(xml_file_object)
-        team_nodes = xml.getElementsByTagName("arenaTeam")
+    def _parse_arena_file(self, parsed, site, get_characters=False):
+        """Parse an arena page, given its XMLStream.ParsedPage."""
         teams = []
         
-        for team_node in team_nodes:
-            name = team_node.attributes["name"].value
-            realm = team_node.attributes["realm"].value
-            size = team_node.attributes["size"].value
+        for team_node in parsed.all("arenaTeam"):
+            name = team_node["name"]
+            realm = team_node["realm"]
+            size = team_node["size"]
             
             try:
                 team = self._tp.get_team(name, realm, site, size, get_characters=get_characters)
             except Exception, e:
                 log.warning("Couldn't get team " + name + " continuing. ERROR: " + str(e))
+                self._defer(self._tp.entity, [name, realm, site, size, \
+                    get_characters], e)
                 continue
             else:
                 teams.append(team)
             
         return teams
         
+DeadLetter.register("arena", ArenaParser)
+
 class ArenaParserTests(unittest.TestCase):
     def setUp(self):
         self.us_realm = u"Blackwater Raiders"
@@ -129,6 +153,12 @@ class ArenaParserTests(unittest.TestCase):
         self.eu_battlegroup = u"Bloodlust"
         self.ap = ArenaParser()
         self.prefs = Preferences.Preferences()
+        import ArmoryStandIn
+        # Only the tests that download point the US Armory at the stand-in
+        self.stand_in = ArmoryStandIn.ArmoryStandIn().start()
+        
+    def tearDown(self):
+        self.stand_in.stop()
         
     def testGetUSArenaURL(self):
         us_url = WoWSpyderLib.get_arena_url(self.us_battlegroup, \
@@ -153,10 +183,12 @@ class ArenaParserTests(unittest.TestCase):
         # log.debug("Found %d guilds", len(guilds))
         
     def testGetTeamsNoCharacters(self):
+        self.stand_in.use([u"us"])
         teams = self.ap.get_arena_teams(self.us_battlegroup, self.us_realm, \
             u"us", get_characters=False, ladders=[2], max_pages=1)
 
     def testGetTeamsAndCharacters(self):
+        self.stand_in.use([u"us"])
         teams = self.ap.get_arena_teams(self.us_battlegroup, self.us_realm, \
             u"us", get_characters=True, ladders=[2], max_pages=1)
         
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+ArmoryPage.py
+
+Downloaded Armory pages, kept gzipped and decompressed a chunk at a time
+as they're parsed.
+
+Copyright (c) 2009, Regents of the University of California
+All rights reserved.
+"""
+
+import sys
+import os
+import unittest
+import zlib
+import struct
+import gzip
+import cStringIO
+import threading
+from xml.dom import minidom
+import XMLStream
+import Logger
+
+log = Logger.log()
+
+# How much of the gzipped page is fed to zlib at a time, and the most it
+# is allowed to hand back in one go.
+CHUNK_SIZE = 64 * 1024
+
+# Enough of the page to cover the page and header elements, where the
+# Armory reports errors, paging and when a character last changed.
+HEAD_SIZE = 8 * 1024
+
+# Tells zlib to expect a gzip header and trailer.
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+class Page(object):
+    """An Armory page as it came off the wire or out of the cache.
+
+    The page stays gzipped. stream() gives a file-like object that
+    decompresses as it's read, so parsers never need the whole page
+    decompressed at once, and head() decompresses just the start of the
+    page for quick checks. parsed() tokenizes the page once for everything
+    that reads it. unchanged is True when the Armory said the page hasn't
+    changed since we last downloaded it.
+
+    Pages are never modified, so one can be handed to several callers.
+
+    """
+    def __init__(self, url, gzip_data=None, data=None, unchanged=False):
+        self.url = url
+        self.gzip_data = gzip_data
+        self.data = data
+        self.unchanged = unchanged
+        self._head = None
+        self._parsed = None
+        self._lock = threading.Lock()
+
+    def stream(self):
+        """Return a new file-like object reading the page's XML."""
+        if self.gzip_data is None:
+            return cStringIO.StringIO(self.data)
+
+        return GzipStream(self.gzip_data)
+
+    def head(self, size=HEAD_SIZE):
+        """Return the first size bytes of the page's XML."""
+        if size == HEAD_SIZE and self._head is not None:
+            return self._head
+
+        head = self.stream().read(size)
+        if size == HEAD_SIZE: self._head = head
+        return head
+
+    def parsed(self):
+        """Return the page's XMLStream.ParsedPage, the same one every time,
+        so however many callers read the page it's only tokenized once.
+
+        """
+        self._lock.acquire()
+        try:
+            if self._parsed is None:
+                self._parsed = XMLStream.ParsedPage(self.stream())
+
+            return self._parsed
+        finally:
+            self._lock.release()
+
+    def size(self):
+        """Return how long the page's XML is, without decompressing it."""
+        if self.gzip_data is None:
+            return len(self.data)
+
+        return gzip_size(self.gzip_data)
+
+    def read(self):
+        """Return the whole of the page's XML."""
+        return self.stream().read()
+
+    def __str__(self):
+        return self.read()
+
+
+class GzipStream(object):
+    """A read-only file over gzipped data that is decompressed as it's
+    read. However much is asked for at once, at most CHUNK_SIZE bytes of
+    compressed data are fed to zlib at a time, and no more than was asked
+    for is decompressed.
+
+    """
+    def __init__(self, gzip_data, chunk_size=CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self._data = gzip_data
+        self._offset = 0
+        self._decompressor = zlib.decompressobj(_GZIP_WBITS)
+        self._pending = ""
+        self._finished = False
+
+    def _input(self):
+        """Return the next compressed input, starting with whatever zlib
+        didn't have room to decompress last time.
+
+        """
+        if self._decompressor.unconsumed_tail:
+            return self._decompressor.unconsumed_tail
+
+        chunk = self._data[self._offset:self._offset + self.chunk_size]
+        self._offset += len(chunk)
+        return chunk
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            parts = [self._pending]
+            self._pending = ""
+
+            while not self._finished:
+                parts.append(self._decompress(self.chunk_size))
+
+            return "".join(parts)
+
+        while len(self._pending) < size and not self._finished:
+            self._pending += self._decompress(max(size - len(self._pending), 1))
+
+        data, self._pending = self._pending[:size], self._pending[size:]
+        return data
+
+    def _decompress(self, size):
+        data = self._input()
+
+        if not data:
+            self._finished = True
+            return self._decompressor.flush()
+
+        try:
+            return self._decompressor.decompress(data, min(size, self.chunk_size))
+        except zlib.error, e:
+            raise IOError("Couldn't decompress page: " + str(e))
+
+    def close(self):
+        self._finished = True
+        self._pending = ""
+
+
+def gzip_size(gzip_data):
+    """Return how long gzip_data is once decompressed, as recorded in the
+    gzip trailer (modulo 4GB, which no Armory page comes near).
+
+    """
+    if len(gzip_data) < 4:
+        return 0
+
+    return struct.unpack("<I", gzip_data[-4:])[0]
+
+def gzip_string(data):
+    """Return data gzipped, as the Armory would send it."""
+    buf = cStringIO.StringIO()
+    f = gzip.GzipFile(fileobj=buf, mode="wb")
+    f.write(data)
+    f.close()
+    return buf.getvalue()
+
+
+class ArmoryPageTests(unittest.TestCase):
+    def setUp(self):
+        self.xml = "<?xml version=\"1.0\"?><page>" + \
+            "<character name=\"Moulin\" realm=\"Ravenholdt\"/>" * 5000 + "</page>"
+        self.page = Page("http://www.wowarmory.com/guild-info.xml", \
+            gzip_data=gzip_string(self.xml))
+
+    def testRead(self):
+        self.assertEqual(self.page.read(), self.xml)
+        self.assertEqual(str(self.page), self.xml)
+
+    def testChunkedRead(self):
+        stream = GzipStream(self.page.gzip_data, chunk_size=100)
+        chunks = []
+
+        while True:
+            chunk = stream.read(1000)
+            if not chunk: break
+            self.assertTrue(len(chunk) <= 1000)
+            chunks.append(chunk)
+
+        self.assertEqual("".join(chunks), self.xml)
+
+    def testHead(self):
+        self.assertEqual(self.page.head(), self.xml[:HEAD_SIZE])
+        self.assertEqual(self.page.head(10), "<?xml vers")
+
+    def testUncompressed(self):
+        page = Page(self.page.url, data=self.xml)
+        self.assertEqual(page.stream().read(), self.xml)
+        self.assertEqual(page.size(), len(self.xml))
+
+    def testSize(self):
+        self.assertEqual(self.page.size(), len(self.xml))
+
+    def testCorrupt(self):
+        page = Page(self.page.url, gzip_data="not gzip")
+        self.assertRaises(IOError, page.read)
+
+    def testParse(self):
+        xml = minidom.parse(self.page.stream())
+        self.assertEqual(len(xml.getElementsByTagName("character")), 5000)
+
+    def testParsedOnce(self):
+        parsed = self.page.parsed()
+        self.assertTrue(self.page.parsed() is parsed)
+        self.assertEqual(len(parsed.all("character")), 5000)
+
+    def testStreamsIndependent(self):
+        first = self.page.stream()
+        first.read(100)
+        self.assertEqual(self.page.stream().read(5), "<?xml")
+
+
+if __name__ == '__main__':
+    unittest.main()
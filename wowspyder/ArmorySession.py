@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+ArmorySession.py
+
+Login sessions with the Armory, one per host, shared by every downloader
+in the process.
+
+Copyright (c) 2009, Regents of the University of California
+All rights reserved.
+"""
+
+import sys
+import os
+import unittest
+import threading
+import time
+import cookielib
+import urllib2
+import urlparse
+import Logger
+
+log = Logger.log()
+
+LOGIN_PAGE = "login-status.xml"
+
+# How long a login is trusted for. The Armory doesn't say when it forgets
+# a session, so logging in again now and then is the only way to be sure.
+DEFAULT_MAX_AGE = 30 * 60
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def get_session(host):
+    """Return the session shared by everything requesting from host."""
+    _sessions_lock.acquire()
+
+    try:
+        session = _sessions.get(host)
+
+        if session is None:
+            session = ArmorySession(host)
+            _sessions[host] = session
+
+        return session
+    finally:
+        _sessions_lock.release()
+
+def get_session_for_url(url):
+    """Return the session for the host url points at."""
+    return get_session(urlparse.urlsplit(url)[1])
+
+def is_login_url(url):
+    return urlparse.urlsplit(url)[2].endswith("/" + LOGIN_PAGE)
+
+
+class ArmorySession(object):
+    """The cookies for one Armory host, and whether we've logged in to it.
+
+    Nobody logs in until a request for the host needs the session, and then
+    only one caller does it while the rest wait. After that the session is
+    reused until its cookies expire or it's older than max_age.
+
+    """
+    def __init__(self, host, max_age=DEFAULT_MAX_AGE):
+        self.host = host
+        self.max_age = max_age
+        self.login_url = "http://" + host + "/" + LOGIN_PAGE
+        self.cookie_jar = cookielib.CookieJar()
+        self.logins = 0
+        self._logged_in = None
+        self._lock = threading.Lock()
+
+    def is_valid(self):
+        """Return True if the login can still be used."""
+        if self._logged_in is None:
+            return False
+
+        if time.time() - self._logged_in > self.max_age:
+            log.debug("Session with " + self.host + " is too old")
+            return False
+
+        self.cookie_jar.clear_expired_cookies()
+
+        if not len(self.cookie_jar):
+            log.debug("Session cookies for " + self.host + " have expired")
+            return False
+
+        return True
+
+    def ensure_login(self, download):
+        """Log in, unless there's already a valid login. download is
+        called with the login URL to do the request, and must send it
+        with this session's cookies.
+
+        """
+        if self.is_valid():
+            return
+
+        self._lock.acquire()
+
+        try:
+            # Someone else may have logged in while we waited
+            if self.is_valid():
+                return
+
+            log.debug("Logging in to " + self.host)
+            download(self.login_url)
+            self._logged_in = time.time()
+            self.logins += 1
+            log.debug("Got cookie " + str(self.cookie_jar))
+        finally:
+            self._lock.release()
+
+    def expire(self):
+        """Forget the login, so the next request logs in again."""
+        self._logged_in = None
+
+
+class SessionCookieProcessor(urllib2.BaseHandler):
+    """A urllib2 handler that sends and stores cookies using the session
+    for each request's host, instead of a jar of its own.
+
+    """
+    def http_request(self, request):
+        get_session_for_url(request.get_full_url()).cookie_jar.add_cookie_header(request)
+        return request
+
+    def http_response(self, request, response):
+        get_session_for_url(request.get_full_url()).cookie_jar.extract_cookies( \
+            response, request)
+        return response
+
+    https_request = http_request
+    https_response = http_response
+
+
+class ArmorySessionTests(unittest.TestCase):
+    def setUp(self):
+        self.session = ArmorySession("eu.wowarmory.com")
+        self.logins = []
+
+    def login(self, url):
+        self.logins.append(url)
+        time.sleep(0.05)
+        self.session.cookie_jar.set_cookie(cookielib.Cookie(0, "JSESSIONID", \
+            "abc", None, False, self.session.host, False, False, "/", False, \
+            False, None, True, None, None, {}))
+
+    def testLazyLogin(self):
+        self.assertEqual(self.session.logins, 0)
+        self.session.ensure_login(self.login)
+        self.session.ensure_login(self.login)
+        self.assertEqual(self.logins, ["http://eu.wowarmory.com/login-status.xml"])
+
+    def testOneLoginForManyThreads(self):
+        threads = [threading.Thread(target=self.session.ensure_login, \
+            args=(self.login,)) for _ in xrange(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(self.logins), 1)
+
+    def testExpiry(self):
+        self.session.ensure_login(self.login)
+        self.session.expire()
+        self.session.ensure_login(self.login)
+
+        self.session.max_age = 0
+        self.session.ensure_login(self.login)
+        self.assertEqual(self.session.logins, 3)
+
+    def testNoCookies(self):
+        self.session.ensure_login(lambda url: None)
+        self.assertFalse(self.session.is_valid())
+
+    def testShared(self):
+        self.assertTrue(get_session_for_url("http://eu.wowarmory.com/team-info.xml") \
+            is get_session("eu.wowarmory.com"))
+        self.assertTrue(is_login_url("http://eu.wowarmory.com/login-status.xml"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,471 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+ArmoryStandIn.py
+
+A local stand-in for the Armory that serves recorded pages, so tests and
+benchmarks can run without the real thing.
+
+Copyright (c) 2009, Regents of the University of California
+All rights reserved.
+"""
+
+import sys
+import os
+import unittest
+import threading
+import time
+import random
+import md5
+import urllib
+import urllib2
+import urlparse
+import cgi
+import BaseHTTPServer
+import SocketServer
+import tempfile
+import shutil
+import XMLDownloader
+import ResponseCache
+import ArmoryPage
+import ArmorySession
+import WoWSpyderLib
+import Logger
+
+log = Logger.log()
+
+FIXTURE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), \
+    "data", "fixtures")
+
+SITES = ("us", "eu")
+
+LOGIN_STATUS = "<?xml version=\"1.0\" encoding=\"UTF-8\"?>" + \
+    "<page globalSearch=\"1\" lang=\"en_us\" requestUrl=\"/login-status.xml\">" + \
+    "<loginStatus username=\"\"/></page>"
+
+def fixture_path(url, directory=FIXTURE_DIRECTORY):
+    """Return where the page for url lives in a fixture corpus:
+    <site>/<page>/<query>.xml, with the query's parameters sorted so the
+    order they were given in doesn't matter.
+
+    """
+    scheme, host, path, query, fragment = urlparse.urlsplit(url)
+    parts = [part for part in path.split("/") if part]
+    page = "index"
+    if parts: page = parts[-1]
+
+    # The stand-in puts the site in the path; the Armory puts it in the host
+    if len(parts) > 1 and parts[-2] in SITES:
+        site = parts[-2]
+    elif host.startswith("eu."):
+        site = "eu"
+    else:
+        site = "us"
+
+    name = urllib.urlencode(sorted(cgi.parse_qsl(query))) or "index"
+
+    if len(name) > 200:
+        name = md5.new(name).hexdigest()
+
+    return os.path.join(directory, site, page.replace(".xml", ""), name + ".xml")
+
+
+class Recorder(object):
+    """Wraps a downloader, saving every page it downloads into a fixture
+    corpus. Hand it to a parser to capture everything a crawl touches:
+
+        parser = CharacterParser(downloader=Recorder(downloader))
+
+    """
+    def __init__(self, downloader, directory=FIXTURE_DIRECTORY):
+        self.downloader = downloader
+        self.directory = directory
+
+    def download_page(self, url, *args, **kwargs):
+        page = self.downloader.download_page(url, *args, **kwargs)
+        self._save(url, page)
+        return page
+
+    def submit(self, url, *args, **kwargs):
+        def save(future):
+            if future.exception() is None:
+                self._save(url, future.result())
+
+        future = self.downloader.submit(url, *args, **kwargs)
+        future.add_done_callback(save)
+        return future
+
+    def download_many(self, urls, *args, **kwargs):
+        return [self.submit(url, *args, **kwargs) for url in urls]
+
+    def _save(self, url, page):
+        path = fixture_path(url, self.directory)
+
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        log.debug("Recording " + url + " to " + path)
+        f = open(path, "wb")
+
+        try:
+            f.write(page.read())
+        finally:
+            f.close()
+
+    def download_url(self, url, *args, **kwargs):
+        return XMLDownloader.page_source(self.download_page(url, *args, **kwargs))
+
+    def close(self):
+        self.downloader.close()
+
+def record(urls, directory=FIXTURE_DIRECTORY, downloader=None):
+    """Download urls from the Armory into a fixture corpus. Pages that
+    can't be downloaded are skipped.
+
+    """
+    if downloader is None: downloader = XMLDownloader.XMLDownloader()
+    recorder = Recorder(downloader, directory)
+
+    for url in urls:
+        try:
+            recorder.download_page(url, cached=False)
+        except Exception, e:
+            log.warning("Couldn't record " + url + ". ERROR: " + str(e))
+
+
+class ArmoryStandIn(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serves a fixture corpus the way the Armory would: gzipped, with
+    ETags, session cookies and keep-alive. Each site is under its own path,
+    so site_url("eu") is http://127.0.0.1:<port>/eu/.
+
+    It can also misbehave the way the Armory does:
+
+    latency          seconds to wait before answering each request
+    connect_latency  seconds to wait before answering a new connection,
+                     as loopback connections are otherwise free
+    error_rate       fraction of requests answered with a 500
+    throttle_rate    requests a second allowed before answering with 503s,
+                     in bursts of up to throttle_burst
+    default_page     served for pages that aren't in the corpus, instead
+                     of a 404, so benchmarks can use as many URLs as they
+                     like
+
+    requests counts the requests it has answered, responses counts them by
+    status and paths by the path asked for.
+
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, directory=FIXTURE_DIRECTORY, port=0, latency=0.0, \
+            connect_latency=0.0, error_rate=0.0, throttle_rate=None, \
+            throttle_burst=10, default_page=None):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", port), \
+            _StandInHandler)
+        self.directory = directory
+        self.latency = latency
+        self.connect_latency = connect_latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.throttle_burst = throttle_burst
+        self.default_page = default_page
+        self.requests = 0
+        self.responses = {}
+        self.paths = {}
+        self._tokens = throttle_burst
+        self._last = time.time()
+        self._pages = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._cache_directory = None
+
+    @property
+    def base_url(self):
+        return "http://127.0.0.1:%d/" % self.server_address[1]
+
+    def site_url(self, site):
+        return self.base_url + site + "/"
+
+    def start(self):
+        """Serve requests on a background thread."""
+        # Poll often, so stop() doesn't hold up every test's tearDown
+        self._thread = threading.Thread(target=self.serve_forever, \
+            args=(0.05,), name="ArmoryStandIn")
+        self._thread.setDaemon(True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving, stop WoWSpyderLib pointing at the stand-in and
+        throw away the scratch response cache."""
+        for site in SITES:
+            if WoWSpyderLib.get_site_url(site) == self.site_url(site):
+                WoWSpyderLib.set_site_url(site, None)
+
+        if self._cache_directory is not None:
+            ResponseCache.set_default_path(None)
+            shutil.rmtree(self._cache_directory, ignore_errors=True)
+            self._cache_directory = None
+
+        if self._thread is not None:
+            self.shutdown()
+            self._thread = None
+
+        self.server_close()
+
+    def use(self, sites=SITES):
+        """Point WoWSpyderLib's URLs for sites at the stand-in, and give
+        the shared response cache a scratch file until the stand-in stops,
+        so tests never write to the user's cache."""
+        for site in sites:
+            WoWSpyderLib.set_site_url(site, self.site_url(site))
+
+        if self._cache_directory is None:
+            self._cache_directory = tempfile.mkdtemp()
+            ResponseCache.set_default_path(os.path.join( \
+                self._cache_directory, "cache.sqlite"))
+
+        return self
+
+    def process_request_thread(self, request, client_address):
+        time.sleep(self.connect_latency)
+        SocketServer.ThreadingMixIn.process_request_thread(self, request, \
+            client_address)
+
+    def count(self, path, status):
+        """Count a response, by status and by the path asked for."""
+        self._lock.acquire()
+
+        try:
+            self.requests += 1
+            self.responses[status] = self.responses.get(status, 0) + 1
+            self.paths[path] = self.paths.get(path, 0) + 1
+        finally:
+            self._lock.release()
+
+    def throttled(self):
+        """Take a token from the throttle, returning True if there wasn't
+        one to take.
+
+        """
+        if not self.throttle_rate:
+            return False
+
+        self._lock.acquire()
+
+        try:
+            now = time.time()
+            self._tokens = min(self.throttle_burst, \
+                self._tokens + (now - self._last) * self.throttle_rate)
+            self._last = now
+
+            if self._tokens < 1:
+                return True
+
+            self._tokens -= 1
+            return False
+        finally:
+            self._lock.release()
+
+    def get_page(self, path):
+        """Return the page at path, gzipped, and its ETag, or None if
+        there's no such page.
+
+        """
+        if path.endswith("/" + ArmorySession.LOGIN_PAGE):
+            key = ArmorySession.LOGIN_PAGE
+        else:
+            key = fixture_path(path, self.directory)
+
+            if not os.path.exists(key):
+                if self.default_page is None:
+                    return None
+                key = None
+
+        self._lock.acquire()
+
+        try:
+            if key in self._pages:
+                return self._pages[key]
+        finally:
+            self._lock.release()
+
+        if key == ArmorySession.LOGIN_PAGE:
+            data = LOGIN_STATUS
+        elif key is None:
+            data = self.default_page
+        else:
+            f = open(key, "rb")
+
+            try:
+                data = f.read()
+            finally:
+                f.close()
+
+        page = (data, ArmoryPage.gzip_string(data), \
+            "\"" + md5.new(data).hexdigest() + "\"")
+
+        self._lock.acquire()
+
+        try:
+            self._pages[key] = page
+        finally:
+            self._lock.release()
+
+        return page
+
+
+class _StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Write each response in one go, otherwise Nagle's algorithm stalls
+    # every reply on a kept-alive connection.
+    wbufsize = -1
+
+    def do_GET(self):
+        server = self.server
+        time.sleep(server.latency)
+
+        if server.throttled():
+            self._send(503)
+            return
+
+        if server.error_rate and random.random() < server.error_rate:
+            self._send(500)
+            return
+
+        page = server.get_page(self.path)
+
+        if page is None:
+            self._send(404)
+            return
+
+        data, gzip_data, etag = page
+        headers = [("ETag", etag), ("Content-Type", "text/xml")]
+
+        if self.path.endswith("/" + ArmorySession.LOGIN_PAGE):
+            headers.append(("Set-Cookie", "JSESSIONID=%x; Path=/" % \
+                random.getrandbits(64)))
+
+        if self.headers.getheader("If-None-Match") == etag:
+            self._send(304, headers=headers)
+            return
+
+        if "gzip" in (self.headers.getheader("Accept-Encoding") or ""):
+            headers.append(("Content-Encoding", "gzip"))
+            data = gzip_data
+
+        self._send(200, data, headers)
+
+    def _send(self, status, body="", headers=()):
+        self.server.count(self.path, status)
+        self.send_response(status)
+
+        for name, value in headers:
+            self.send_header(name, value)
+
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ArmoryStandInTests(unittest.TestCase):
+    def setUp(self):
+        self.stand_in = ArmoryStandIn().start().use()
+        self.opener = urllib2.build_opener()
+        self.moulin = WoWSpyderLib.get_character_sheet_url(u"Moulin", \
+            u"Ravenholdt", u"us")
+
+    def tearDown(self):
+        self.stand_in.stop()
+
+    def testFixturePath(self):
+        first = fixture_path("http://www.wowarmory.com/character-sheet.xml" + \
+            "?r=Ravenholdt&n=Moulin", "fixtures")
+        second = fixture_path(self.stand_in.site_url("us") + \
+            "character-sheet.xml?n=Moulin&r=Ravenholdt", "fixtures")
+        self.assertEqual(first, second)
+        self.assertEqual(first, os.path.join("fixtures", "us", \
+            "character-sheet", "n=Moulin&r=Ravenholdt.xml"))
+        self.assertTrue(os.path.join("eu", "team-info") in fixture_path( \
+            "http://eu.wowarmory.com/team-info.xml?t=Meow"))
+
+    def testSiteURL(self):
+        self.assertEqual(WoWSpyderLib.get_site_url(u"us"), \
+            self.stand_in.site_url("us"))
+        self.stand_in.stop()
+        self.assertEqual(WoWSpyderLib.get_site_url(u"us"), \
+            "http://www.wowarmory.com/")
+
+    def testServesFixture(self):
+        source = self.opener.open(self.moulin).read()
+        self.assertTrue("name=\"Moulin\"" in source)
+
+    def testGzipAndNotModified(self):
+        request = urllib2.Request(self.moulin)
+        request.add_header("Accept-Encoding", "gzip")
+        response = self.opener.open(request)
+        self.assertEqual(response.info().getheader("Content-Encoding"), "gzip")
+
+        request.add_header("If-None-Match", response.info().getheader("ETag"))
+
+        try:
+            self.opener.open(request)
+        except urllib2.HTTPError, e:
+            self.assertEqual(e.code, 304)
+        else:
+            self.fail("Expected a 304")
+
+    def testMissing(self):
+        try:
+            self.opener.open(self.stand_in.site_url("us") + "guild-info.xml?n=Nobody")
+        except urllib2.HTTPError, e:
+            self.assertEqual(e.code, 404)
+        else:
+            self.fail("Expected a 404")
+
+    def testDefaultPage(self):
+        self.stand_in.default_page = "<page/>"
+        self.assertEqual(self.opener.open(self.stand_in.site_url("us") + \
+            "guild-info.xml?n=Nobody").read(), "<page/>")
+
+    def testThrottle(self):
+        self.stand_in.throttle_rate = 1
+        self.stand_in.throttle_burst = 2
+        self.stand_in._tokens = 2
+
+        codes = []
+
+        for _ in xrange(3):
+            try:
+                codes.append(self.opener.open(self.moulin).code)
+            except urllib2.HTTPError, e:
+                codes.append(e.code)
+
+        self.assertEqual(codes, [200, 200, 503])
+
+    def testErrors(self):
+        self.stand_in.error_rate = 1.0
+        self.assertRaises(urllib2.HTTPError, self.opener.open, self.moulin)
+        self.assertEqual(self.stand_in.responses, {500: 1})
+
+    def testRecorder(self):
+        directory = tempfile.mkdtemp()
+        cache = ResponseCache.ResponseCache(os.path.join(directory, "cache.sqlite"))
+        recorder = Recorder(XMLDownloader.XMLDownloader(cache=cache), \
+            os.path.join(directory, "fixtures"))
+
+        try:
+            source = recorder.download_url(self.moulin)
+            f = open(fixture_path(self.moulin, recorder.directory))
+            self.assertEqual(f.read(), source)
+            f.close()
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,777 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+AsyncDownloader.py
+
+An event loop download engine. It offers the same download_url/close
+surface as XMLDownloaderThreaded, but runs every request on one thread
+instead of one thread per request.
+
+Copyright (c) 2009, Regents of the University of California
+All rights reserved.
+"""
+
+import sys
+import os
+import unittest
+import asyncore
+import socket
+import errno
+import fcntl
+import threading
+import time
+import heapq
+import urllib2
+import urlparse
+import httplib
+import StringIO
+import gzip
+import tempfile
+import shutil
+import BaseHTTPServer
+import SocketServer
+import XMLDownloader
+import ResponseCache
+import RateLimiter
+import DownloadStats
+import DownloadFuture
+import ConcurrencyController
+import CircuitBreaker
+import RetryPolicy
+import SingleFlight
+import RequestQueue
+import WoWSpyderLib
+import ArmorySession
+import ArmoryPage
+import Logger
+
+log = Logger.log()
+
+class XMLDownloaderAsync(object):
+    '''A drop-in alternative to XMLDownloaderThreaded that multiplexes
+    requests on a single asyncore loop.
+
+    max_in_flight plays the part of the thread count: it is the number of
+    requests that can be on the wire at once. Requests wait on the shared
+    RateLimiter before they go out, just as the downloader threads do, so
+    the two engines keep to the same budget. Within max_in_flight, each
+    host's ConcurrencyController decides how many of its requests are out.
+    Backing off on errors doesn't hold a slot. Waiting requests are
+    started in priority order, as in XMLDownloaderThreaded.
+
+    '''
+    def __init__(self, max_in_flight=20, backoff_attempts=3, \
+            backoff_initial_time=30, backoff_increment=60, timeout=60, \
+            max_redirects=5, cache=None, priorities=None, aging=5, \
+            deadline=None, retry_policy=None):
+        self.max_in_flight = max_in_flight
+
+        # A retry_policy replaces the backoff arguments, timeout and deadline
+        if retry_policy is None:
+            retry_policy = RetryPolicy.RetryPolicy(attempts=backoff_attempts, \
+                initial=backoff_initial_time, increment=backoff_increment, \
+                timeout=timeout, deadline=deadline)
+        self.retry_policy = retry_policy
+        self.max_redirects = max_redirects
+        self.priorities = priorities
+
+        if cache is None: cache = ResponseCache.get_cache()
+        self._cache = cache
+
+        self._map = {}
+        self._lock = threading.Lock()
+        self._incoming = []
+        self._waiting = RequestQueue.PriorityRequestQueue(aging=aging)
+        self._timers = []
+        self._sequence = 0
+        self._slots = max_in_flight
+        self._connections = set()
+        self._addresses = {}
+        self._closed = False
+
+        self._waker = _Waker(self._map)
+        self._thread = threading.Thread(target=self._run, name="XMLDownloaderAsync")
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def __del__(self):
+        self.close()
+
+    def refresh_login(self, site_url=None):
+        """Refresh the login, getting a new session cookie from the Armory
+        at site_url (the US Armory by default).
+
+        """
+        if site_url is None: site_url = WoWSpyderLib.get_site_url(u"us")
+        session = ArmorySession.get_session_for_url(site_url)
+        session.expire()
+        session.ensure_login(self._login)
+
+    def _login(self, login_url):
+        self.download_url(login_url, cached=False)
+
+    def download_url(self, url, cached=True, priority=None):
+        """Download a URL and return the source, blocking until the
+        event loop has fetched it.
+
+        """
+        return XMLDownloader.page_source(self.download_page(url, cached, \
+            priority))
+
+    def download_page(self, url, cached=True, priority=None):
+        """Download a URL and return it as an ArmoryPage.Page, blocking
+        until the event loop has fetched it. priority overrides the URL's
+        priority class.
+
+        """
+        return self.submit(url, cached, priority).result()
+
+    def download_many(self, urls, cached=True, priority=None):
+        """Hand all of urls to the event loop at once, returning a future
+        for each, in the same order. DownloadFuture.as_completed() hands
+        them back as they finish.
+
+        """
+        return [self.submit(url, cached, priority) for url in urls]
+
+    def submit(self, url, cached=True, priority=None):
+        """Hand a URL to the event loop and return a DownloadFuture.Future
+        for its page without waiting for it, though the first request to
+        a host waits for the login.
+
+        """
+        entry = None
+
+        if cached:
+            entry = self._cache.lookup(url)
+
+            if entry is None or not entry.fresh:
+                log.debug("Retrieving " + url)
+                DownloadStats.get_stats().record_cache(url, False)
+            else:
+                log.debug("Returning cached version of " + url)
+                DownloadStats.get_stats().record_cache(url, True)
+                return DownloadFuture.completed(ArmoryPage.Page(url, \
+                    gzip_data=entry.body))
+
+        if not ArmorySession.is_login_url(url):
+            ArmorySession.get_session_for_url(url).ensure_login(self._login)
+
+        try:
+            CircuitBreaker.get_breaker_for_url(url).check()
+        except CircuitBreaker.CircuitOpenError, e:
+            future = DownloadFuture.Future()
+            future.set_exception(e)
+            return future
+
+        if priority is None:
+            priority = WoWSpyderLib.get_url_priority(url, self.priorities)
+
+        # Anyone else asking for the same URL while it's on the wire gets
+        # this download's result.
+        return SingleFlight.get_downloads().submit(url, self._queue, url, \
+            cached, entry, priority)
+
+    def _queue(self, future, url, cached, entry, priority):
+        """Hand a request to the event loop, which finishes future."""
+        request = _Request(url, cached, self.retry_policy.begin(), future)
+        request.entry = entry
+        request.priority = priority
+
+        self._lock.acquire()
+
+        try:
+            if self._closed:
+                raise IOError("Downloader has been closed")
+
+            self._incoming.append(request)
+            # Under the lock, so the loop can't have closed the waker
+            self._waker.wake()
+        finally:
+            self._lock.release()
+
+    def close(self):
+        """Close the object, ending the event loop. Requests still
+        waiting are failed with an IOError.
+
+        """
+        self._lock.acquire()
+
+        try:
+            if self._closed:
+                return
+            self._closed = True
+            self._waker.wake()
+        finally:
+            self._lock.release()
+
+    def _run(self):
+        while not self._closed:
+            self._lock.acquire()
+
+            try:
+                incoming, self._incoming = self._incoming, []
+            finally:
+                self._lock.release()
+
+            for request in incoming:
+                self._waiting.put(request, request.priority)
+
+            now = time.time()
+
+            while self._timers and self._timers[0][0] <= now:
+                when, sequence, callback = heapq.heappop(self._timers)
+                callback()
+
+            if self._slots > 0 and self._waiting:
+                self._dispatch()
+
+            for connection in list(self._connections):
+                if now - connection.last_activity > \
+                        connection.request.retry.timeout():
+                    connection.fail(urllib2.URLError("timed out"))
+
+            timeout = 1.0
+
+            if self._timers:
+                timeout = max(0, min(timeout, self._timers[0][0] - time.time()))
+
+            asyncore.loop(timeout=timeout, map=self._map, use_poll=True, count=1)
+
+        self._shutdown()
+
+    def _shutdown(self):
+        error = IOError("Downloader has been closed")
+
+        for connection in list(self._connections):
+            connection.fail(error)
+
+        self._lock.acquire()
+
+        try:
+            incoming, self._incoming = self._incoming, []
+        finally:
+            self._lock.release()
+
+        for request in incoming:
+            request.finish(error=error)
+
+        while self._waiting:
+            self._waiting.get(block=False).finish(error=error)
+
+        for when, sequence, callback in self._timers:
+            pending = getattr(callback, "request", None)
+            if pending is not None:
+                self._finished(pending, ConcurrencyController.FAILED)
+                pending.finish(error=error)
+
+        self._timers = []
+        # _queue and close only wake the loop under the lock, and only
+        # while it's open, so nothing writes to the pipe once it's closed
+        self._lock.acquire()
+
+        try:
+            self._waker.close()
+        finally:
+            self._lock.release()
+
+    def _call_later(self, delay, callback):
+        self._sequence += 1
+        heapq.heappush(self._timers, (time.time() + delay, self._sequence, callback))
+
+    def _resolve(self, host, port):
+        try:
+            return self._addresses[(host, port)]
+        except KeyError, e:
+            address = (socket.gethostbyname(host), port)
+            self._addresses[(host, port)] = address
+            return address
+
+    def _dispatch(self):
+        """Start as many waiting requests as there are free slots and
+        room in their hosts' concurrency windows. Requests for a host
+        whose window is full stay in line without holding up the others.
+
+        """
+        blocked = []
+
+        while self._slots > 0 and self._waiting:
+            due, request = self._waiting.get_entry(block=False)
+            controller = ConcurrencyController.get_controller_for_url(request.url)
+
+            if not controller.try_acquire():
+                blocked.append((due, request))
+                continue
+
+            self._slots -= 1
+            request.controller = controller
+            self._throttle(request)
+
+        for due, request in blocked:
+            self._waiting.put_at(request, due)
+
+    def _throttle(self, request):
+        """Start the request once the rate limiter allows it. It keeps
+        its slot while it waits.
+
+        """
+        wait = RateLimiter.get_limiter_for_url(request.url).reserve()
+        DownloadStats.get_stats().record_throttle(request.url, wait)
+
+        if wait <= 0:
+            self._start(request)
+            return
+
+        def start():
+            self._start(request)
+
+        start.request = request
+        self._call_later(wait, start)
+
+    def _start(self, request):
+        log.debug("Downloading " + request.url)
+        parts = urlparse.urlsplit(request.url)
+        selector = parts[2] or "/"
+
+        if parts[3]:
+            selector += "?" + parts[3]
+
+        # The urllib2 request is only used to get cookies in and out of
+        # the jar.
+        cookie_request = urllib2.Request(request.url)
+        session = ArmorySession.get_session_for_url(request.url)
+        session.cookie_jar.add_cookie_header(cookie_request)
+
+        lines = ["GET " + selector + " HTTP/1.0",
+            "Host: " + parts[1],
+            "User-Agent: " + XMLDownloader.USER_AGENT,
+            "Accept-Encoding: gzip"]
+
+        cookie = cookie_request.get_header("Cookie")
+
+        if cookie:
+            lines.append("Cookie: " + cookie)
+
+        if request.entry is not None:
+            if request.entry.etag:
+                lines.append("If-None-Match: " + request.entry.etag)
+            if request.entry.last_modified:
+                lines.append("If-Modified-Since: " + request.entry.last_modified)
+
+        data = "\r\n".join(lines) + "\r\n\r\n"
+        request.sent = time.time()
+        request.status = None
+        request.compressed_bytes = 0
+        request.decompressed_bytes = 0
+
+        try:
+            address = self._resolve(parts.hostname, parts.port or 80)
+            connection = _ArmoryConnection(self, request, address, data)
+        except socket.error, e:
+            self._finished(request, ConcurrencyController.THROTTLED)
+            self._retry(request, urllib2.URLError(e))
+        else:
+            self._connections.add(connection)
+
+    def _finished(self, request, outcome):
+        """Give back a request's slot and its place in the concurrency
+        window, telling the window how the request went, and record the
+        fetch in the download stats.
+
+        """
+        if request.controller is None:
+            return
+
+        latency = None
+        if request.sent is not None: latency = time.time() - request.sent
+        request.controller.release(outcome, latency)
+        CircuitBreaker.get_breaker_for_url(request.url).record(outcome)
+
+        if latency is not None:
+            DownloadStats.get_stats().record_fetch(request.url, latency, \
+                request.status, request.compressed_bytes, \
+                request.decompressed_bytes)
+
+        request.controller = None
+        self._slots += 1
+
+    def _response(self, connection, data):
+        self._connections.discard(connection)
+        request = connection.request
+
+        try:
+            status, reason, message, body = _parse_response(data)
+        except ValueError, e:
+            log.warning("Bad response for " + request.url)
+            self._finished(request, ConcurrencyController.FAILED)
+            self._retry(request, urllib2.URLError(e))
+            return
+
+        request.status = status
+        request.compressed_bytes = len(body)
+
+        if message.getheader("Content-Encoding") == "gzip":
+            request.decompressed_bytes = ArmoryPage.gzip_size(body)
+        else:
+            request.decompressed_bytes = len(body)
+
+        if status >= 500:
+            self._finished(request, ConcurrencyController.THROTTLED)
+        elif status >= 400 and status != 404:
+            self._finished(request, ConcurrencyController.FAILED)
+        else:
+            self._finished(request, ConcurrencyController.SUCCEEDED)
+
+        session = ArmorySession.get_session_for_url(request.url)
+        session.cookie_jar.extract_cookies(_CookieResponse(message), \
+            urllib2.Request(request.url))
+
+        if status in (301, 302, 303, 307) and message.getheader("Location"):
+            if request.redirects >= self.max_redirects:
+                request.finish(error=urllib2.HTTPError(request.url, status, \
+                    "Too many redirects", message, StringIO.StringIO(body)))
+                return
+
+            request.redirects += 1
+            request.url = urlparse.urljoin(request.url, message.getheader("Location"))
+            self._waiting.put(request, request.priority)
+            return
+
+        if status == 304 and request.entry is not None:
+            log.debug("Not modified, returning cached version of " + request.url)
+            self._cache.revalidate(request.cache_key)
+            request.finish(result=ArmoryPage.Page(request.url, \
+                gzip_data=request.entry.body, unchanged=True))
+            return
+
+        if status != 200:
+            log.warning("Download URL failed, got HTTP %d. URL: %s" % \
+                (status, request.url))
+            error = urllib2.HTTPError(request.url, status, reason, message, \
+                StringIO.StringIO(body))
+
+            if status == 404:
+                log.debug("couldn't find page")
+                request.finish(error=error)
+            else:
+                self._retry(request, error)
+
+            return
+
+        log.debug("Downloaded %s" % request.url)
+
+        if message.getheader("Content-Encoding") != "gzip":
+            request.finish(result=ArmoryPage.Page(request.url, data=body))
+            return
+
+        if request.cached:
+            self._cache.put(request.cache_key, body, \
+                etag=message.getheader("ETag"), \
+                last_modified=message.getheader("Last-Modified"))
+
+        request.finish(result=ArmoryPage.Page(request.url, gzip_data=body))
+
+    def _connection_failed(self, connection, error):
+        self._connections.discard(connection)
+        log.warning("Time out")
+        self._finished(connection.request, ConcurrencyController.THROTTLED)
+        self._retry(connection.request, urllib2.URLError(error))
+
+    def _retry(self, request, error):
+        """Back off and put the request back in line, or give up on it.
+        Requests to a host whose breaker has opened are given up on
+        straight away, rather than waiting out a backoff for nothing.
+
+        """
+        breaker = CircuitBreaker.get_breaker_for_url(request.url)
+
+        if breaker.is_open():
+            request.finish(error=CircuitBreaker.CircuitOpenError( \
+                "Circuit to " + breaker.host + " is open, giving up on " + \
+                request.url))
+            return
+
+        delay = request.retry.backoff()
+
+        if delay is None:
+            request.finish(error=error)
+            return
+
+        log.warning("Sleeping for: %d" % (delay))
+        DownloadStats.get_stats().record_retry(request.url, delay)
+
+        def requeue():
+            self._waiting.put(request, request.priority)
+
+        requeue.request = request
+        self._call_later(delay, requeue)
+
+
+class _Request(object):
+    """A download waiting on, or being handled by, the event loop."""
+    def __init__(self, url, cached, retry, future):
+        self.url = url
+        self.cache_key = url
+        self.cached = cached
+        self.entry = None
+        self.retry = retry
+        self.redirects = 0
+        self.priority = 0
+        self.controller = None
+        self.sent = None
+        self.status = None
+        self.compressed_bytes = 0
+        self.decompressed_bytes = 0
+        self.future = future
+
+    def finish(self, result=None, error=None):
+        if error is None:
+            self.future.set_result(result)
+        else:
+            self.future.set_exception(error)
+
+
+class _ArmoryConnection(asyncore.dispatcher):
+    """A single HTTP/1.0 request. The server closing the connection marks
+    the end of the response.
+
+    """
+    def __init__(self, engine, request, address, data):
+        asyncore.dispatcher.__init__(self, map=engine._map)
+        self.engine = engine
+        self.request = request
+        self.outgoing = data
+        self.incoming = []
+        self.last_activity = time.time()
+        self.finished = False
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+
+        try:
+            self.connect(address)
+        except socket.error, e:
+            self.close()
+            raise
+
+    def handle_connect(self):
+        self.last_activity = time.time()
+
+    def writable(self):
+        return not self.connected or bool(self.outgoing)
+
+    def handle_write(self):
+        sent = self.send(self.outgoing)
+        self.outgoing = self.outgoing[sent:]
+        self.last_activity = time.time()
+
+    def handle_read(self):
+        data = self.recv(65536)
+
+        if data:
+            self.incoming.append(data)
+            self.last_activity = time.time()
+
+    def handle_close(self):
+        if self.finished:
+            return
+
+        self.finished = True
+        self.close()
+        self.engine._response(self, "".join(self.incoming))
+
+    def handle_error(self):
+        self.fail(sys.exc_info()[1])
+
+    def fail(self, error):
+        if self.finished:
+            return
+
+        self.finished = True
+        self.close()
+        self.engine._connection_failed(self, error)
+
+
+class _Waker(asyncore.file_dispatcher):
+    """Wakes the event loop when a request is handed over from another
+    thread.
+
+    """
+    def __init__(self, map):
+        self._read_fd, self._write_fd = os.pipe()
+        flags = fcntl.fcntl(self._write_fd, fcntl.F_GETFL)
+        fcntl.fcntl(self._write_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        asyncore.file_dispatcher.__init__(self, self._read_fd, map=map)
+        os.close(self._read_fd)
+
+    def wake(self):
+        try:
+            os.write(self._write_fd, "x")
+        except OSError, e:
+            # The pipe is full, so the loop is going to wake anyway
+            if e.errno not in (errno.EAGAIN, errno.EBADF):
+                raise
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(4096)
+
+    def close(self):
+        asyncore.file_dispatcher.close(self)
+        os.close(self._write_fd)
+
+
+class _CookieResponse(object):
+    """Just enough of a urllib2 response for cookielib."""
+    def __init__(self, message):
+        self._message = message
+
+    def info(self):
+        return self._message
+
+
+def _parse_response(data):
+    """Split a raw HTTP response into status, reason, headers and body."""
+    head, separator, body = data.partition("\r\n\r\n")
+
+    if not separator:
+        raise ValueError("Incomplete HTTP response")
+
+    status_line, separator, header_text = head.partition("\r\n")
+    parts = status_line.split(None, 2)
+
+    if len(parts) < 2 or not parts[0].startswith("HTTP/"):
+        raise ValueError("Bad status line: " + status_line)
+
+    reason = ""
+    if len(parts) == 3: reason = parts[2]
+
+    message = httplib.HTTPMessage(StringIO.StringIO(header_text + "\r\n"))
+
+    return int(parts[1]), reason, message, body
+
+class _TestArmoryHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    wbufsize = -1
+    unavailable = {}
+
+    def do_GET(self):
+        if self.path.startswith("/missing"):
+            self.send_error(404)
+            return
+
+        if self.path.startswith("/busy") and \
+                self.unavailable.setdefault(self.path, 1) > 0:
+            self.unavailable[self.path] -= 1
+            self.send_error(503)
+            return
+
+        if self.headers.getheader("If-None-Match") == "\"v1\"":
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        buf = StringIO.StringIO()
+        f = gzip.GzipFile(fileobj=buf, mode="wb")
+        f.write("<?xml version=\"1.0\"?><page path=\"" + self.path + "\"/>")
+        f.close()
+
+        self.send_response(200)
+        self.send_header("Content-Encoding", "gzip")
+        self.send_header("Set-Cookie", "JSESSIONID=1234; Path=/")
+        self.send_header("ETag", "\"v1\"")
+        self.end_headers()
+        self.wfile.write(buf.getvalue())
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _TestArmory(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class XMLDownloaderAsyncTests(unittest.TestCase):
+    def setUp(self):
+        self.server = _TestArmory(("127.0.0.1", 0), _TestArmoryHandler)
+        self.base_url = "http://127.0.0.1:%d/" % self.server.server_address[1]
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+        self.directory = tempfile.mkdtemp()
+        RateLimiter.configure(rate=None)
+        self.downloader = XMLDownloaderAsync(max_in_flight=5, \
+            backoff_initial_time=0.1, backoff_increment=0.1, \
+            cache=ResponseCache.ResponseCache(os.path.join(self.directory, "cache")))
+
+    def tearDown(self):
+        self.downloader.close()
+        shutil.rmtree(self.directory)
+        RateLimiter.configure()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def testDownloadXMLSource(self):
+        source = self.downloader.download_url(self.base_url + "arena-ladder.xml", \
+            cached=False)
+        self.assertTrue(source.startswith("<?xml"))
+
+    def testCookies(self):
+        session = ArmorySession.get_session_for_url(self.base_url)
+        self.assertEqual(session.logins, 0)
+
+        self.downloader.download_url(self.base_url + "arena-ladder.xml")
+        self.downloader.download_url(self.base_url + "team-info.xml")
+        self.assertEqual(session.logins, 1)
+        self.assertEqual(len(session.cookie_jar), 1)
+
+    def testDownloadMissing(self):
+        self.assertRaises(urllib2.HTTPError, self.downloader.download_url, \
+            self.base_url + "missing.xml")
+
+    def testBackoff(self):
+        source = self.downloader.download_url(self.base_url + "busy.xml")
+        self.assertTrue(source.startswith("<?xml"))
+
+    def testManyInFlight(self):
+        results = []
+
+        def fetch(n):
+            results.append(self.downloader.download_url( \
+                self.base_url + "team-info.xml?t=" + str(n), cached=False))
+
+        threads = [threading.Thread(target=fetch, args=(n,)) for n in xrange(50)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(results), 50)
+
+    def testDownloadMany(self):
+        urls = [self.base_url + "team-info.xml?t=" + str(n) for n in xrange(50)]
+        futures = self.downloader.download_many(urls, cached=False)
+        finished = list(DownloadFuture.as_completed(futures, timeout=30))
+
+        self.assertEqual(len(finished), 50)
+        self.assertTrue(futures[0].result().read())
+
+    def testNotModified(self):
+        url = self.base_url + "guild-info.xml?n=Meow"
+        self.downloader._cache.ttls["guild"] = 0.01
+        source = self.downloader.download_url(url)
+        self.assertFalse(XMLDownloader.is_unchanged(source))
+
+        time.sleep(0.02)
+        unchanged = self.downloader.download_url(url)
+        self.assertTrue(XMLDownloader.is_unchanged(unchanged))
+        self.assertEqual(source, unchanged)
+
+    def testClose(self):
+        self.downloader.close()
+        self.assertRaises(IOError, self.downloader.download_url, \
+            self.base_url + "arena-ladder.xml")
+
+
+if __name__ == '__main__':
+    unittest.main()
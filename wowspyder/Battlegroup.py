@@ -10,7 +10,7 @@ Copyright (c) 2009 Regents of University of Califonia. All rights reserved.
 import sys
 import os
 import unittest
-from xml.dom import minidom
+import XMLStream
 import Database
 import Logger
 import datetime
@@ -33,32 +33,32 @@ class BattlegroupParser(object):
         
     def parse_battlegroup_file(self, filename):
         # cflewis | 2009-03-15 | This should parse as UTF-8 automatically
-        xml = minidom.parse(filename)
-        log.debug("XML is %s" % xml.toxml())
-        battlegroups = xml.getElementsByTagName("battlegroup")
+        # Realms come inside their battlegroup, so the battlegroup they
+        # belong to is the last one seen
+        battlegroup = None
         
-        for bg_node in battlegroups:
-            self._parse_battlegroup_node(bg_node)
+        for tag, node in XMLStream.iter_elements(filename, \
+            ("battlegroup", "realm")):
+            if tag == "battlegroup":
+                battlegroup = self._parse_battlegroup_node(node)
+            else:
+                self._parse_realm_node(node, battlegroup)
         
     def _parse_battlegroup_node(self, bg_node):
-        name = bg_node.attributes["name"].value
-        site = bg_node.attributes["site"].value
+        name = bg_node["name"]
+        site = bg_node["site"]
                 
         bg = Battlegroup(name, site)
         Database.insert(bg)
         log.debug("Battlegroup is %s %s" % (site, name))
         
-        realms = bg_node.getElementsByTagName("realm")
+        return name
         
-        for realm_node in realms:
-            self._parse_realm_node(realm_node)
-        
-    def _parse_realm_node(self, realm_node):
-        name = realm_node.attributes["name"].value
-        site = realm_node.attributes["site"].value
-        battlegroup = realm_node.parentNode.attributes["name"].value
-        server_type = realm_node.attributes["type"].value
-        language = realm_node.attributes["lang"].value        
+    def _parse_realm_node(self, realm_node, battlegroup):
+        name = realm_node["name"]
+        site = realm_node["site"]
+        server_type = realm_node["type"]
+        language = realm_node["lang"]
         
         realm = Realm(name, site, battlegroup, server_type, language)
         Database.insert(realm)
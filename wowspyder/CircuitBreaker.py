@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+CircuitBreaker.py
+
+Stops sending requests to an Armory host that keeps failing, so callers
+fail fast instead of queueing and backing off against a host that isn't
+going to answer.
+
+Copyright (c) 2009, Regents of the University of California
+All rights reserved.
+"""
+
+import sys
+import os
+import unittest
+import threading
+import time
+import urlparse
+import ConcurrencyController
+import Logger
+
+log = Logger.log()
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+_settings = {"failures": 5, "reset_time": 60}
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+class CircuitOpenError(IOError):
+    """Raised instead of sending a request to a host whose breaker is
+    open.
+
+    """
+    pass
+
+
+def configure(failures=5, reset_time=60):
+    """Set how many failures in a row open a host's breaker, and how many
+    seconds it stays open before a request is let through to probe the
+    host. Applies to every host, including ones already seen.
+
+    """
+    _breakers_lock.acquire()
+
+    try:
+        _settings["failures"] = failures
+        _settings["reset_time"] = reset_time
+
+        for breaker in _breakers.values():
+            breaker.failures = failures
+            breaker.reset_time = reset_time
+    finally:
+        _breakers_lock.release()
+
+def get_breaker(host):
+    """Return the breaker shared by everything requesting from host."""
+    _breakers_lock.acquire()
+
+    try:
+        breaker = _breakers.get(host)
+
+        if breaker is None:
+            breaker = CircuitBreaker(host, failures=_settings["failures"], \
+                reset_time=_settings["reset_time"])
+            _breakers[host] = breaker
+
+        return breaker
+    finally:
+        _breakers_lock.release()
+
+def get_breaker_for_url(url):
+    """Return the breaker for the host url points at."""
+    return get_breaker(urlparse.urlsplit(url)[1])
+
+def get_states():
+    """Return the state of every host's breaker, keyed on host."""
+    _breakers_lock.acquire()
+
+    try:
+        return dict((host, breaker.state) for host, breaker \
+            in _breakers.items())
+    finally:
+        _breakers_lock.release()
+
+
+class CircuitBreaker(object):
+    """Tracks whether a host is healthy.
+
+    The breaker starts closed, letting everything through. After failures
+    throttled outcomes in a row (5xx answers, timeouts, refused
+    connections) it opens, and check() raises CircuitOpenError. Once it
+    has been open for reset_time seconds it goes half-open and lets one
+    request through as a probe: if that succeeds the breaker closes, and
+    if not it opens for another reset_time.
+
+    Outcomes are ConcurrencyController's. Only THROTTLED counts against the
+    host; a 404 or other client error is the host answering just fine.
+
+    """
+    def __init__(self, host, failures=5, reset_time=60):
+        self.host = host
+        self.failures = failures
+        self.reset_time = reset_time
+        self.state = CLOSED
+        self.opens = 0
+        self._failed = 0
+        self._opened = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Return True if a request may go to the host now. When the
+        breaker is half-open, only the first caller is allowed, as the
+        probe.
+
+        """
+        self._lock.acquire()
+
+        try:
+            if self.state == CLOSED:
+                return True
+
+            if self.state == OPEN:
+                if time.time() - self._opened < self.reset_time:
+                    return False
+
+                log.info("Probing " + self.host + " to see if it's back")
+                self.state = HALF_OPEN
+                self._probing = False
+
+            if self._probing:
+                return False
+
+            self._probing = True
+            return True
+        finally:
+            self._lock.release()
+
+    def check(self):
+        """Raise CircuitOpenError unless a request may go to the host."""
+        if not self.allow():
+            raise CircuitOpenError("Circuit to " + self.host + \
+                " is open, not sending requests")
+
+    def is_open(self):
+        """Return True if the host is being given a rest, without using
+        up a half-open breaker's probe.
+
+        """
+        return self.state == OPEN
+
+    def record(self, outcome):
+        """Record how a request to the host went."""
+        self._lock.acquire()
+
+        try:
+            if outcome != ConcurrencyController.THROTTLED:
+                if self.state != CLOSED:
+                    log.info(self.host + " is answering again, closing circuit")
+
+                self.state = CLOSED
+                self._failed = 0
+                self._probing = False
+                return
+
+            self._failed += 1
+
+            if self.state == HALF_OPEN or \
+                    (self.state == CLOSED and self._failed >= self.failures):
+                log.warning("%s failed %d times in a row, opening circuit " \
+                    "for %d seconds" % (self.host, self._failed, self.reset_time))
+                self.state = OPEN
+                self.opens += 1
+                self._opened = time.time()
+                self._probing = False
+        finally:
+            self._lock.release()
+
+
+class CircuitBreakerTests(unittest.TestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker("eu.wowarmory.com", failures=3, \
+            reset_time=0.05)
+
+    def throttle(self, times=1):
+        for _ in xrange(times):
+            self.breaker.record(ConcurrencyController.THROTTLED)
+
+    def testOpens(self):
+        self.throttle(2)
+        self.assertTrue(self.breaker.allow())
+        self.throttle()
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertRaises(CircuitOpenError, self.breaker.check)
+
+    def testSuccessResets(self):
+        self.throttle(2)
+        self.breaker.record(ConcurrencyController.SUCCEEDED)
+        self.throttle(2)
+        self.assertEqual(self.breaker.state, CLOSED)
+
+    def testClientErrorsDontCount(self):
+        for _ in xrange(10):
+            self.breaker.record(ConcurrencyController.FAILED)
+
+        self.assertEqual(self.breaker.state, CLOSED)
+
+    def testProbe(self):
+        self.throttle(3)
+        time.sleep(0.06)
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+        self.assertFalse(self.breaker.allow())
+
+        self.breaker.record(ConcurrencyController.SUCCEEDED)
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertTrue(self.breaker.allow())
+
+    def testFailedProbe(self):
+        self.throttle(3)
+        time.sleep(0.06)
+        self.assertTrue(self.breaker.allow())
+        self.throttle()
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.opens, 2)
+
+    def testShared(self):
+        self.assertTrue(get_breaker_for_url("http://eu.wowarmory.com/team-info.xml") \
+            is get_breaker("eu.wowarmory.com"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+ConcurrencyController.py
+
+Additive increase, multiplicative decrease control of how many requests
+are in flight to each Armory host.
+
+Copyright (c) 2009, Regents of the University of California
+All rights reserved.
+"""
+
+import sys
+import os
+import unittest
+import threading
+import time
+import urlparse
+import Logger
+
+log = Logger.log()
+
+SUCCEEDED = "succeeded"
+THROTTLED = "throttled"
+FAILED = "failed"
+
+_settings = {"initial": 4, "minimum": 1, "maximum": 20}
+_controllers = {}
+_controllers_lock = threading.Lock()
+
+def configure(initial=4, minimum=1, maximum=20):
+    """Set the window limits for every host. Existing windows are
+    clamped to the new limits.
+
+    """
+    _controllers_lock.acquire()
+
+    try:
+        _settings["initial"] = initial
+        _settings["minimum"] = minimum
+        _settings["maximum"] = maximum
+
+        for controller in _controllers.values():
+            controller.set_limits(minimum, maximum)
+    finally:
+        _controllers_lock.release()
+
+def get_controller(host):
+    """Return the controller shared by everything requesting from host."""
+    _controllers_lock.acquire()
+
+    try:
+        controller = _controllers.get(host)
+
+        if controller is None:
+            controller = AIMDController(initial=_settings["initial"], \
+                minimum=_settings["minimum"], maximum=_settings["maximum"])
+            _controllers[host] = controller
+
+        return controller
+    finally:
+        _controllers_lock.release()
+
+def get_controller_for_url(url):
+    """Return the controller for the host url points at."""
+    return get_controller(urlparse.urlsplit(url)[1])
+
+def get_metrics():
+    """Return the metrics of every host's controller, keyed on host."""
+    _controllers_lock.acquire()
+
+    try:
+        return dict((host, controller.metrics()) for host, controller \
+            in _controllers.items())
+    finally:
+        _controllers_lock.release()
+
+
+class AIMDController(object):
+    """Limits the requests in flight to a host to a window that grows by
+    increase requests for every window's worth of healthy responses, and
+    is cut by decrease when the host throttles us (5xx responses and
+    timeouts).
+
+    The window is only cut once per round trip, so a burst of 503s from
+    requests that were already in flight counts as one signal rather than
+    collapsing the window to the minimum.
+
+    """
+    def __init__(self, initial=4, minimum=1, maximum=20, increase=1.0, \
+            decrease=0.5, smoothing=0.1):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.smoothing = smoothing
+        self.window = float(max(minimum, min(initial, maximum)))
+        self.in_flight = 0
+        self.latency = None
+        self.error_rate = 0.0
+        self.requests = 0
+        self.cuts = 0
+        self._last_cut = 0
+        self._condition = threading.Condition()
+
+    def set_limits(self, minimum, maximum):
+        self._condition.acquire()
+
+        try:
+            self.minimum = minimum
+            self.maximum = maximum
+            self.window = max(minimum, min(self.window, maximum))
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+
+    def acquire(self):
+        """Block until there's room in the window, then take a place
+        in it.
+
+        """
+        self._condition.acquire()
+
+        try:
+            while self.in_flight >= int(self.window):
+                self._condition.wait()
+
+            self.in_flight += 1
+        finally:
+            self._condition.release()
+
+    def try_acquire(self):
+        """Take a place in the window if there's room, without blocking.
+        Returns whether a place was taken.
+
+        """
+        self._condition.acquire()
+
+        try:
+            if self.in_flight >= int(self.window):
+                return False
+
+            self.in_flight += 1
+            return True
+        finally:
+            self._condition.release()
+
+    def release(self, outcome, latency=None):
+        """Give back a place in the window, adjusting the window for how
+        the request went.
+
+        """
+        self._condition.acquire()
+
+        try:
+            self.in_flight -= 1
+            self.requests += 1
+            now = time.time()
+
+            if latency is not None:
+                if self.latency is None:
+                    self.latency = latency
+                else:
+                    self.latency += self.smoothing * (latency - self.latency)
+
+            failed = 0.0
+            if outcome != SUCCEEDED: failed = 1.0
+            self.error_rate += self.smoothing * (failed - self.error_rate)
+
+            if outcome == SUCCEEDED:
+                self.window = min(self.maximum, \
+                    self.window + self.increase / self.window)
+            elif outcome == THROTTLED and now - self._last_cut > (self.latency or 0):
+                self.window = max(self.minimum, self.window * self.decrease)
+                self._last_cut = now
+                self.cuts += 1
+                log.warning("Throttled, concurrency window cut to %.1f" % self.window)
+
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+
+    def metrics(self):
+        """Return the current state of the controller."""
+        self._condition.acquire()
+
+        try:
+            return {"window": self.window, "in_flight": self.in_flight, \
+                "latency": self.latency, "error_rate": self.error_rate, \
+                "requests": self.requests, "cuts": self.cuts}
+        finally:
+            self._condition.release()
+
+
+class ConcurrencyControllerTests(unittest.TestCase):
+    def testAdditiveIncrease(self):
+        controller = AIMDController(initial=2, maximum=10)
+
+        for _ in xrange(2):
+            controller.acquire()
+        for _ in xrange(2):
+            controller.release(SUCCEEDED, 0.1)
+
+        self.assertEqual(controller.window, 2.0 + 0.5 + 1.0 / 2.5)
+
+    def testMultiplicativeDecrease(self):
+        controller = AIMDController(initial=8, maximum=10)
+        controller.acquire()
+        controller.release(THROTTLED, 0.1)
+        self.assertEqual(controller.window, 4.0)
+
+    def testOneCutPerRoundTrip(self):
+        controller = AIMDController(initial=8, maximum=10)
+
+        for _ in xrange(4):
+            controller.acquire()
+        for _ in xrange(4):
+            controller.release(THROTTLED, 10)
+
+        self.assertEqual(controller.window, 4.0)
+        self.assertEqual(controller.cuts, 1)
+
+    def testLimits(self):
+        controller = AIMDController(initial=1, minimum=1, maximum=1)
+        controller.acquire()
+        controller.release(SUCCEEDED)
+        self.assertEqual(controller.window, 1)
+        controller.acquire()
+        controller.release(THROTTLED)
+        self.assertEqual(controller.window, 1)
+
+    def testWindowBlocks(self):
+        controller = AIMDController(initial=1)
+        controller.acquire()
+        self.assertFalse(controller.try_acquire())
+
+        threading.Timer(0.05, controller.release, args=(SUCCEEDED,)).start()
+        controller.acquire()
+        self.assertEqual(controller.in_flight, 1)
+
+    def testMetrics(self):
+        get_controller("eu.wowarmory.com")
+        self.assertTrue("window" in get_metrics()["eu.wowarmory.com"])
+
+
+if __name__ == '__main__':
+    unittest.main()
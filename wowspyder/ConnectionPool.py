@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+ConnectionPool.py
+
+Persistent HTTP/1.1 connections to the Armory, shared by every downloader
+in the process.
+
+Copyright (c) 2009, Regents of the University of California
+All rights reserved.
+"""
+
+import sys
+import os
+import unittest
+import httplib
+import socket
+import threading
+import time
+import urllib2
+import StringIO
+import BaseHTTPServer
+import SocketServer
+import Logger
+
+log = Logger.log()
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(host, size=4, idle_timeout=30):
+    """Return the connection pool for host, creating it if needed. All
+    downloaders share the same pool for a host, so asking for a bigger
+    pool than the one that exists grows it.
+
+    """
+    _pools_lock.acquire()
+    try:
+        pool = _pools.get(host)
+
+        if pool is None:
+            log.debug("Creating connection pool for " + host)
+            pool = HTTPConnectionPool(host, size=size, idle_timeout=idle_timeout)
+            _pools[host] = pool
+        elif size > pool.size:
+            pool.grow(size)
+
+        return pool
+    finally:
+        _pools_lock.release()
+
+def close_pools():
+    """Close every idle connection in every pool."""
+    _pools_lock.acquire()
+    try:
+        for pool in _pools.values():
+            pool.close()
+    finally:
+        _pools_lock.release()
+
+
+class HTTPConnectionPool(object):
+    """A bounded pool of keep-alive connections to a single host.
+
+    At most size connections are handed out at once; anyone else asking
+    blocks until one is returned. Connections that have sat idle for longer
+    than idle_timeout seconds are closed rather than reused, as the Armory
+    will have dropped them by then anyway.
+
+    """
+    def __init__(self, host, size=4, idle_timeout=30):
+        self.host = host
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.created = 0
+        self.reused = 0
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(size)
+
+    def grow(self, size):
+        """Allow up to size connections to be out at once."""
+        self._lock.acquire()
+        try:
+            for _ in xrange(size - self.size):
+                self._slots.release()
+            self.size = max(size, self.size)
+        finally:
+            self._lock.release()
+
+    def get_connection(self):
+        """Borrow a connection. Returns the connection and whether it
+        has been used before, because a reused connection may have been
+        closed by the server underneath us.
+
+        """
+        self._slots.acquire()
+        self._lock.acquire()
+
+        try:
+            now = time.time()
+
+            while self._idle:
+                connection, last_used = self._idle.pop()
+
+                if now - last_used < self.idle_timeout:
+                    self.reused += 1
+                    return connection, True
+
+                log.debug("Closing idle connection to " + self.host)
+                connection.close()
+
+            self.created += 1
+        finally:
+            self._lock.release()
+
+        return httplib.HTTPConnection(self.host), False
+
+    def put_connection(self, connection, reusable=True):
+        """Return a borrowed connection to the pool. Connections that
+        can't be reused are closed.
+
+        """
+        self._lock.acquire()
+
+        try:
+            if reusable:
+                self._idle.append((connection, time.time()))
+            else:
+                connection.close()
+        finally:
+            self._lock.release()
+
+        self._slots.release()
+
+    def close(self):
+        """Close all the idle connections."""
+        self._lock.acquire()
+
+        try:
+            for connection, last_used in self._idle:
+                connection.close()
+            self._idle = []
+        finally:
+            self._lock.release()
+
+
+class KeepAliveHandler(urllib2.HTTPHandler):
+    """A urllib2 handler that sends requests over pooled connections
+    instead of opening (and closing) a new one for every request.
+
+    """
+    def __init__(self, pool_size=4, idle_timeout=30, debuglevel=0):
+        urllib2.HTTPHandler.__init__(self, debuglevel)
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+
+    def http_open(self, req):
+        host = req.get_host()
+
+        if not host:
+            raise urllib2.URLError("no host given")
+
+        pool = get_pool(host, size=self.pool_size, idle_timeout=self.idle_timeout)
+        timeout = getattr(req, "timeout", socket._GLOBAL_DEFAULT_TIMEOUT)
+        if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+            timeout = socket.getdefaulttimeout()
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items() \
+            if k not in headers))
+        headers = dict((name.title(), val) for name, val in headers.items())
+
+        retry = True
+
+        while True:
+            connection, reused = pool.get_connection()
+            # Pooled connections outlive requests, so each request sets
+            # its own timeout on the socket.
+            connection.timeout = timeout
+            if connection.sock is not None:
+                connection.sock.settimeout(timeout)
+
+            try:
+                connection.request(req.get_method(), req.get_selector(), \
+                    req.data, headers)
+                response = connection.getresponse()
+                # The body has to be read off the socket before anyone
+                # else can use the connection.
+                body = response.read()
+            except (httplib.HTTPException, socket.error), e:
+                pool.put_connection(connection, reusable=False)
+
+                # The server is allowed to drop an idle keep-alive
+                # connection at any time, so try once more on a fresh one.
+                if reused and retry:
+                    log.debug("Pooled connection to " + host + " went away, retrying")
+                    retry = False
+                    continue
+
+                raise urllib2.URLError(e)
+
+            pool.put_connection(connection, reusable=not response.will_close)
+            break
+
+        resp = urllib2.addinfourl(StringIO.StringIO(body), response.msg, \
+            req.get_full_url())
+        resp.code = response.status
+        resp.msg = response.reason
+
+        return resp
+
+
+class _KeepAliveTestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    wbufsize = -1
+
+    def do_GET(self):
+        body = "<?xml version=\"1.0\"?><page/>"
+        if self.path.startswith("/slow"): time.sleep(0.5)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _ThreadedTestServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class ConnectionPoolTests(unittest.TestCase):
+    def setUp(self):
+        self.server = _ThreadedTestServer(("127.0.0.1", 0), _KeepAliveTestHandler)
+        self.host = "127.0.0.1:%d" % self.server.server_address[1]
+        self.url = "http://" + self.host + "/test.xml"
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        self.opener = urllib2.build_opener(KeepAliveHandler(pool_size=2))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def testConnectionReused(self):
+        for _ in xrange(5):
+            self.assertTrue(self.opener.open(self.url).read())
+
+        pool = get_pool(self.host)
+        self.assertEqual(pool.created, 1)
+        self.assertEqual(pool.reused, 4)
+
+    def testTimeout(self):
+        self.assertTrue(self.opener.open(self.url, timeout=0.2).read())
+        self.assertRaises(urllib2.URLError, self.opener.open, \
+            "http://" + self.host + "/slow.xml", timeout=0.1)
+
+    def testIdleTimeout(self):
+        pool = HTTPConnectionPool(self.host, size=1, idle_timeout=0)
+        connection, reused = pool.get_connection()
+        pool.put_connection(connection)
+        connection, reused = pool.get_connection()
+        self.assertFalse(reused)
+        self.assertEqual(pool.created, 2)
+
+    def testGrow(self):
+        pool = HTTPConnectionPool(self.host, size=1)
+        pool.grow(3)
+        connections = [pool.get_connection()[0] for _ in xrange(3)]
+        self.assertEqual(pool.created, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
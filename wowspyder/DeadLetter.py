@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+DeadLetter.py
+
+Keeps the work the parsers had to skip because a download failed, so a
+retry pass can redo it when the Armory is quiet instead of it waiting for
+the next time the whole realm is crawled.
+
+Copyright (c) 2009, Regents of the University of California
+All rights reserved.
+"""
+
+import sys
+import os
+import unittest
+import datetime
+import threading
+import json
+import Database
+import ConcurrencyController
+import WoWSpyderLib
+import Logger
+from sqlalchemy import Table, Column, DateTime, Unicode, UnicodeText, Integer
+
+log = Logger.log()
+
+Base = Database.get_base()
+
+# How long to wait before retrying something the first time, and the
+# longest wait however many times it has failed.
+RETRY_DELAY = 15 * 60
+MAX_RETRY_DELAY = 12 * 60 * 60
+
+# Attempts after which something is left in the table, but not retried.
+MAX_ATTEMPTS = 6
+
+# The priority class retries are downloaded in, behind everything else.
+RETRY_PRIORITY = 10
+
+# Parser classes that redo each kind of work, keyed on kind.
+_handlers = {}
+
+def register(kind, parser_class):
+    """Have parser_class redo failed work of kind. The retry pass makes
+    one of them and calls its redo() with the arguments recorded.
+
+    """
+    _handlers[kind] = parser_class
+
+def make_key(args):
+    """Return the key for the arguments of a piece of work."""
+    return u"/".join([unicode(arg) for arg in args])
+
+def record(kind, args, error, url=None):
+    """Record that the work of kind with arguments args (a list that can
+    be saved as JSON) failed with error, scheduling it to be retried.
+
+    """
+    now = datetime.datetime.now()
+    key = make_key(args)
+    letter = Database.session().query(DeadLetter).get((kind, key))
+
+    if letter is None:
+        letter = DeadLetter(kind, key, args)
+
+    letter.url = url
+    letter.reason = unicode(str(error), "utf-8", "replace")[:500]
+    letter.attempts = (letter.attempts or 0) + 1
+    letter.last_failed = now
+    letter.next_retry = None
+
+    if letter.attempts < MAX_ATTEMPTS:
+        delay = min(MAX_RETRY_DELAY, RETRY_DELAY * 2 ** (letter.attempts - 1))
+        letter.next_retry = now + datetime.timedelta(seconds=delay)
+        log.info("Will retry %s %s at %s" % (kind, key.encode("utf-8"), \
+            letter.next_retry))
+    else:
+        log.warning("Giving up on %s %s after %d attempts" % (kind, \
+            key.encode("utf-8"), letter.attempts))
+
+    Database.insert(letter)
+
+def resolve(kind, args):
+    """Forget failed work that has since been done."""
+    session = Database.session()
+    session.query(DeadLetter).filter(DeadLetter.kind == kind) \
+        .filter(DeadLetter.entity_key == make_key(args)).delete()
+    session.commit()
+
+def get_due(limit=20):
+    """Return up to limit pieces of failed work that are due a retry,
+    those that have waited longest first.
+
+    """
+    return Database.session().query(DeadLetter) \
+        .filter(DeadLetter.next_retry <= datetime.datetime.now()) \
+        .order_by(DeadLetter.next_retry).limit(limit).all()
+
+def is_quiet(in_flight=2):
+    """Return True if fewer than in_flight requests are out to the
+    Armory, across every host.
+
+    """
+    metrics = ConcurrencyController.get_metrics()
+    return sum([host["in_flight"] for host in metrics.values()]) < in_flight
+
+
+class DeadLetter(Base):
+    """Work that failed and is waiting to be retried."""
+    __table__ = Table("DEAD_LETTER", Base.metadata,
+        Column("kind", Unicode(20), primary_key=True),
+        Column("entity_key", Unicode(300), primary_key=True),
+        Column("args", UnicodeText()),
+        Column("url", Unicode(500)),
+        Column("reason", Unicode(500)),
+        Column("attempts", Integer()),
+        Column("first_failed", DateTime(), default=datetime.datetime.now),
+        Column("last_failed", DateTime()),
+        Column("next_retry", DateTime(), index=True),
+        mysql_charset="utf8",
+        mysql_engine="InnoDB"
+    )
+
+    def __init__(self, kind, entity_key, args):
+        self.kind = kind
+        self.entity_key = entity_key
+        self.args = unicode(json.dumps(args))
+        self.attempts = 0
+
+    def get_args(self):
+        return json.loads(self.args)
+
+    def __repr__(self):
+        return unicode("<DeadLetter('%s','%s','%d')>" % (self.kind, \
+            self.entity_key, self.attempts))
+
+
+class Retrier(threading.Thread):
+    """Every interval seconds, if the Armory is quiet, redoes up to batch
+    pieces of failed work that are due, downloading in RETRY_PRIORITY so
+    the crawl's own requests go first. Work that fails again is put back
+    with a longer wait.
+
+    """
+    def __init__(self, interval=60, batch=20, in_flight=2):
+        threading.Thread.__init__(self, name="DeadLetterRetrier")
+        self.setDaemon(True)
+        self.interval = interval
+        self.batch = batch
+        self.in_flight = in_flight
+        self.retried = 0
+        self.recovered = 0
+        self._parsers = {}
+        self._stopped = threading.Event()
+
+    def run(self):
+        WoWSpyderLib.set_thread_priority(RETRY_PRIORITY)
+
+        while True:
+            self._stopped.wait(self.interval)
+            if self._stopped.isSet(): break
+
+            if not is_quiet(self.in_flight):
+                log.debug("Armory is busy, not retrying failed work yet")
+                continue
+
+            try:
+                self.retry(get_due(self.batch))
+            except Exception, e:
+                log.warning("Retry pass failed. ERROR: " + str(e))
+
+            Database.session().expunge_all()
+
+    def retry(self, letters):
+        """Redo each of letters, returning how many were done."""
+        done = 0
+
+        for letter in letters:
+            kind = letter.kind
+            args = letter.get_args()
+            attempts = letter.attempts
+            parser = self._get_parser(kind)
+
+            if parser is None:
+                log.warning("Don't know how to retry " + kind)
+                continue
+
+            self.retried += 1
+
+            try:
+                parser.redo(*args)
+            except Exception, e:
+                log.warning("Retrying %s %s failed again. ERROR: %s" % \
+                    (kind, letter.entity_key.encode("utf-8"), str(e)))
+                record(kind, args, e, letter.url)
+            else:
+                log.info("Retried %s %s" % (kind, \
+                    letter.entity_key.encode("utf-8")))
+                done += 1
+
+                # Part of the work may have failed and been recorded again
+                if letter.attempts == attempts:
+                    resolve(kind, args)
+
+        self.recovered += done
+        return done
+
+    def _get_parser(self, kind):
+        if kind not in self._parsers and kind in _handlers:
+            self._parsers[kind] = _handlers[kind]()
+
+        return self._parsers.get(kind)
+
+    def stop(self):
+        self._stopped.set()
+
+def start_retrying(interval=60, batch=20):
+    """Start retrying failed work in the background. Returns the Retrier,
+    which can be stopped.
+
+    """
+    retrier = Retrier(interval=interval, batch=batch)
+    retrier.start()
+    return retrier
+
+
+class _Redoer(object):
+    def __init__(self):
+        self.done = []
+
+    def redo(self, name, realm, site):
+        if name == u"Nobody":
+            raise IOError("Armory is down")
+
+        self.done.append(name)
+
+
+class DeadLetterTests(unittest.TestCase):
+    def setUp(self):
+        Base.metadata.create_all(Database.engine)
+        register(u"test", _Redoer)
+        self.moulin = [u"Moulin", u"Ravenholdt", u"us"]
+        self.nobody = [u"Nobody", u"Ravenholdt", u"us"]
+
+    def tearDown(self):
+        resolve(u"test", self.moulin)
+        resolve(u"test", self.nobody)
+        del _handlers[u"test"]
+
+    def due(self):
+        # Make everything due straight away
+        for letter in Database.session().query(DeadLetter) \
+                .filter(DeadLetter.kind == u"test").all():
+            letter.next_retry = datetime.datetime.now()
+            Database.insert(letter)
+
+        return [l for l in get_due(100) if l.kind == u"test"]
+
+    def testRecord(self):
+        record(u"test", self.moulin, IOError("Armory is down"))
+        letter = Database.session().query(DeadLetter).get((u"test", \
+            make_key(self.moulin)))
+        self.assertEqual(letter.attempts, 1)
+        self.assertEqual(letter.get_args(), self.moulin)
+        self.assertTrue(letter.next_retry > datetime.datetime.now())
+
+    def testRetry(self):
+        record(u"test", self.moulin, IOError("Armory is down"))
+        record(u"test", self.nobody, IOError("Armory is down"))
+        retrier = Retrier()
+
+        self.assertEqual(retrier.retry(self.due()), 1)
+        self.assertEqual(retrier._parsers[u"test"].done, [u"Moulin"])
+
+        remaining = Database.session().query(DeadLetter) \
+            .filter(DeadLetter.kind == u"test").all()
+        self.assertEqual([l.entity_key for l in remaining], \
+            [make_key(self.nobody)])
+        self.assertEqual(remaining[0].attempts, 2)
+
+    def testGivesUp(self):
+        for _ in xrange(MAX_ATTEMPTS):
+            record(u"test", self.nobody, IOError("Armory is down"))
+
+        letter = Database.session().query(DeadLetter).get((u"test", \
+            make_key(self.nobody)))
+        self.assertEqual(letter.next_retry, None)
+
+
+if __name__ == '__main__':
+    unittest.main()
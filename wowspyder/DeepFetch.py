@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+DeepFetch.py
+
+The queue of characters a stub crawl made from guild and team rosters
+that need their character sheets downloaded as well, because they're new,
+have levelled or haven't been fully fetched in a while.
+
+Copyright (c) 2009, Regents of the University of California
+All rights reserved.
+"""
+
+import sys
+import os
+import unittest
+import datetime
+import Database
+import Logger
+from sqlalchemy import Table, Column, DateTime, Unicode
+
+log = Logger.log()
+
+Base = Database.get_base()
+
+# The character has never had its sheet downloaded.
+NEW = u"new"
+# The roster lists the character at a different level than we have.
+LEVEL = u"level"
+# The character's sheet hasn't been downloaded for too long.
+STALE = u"stale"
+
+# How long, in seconds, a character can be claimed by a client before
+# another can take it, in case the first went away.
+LOCK_TIMEOUT = 60 * 60
+
+def enqueue_many(entries):
+    """Queue each (name, realm, site, reason) in entries for a deep fetch,
+    in one go. Characters already queued keep their place.
+
+    """
+    if not entries:
+        return 0
+
+    session = Database.session()
+
+    for name, realm, site, reason in entries:
+        fetch = session.query(DeepFetch).get((name, realm, site))
+
+        if fetch is None:
+            session.add(DeepFetch(name, realm, site, reason))
+        else:
+            fetch.reason = reason
+
+    try:
+        session.commit()
+    except Exception, e:
+        log.warning("Couldn't queue deep fetches. ERROR: " + str(e))
+        session.rollback()
+        return 0
+
+    log.info("Queued %d characters for a deep fetch" % len(entries))
+    return len(entries)
+
+def enqueue(name, realm, site, reason):
+    """Queue one character for a deep fetch."""
+    return enqueue_many([(name, realm, site, reason)])
+
+def get_next(realm, site, lock_id):
+    """Claim and return the character of realm queued longest, that isn't
+    claimed by another client, or None if there's nothing to do. A
+    character claimed by lock_id already is handed back first, so a client
+    that restarts picks up where it was.
+
+    """
+    session = Database.session()
+    queue = session.query(DeepFetch).filter(DeepFetch.realm == realm) \
+        .filter(DeepFetch.site == site)
+    fetch = queue.filter(DeepFetch.lock_id == lock_id).first()
+
+    if fetch is None:
+        expired = datetime.datetime.now() - \
+            datetime.timedelta(seconds=LOCK_TIMEOUT)
+        fetch = queue.filter((DeepFetch.lock_id == None) | \
+            (DeepFetch.lock_time < expired)).order_by(DeepFetch.queued).first()
+
+        if fetch is None:
+            return None
+
+        fetch.lock_id = lock_id
+        fetch.lock_time = datetime.datetime.now()
+        Database.insert(fetch)
+
+    return fetch
+
+def finish(name, realm, site):
+    """Take a character off the queue, as its deep fetch is done."""
+    session = Database.session()
+    session.query(DeepFetch).filter(DeepFetch.name == name) \
+        .filter(DeepFetch.realm == realm).filter(DeepFetch.site == site) \
+        .delete()
+    session.commit()
+
+def count(realm=None, site=None):
+    """Return how many characters are queued, in realm if given."""
+    query = Database.session().query(DeepFetch)
+
+    if realm is not None:
+        query = query.filter(DeepFetch.realm == realm)
+    if site is not None:
+        query = query.filter(DeepFetch.site == site)
+
+    return query.count()
+
+
+class DeepFetch(Base):
+    """A character waiting for its sheet to be downloaded."""
+    __table__ = Table("DEEP_FETCH", Base.metadata,
+        Column("name", Unicode(100), primary_key=True),
+        Column("realm", Unicode(100), primary_key=True),
+        Column("site", Unicode(2), primary_key=True),
+        Column("reason", Unicode(20)),
+        Column("queued", DateTime(), default=datetime.datetime.now, index=True),
+        Column("lock_id", Unicode(100)),
+        Column("lock_time", DateTime()),
+        mysql_charset="utf8",
+        mysql_engine="InnoDB"
+    )
+
+    def __init__(self, name, realm, site, reason):
+        self.name = name
+        self.realm = realm
+        self.site = site
+        self.reason = reason
+
+    def __repr__(self):
+        return unicode("<DeepFetch('%s','%s','%s','%s')>" % (self.name, \
+            self.realm, self.site, self.reason))
+
+
+class DeepFetchTests(unittest.TestCase):
+    def setUp(self):
+        Base.metadata.create_all(Database.engine)
+        self.realm = u"Stub Test Realm"
+
+    def tearDown(self):
+        for name in (u"Moulin", u"Shirley"):
+            finish(name, self.realm, u"us")
+
+    def testQueue(self):
+        enqueue(u"Moulin", self.realm, u"us", NEW)
+        enqueue(u"Shirley", self.realm, u"us", LEVEL)
+        self.assertEqual(count(self.realm, u"us"), 2)
+
+        first = get_next(self.realm, u"us", u"first").name
+        # Claimed, so another client gets the other one
+        second = get_next(self.realm, u"us", u"second").name
+        self.assertEqual(set([first, second]), set([u"Moulin", u"Shirley"]))
+        self.assertEqual(get_next(self.realm, u"us", u"first").name, first)
+        self.assertEqual(get_next(self.realm, u"us", u"third"), None)
+
+        finish(first, self.realm, u"us")
+        self.assertEqual(count(self.realm, u"us"), 1)
+
+    def testRequeueKeepsPlace(self):
+        enqueue(u"Moulin", self.realm, u"us", NEW)
+        enqueue(u"Moulin", self.realm, u"us", STALE)
+        self.assertEqual(count(self.realm, u"us"), 1)
+        self.assertEqual(get_next(self.realm, u"us", u"first").reason, STALE)
+
+
+if __name__ == '__main__':
+    unittest.main()
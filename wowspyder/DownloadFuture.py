@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+DownloadFuture.py
+
+Futures for downloads that have been asked for but may not have finished,
+so a caller can ask for many pages at once and use them as they arrive.
+
+Copyright (c) 2009, Regents of the University of California
+All rights reserved.
+"""
+
+import sys
+import os
+import unittest
+import threading
+import time
+import Queue
+import Logger
+
+log = Logger.log()
+
+class TimeoutError(Exception):
+    """Raised when a future isn't done in the time allowed."""
+    pass
+
+
+class Future(object):
+    """The result of a download that may still be going. result() waits
+    for it, returning the page or raising whatever the download raised.
+
+    Futures are shared: everyone who asked for a URL while it was in
+    flight gets the same one.
+
+    """
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._error = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done.isSet()
+
+    def result(self, timeout=None):
+        """Return the result, waiting up to timeout seconds (forever if
+        None) for it. Raises the download's exception if it failed.
+
+        """
+        self._wait(timeout)
+
+        if self._error is not None:
+            raise self._error
+
+        return self._result
+
+    def exception(self, timeout=None):
+        """Return the exception the download raised, or None."""
+        self._wait(timeout)
+        return self._error
+
+    def _wait(self, timeout):
+        self._done.wait(timeout)
+
+        if not self._done.isSet():
+            raise TimeoutError("Download didn't finish within %s seconds" % \
+                timeout)
+
+    def add_done_callback(self, callback):
+        """Call callback with the future once it's done, straight away if
+        it already is. Callbacks run in whichever thread finishes the
+        future, so they should be quick.
+
+        """
+        self._lock.acquire()
+
+        try:
+            if not self._done.isSet():
+                self._callbacks.append(callback)
+                return
+        finally:
+            self._lock.release()
+
+        self._call(callback)
+
+    def set_result(self, result):
+        self._finish(result, None)
+
+    def set_exception(self, error):
+        self._finish(None, error)
+
+    def _finish(self, result, error):
+        self._lock.acquire()
+
+        try:
+            if self._done.isSet():
+                return
+
+            self._result = result
+            self._error = error
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        finally:
+            self._lock.release()
+
+        for callback in callbacks:
+            self._call(callback)
+
+    def _call(self, callback):
+        try:
+            callback(self)
+        except Exception, e:
+            log.warning("Future callback failed. ERROR: " + str(e))
+
+
+def completed(result):
+    """Return a future that is already done with result."""
+    future = Future()
+    future.set_result(result)
+    return future
+
+def as_completed(futures, timeout=None):
+    """Yield futures as they finish, whatever order they were made in.
+    Raises TimeoutError if they aren't all done within timeout seconds.
+
+    """
+    finished = Queue.Queue()
+    futures = list(futures)
+
+    for future in futures:
+        future.add_done_callback(finished.put)
+
+    if timeout is not None:
+        end = time.time() + timeout
+
+    for _ in futures:
+        if timeout is None:
+            yield finished.get()
+            continue
+
+        try:
+            yield finished.get(True, max(end - time.time(), 0))
+        except Queue.Empty:
+            raise TimeoutError("Downloads didn't finish within %s seconds" % \
+                timeout)
+
+
+class DownloadFutureTests(unittest.TestCase):
+    def later(self, delay, future, result=None, error=None):
+        if error is None:
+            finish = lambda: future.set_result(result)
+        else:
+            finish = lambda: future.set_exception(error)
+
+        threading.Timer(delay, finish).start()
+        return future
+
+    def testResult(self):
+        future = self.later(0.05, Future(), "page")
+        self.assertFalse(future.done())
+        self.assertEqual(future.result(), "page")
+        self.assertTrue(future.done())
+
+    def testException(self):
+        future = self.later(0.01, Future(), error=IOError("Armory is down"))
+        self.assertRaises(IOError, future.result)
+        self.assertTrue(isinstance(future.exception(), IOError))
+
+    def testTimeout(self):
+        self.assertRaises(TimeoutError, Future().result, 0.01)
+
+    def testCallbacks(self):
+        called = []
+        future = Future()
+        future.add_done_callback(called.append)
+        future.set_result("page")
+        future.add_done_callback(called.append)
+        self.assertEqual(called, [future, future])
+
+    def testAsCompleted(self):
+        slow = self.later(0.1, Future(), "slow")
+        fast = self.later(0.01, Future(), "fast")
+        done = completed("done")
+        self.assertEqual([f.result() for f in as_completed([slow, fast, done])], \
+            ["done", "fast", "slow"])
+
+    def testAsCompletedTimeout(self):
+        futures = as_completed([completed("done"), Future()], timeout=0.01)
+        futures.next()
+        self.assertRaises(TimeoutError, futures.next)
+
+
+if __name__ == '__main__':
+    unittest.main()
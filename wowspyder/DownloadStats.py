@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+DownloadStats.py
+
+Counts what the download engines do with each type of Armory page: how
+long requests take, how much comes back, how often the cache answers and
+how long is spent backing off or waiting on the rate limit.
+
+Copyright (c) 2009, Regents of the University of California
+All rights reserved.
+"""
+
+import sys
+import os
+import unittest
+import threading
+import collections
+import time
+import WoWSpyderLib
+import Logger
+
+log = Logger.log()
+
+# How many of the latest latencies are kept for each type of page, which
+# is what the percentiles are taken over.
+DEFAULT_SAMPLES = 1000
+
+class DownloadStats(object):
+    """Download statistics, kept separately for each type of page (see
+    WoWSpyderLib.get_url_type). Safe to record into from any thread.
+
+    A fetch is a request that went out to the Armory, whatever came back;
+    a retry is a fetch that had to be made again, along with however long
+    was slept before making it. Pages the cache answered without asking
+    the Armory are cache hits, and never count as fetches.
+
+    """
+    def __init__(self, samples=DEFAULT_SAMPLES):
+        self.samples = samples
+        self._types = {}
+        self._started = time.time()
+        self._lock = threading.Lock()
+
+    def _get(self, url):
+        """Return the stats for url's type. Call with the lock held."""
+        url_type = WoWSpyderLib.get_url_type(url)
+        stats = self._types.get(url_type)
+
+        if stats is None:
+            stats = _TypeStats(self.samples)
+            self._types[url_type] = stats
+
+        return stats
+
+    def record_fetch(self, url, latency, status, compressed_bytes=0, \
+            decompressed_bytes=0):
+        """Record a request to the Armory that took latency seconds and
+        got status back, which is None if there was no response at all.
+
+        """
+        self._lock.acquire()
+
+        try:
+            stats = self._get(url)
+            stats.fetches += 1
+            stats.latencies.append(latency)
+            stats.latency_total += latency
+            stats.compressed_bytes += compressed_bytes
+            stats.decompressed_bytes += decompressed_bytes
+
+            if status == 304:
+                stats.not_modified += 1
+            elif status != 200:
+                stats.errors += 1
+        finally:
+            self._lock.release()
+
+    def record_cache(self, url, hit):
+        """Record whether the cache could answer for url."""
+        self._lock.acquire()
+
+        try:
+            stats = self._get(url)
+
+            if hit:
+                stats.cache_hits += 1
+            else:
+                stats.cache_misses += 1
+        finally:
+            self._lock.release()
+
+    def record_retry(self, url, backoff_time=0):
+        """Record that url is being fetched again after backing off for
+        backoff_time seconds.
+
+        """
+        self._lock.acquire()
+
+        try:
+            stats = self._get(url)
+            stats.retries += 1
+            stats.backoff_time += backoff_time
+        finally:
+            self._lock.release()
+
+    def record_throttle(self, url, wait):
+        """Record that the rate limiter held url back for wait seconds."""
+        if wait <= 0:
+            return
+
+        self._lock.acquire()
+
+        try:
+            stats = self._get(url)
+            stats.throttles += 1
+            stats.throttle_time += wait
+        finally:
+            self._lock.release()
+
+    def summary(self):
+        """Return a dictionary of the stats for each type of page, each
+        itself a dictionary. Latencies are in seconds, and are None for
+        types that haven't been fetched.
+
+        """
+        self._lock.acquire()
+
+        try:
+            return self._summary()
+        finally:
+            self._lock.release()
+
+    def _summary(self):
+        summary = {}
+
+        for url_type, stats in self._types.items():
+            latencies = sorted(stats.latencies)
+            lookups = stats.cache_hits + stats.cache_misses
+            hit_ratio = None
+            mean = None
+
+            if lookups: hit_ratio = stats.cache_hits / float(lookups)
+            if stats.fetches: mean = stats.latency_total / stats.fetches
+
+            summary[url_type] = {
+                "fetches": stats.fetches,
+                "errors": stats.errors,
+                "not_modified": stats.not_modified,
+                "latency_mean": mean,
+                "latency_p50": percentile(latencies, 0.5),
+                "latency_p90": percentile(latencies, 0.9),
+                "latency_p99": percentile(latencies, 0.99),
+                "latency_max": percentile(latencies, 1.0),
+                "latency_total": stats.latency_total,
+                "compressed_bytes": stats.compressed_bytes,
+                "decompressed_bytes": stats.decompressed_bytes,
+                "retries": stats.retries,
+                "backoff_time": stats.backoff_time,
+                "cache_hits": stats.cache_hits,
+                "cache_misses": stats.cache_misses,
+                "cache_hit_ratio": hit_ratio,
+                "throttles": stats.throttles,
+                "throttle_time": stats.throttle_time,
+            }
+
+        return summary
+
+    def reset(self):
+        """Return the summary and start counting again."""
+        self._lock.acquire()
+
+        try:
+            summary = self._summary()
+            self._types = {}
+            self._started = time.time()
+            return summary
+        finally:
+            self._lock.release()
+
+    def elapsed(self):
+        """Return how many seconds the stats have been counting for."""
+        return time.time() - self._started
+
+
+class _TypeStats(object):
+    def __init__(self, samples):
+        self.fetches = 0
+        self.errors = 0
+        self.not_modified = 0
+        self.latencies = collections.deque(maxlen=samples)
+        self.latency_total = 0.0
+        self.compressed_bytes = 0
+        self.decompressed_bytes = 0
+        self.retries = 0
+        self.backoff_time = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.throttles = 0
+        self.throttle_time = 0.0
+
+
+def percentile(values, fraction):
+    """Return the value fraction of the way through sorted values, or
+    None if there aren't any.
+
+    """
+    if not values:
+        return None
+
+    index = int(round(fraction * (len(values) - 1)))
+    return values[index]
+
+def format_summary(summary):
+    """Return a summary as a table, one line per type of page, with the
+    types that took the most time first.
+
+    """
+    lines = ["%-23s %7s %5s %5s %7s %7s %7s %9s %9s %6s %8s %8s" % \
+        ("type", "fetches", "errs", "304s", "p50 ms", "p90 ms", "p99 ms", \
+        "KB gz", "KB xml", "hits", "retries", "wait s")]
+
+    def ms(seconds):
+        if seconds is None: return "-"
+        return "%.0f" % (seconds * 1000)
+
+    def hits(ratio):
+        if ratio is None: return "-"
+        return "%.0f%%" % (ratio * 100)
+
+    ordered = sorted(summary.items(), key=lambda item: \
+        -(item[1]["latency_total"] + item[1]["backoff_time"] + \
+        item[1]["throttle_time"]))
+
+    for url_type, stats in ordered:
+        lines.append("%-23s %7d %5d %5d %7s %7s %7s %9.1f %9.1f %6s %8d %8.1f" % \
+            (url_type, stats["fetches"], stats["errors"], \
+            stats["not_modified"], ms(stats["latency_p50"]), \
+            ms(stats["latency_p90"]), ms(stats["latency_p99"]), \
+            stats["compressed_bytes"] / 1024.0, \
+            stats["decompressed_bytes"] / 1024.0, \
+            hits(stats["cache_hit_ratio"]), stats["retries"], \
+            stats["backoff_time"] + stats["throttle_time"]))
+
+    return "\n".join(lines)
+
+
+# Every downloader in the process records into the same stats.
+_stats = DownloadStats()
+
+def get_stats():
+    """Return the stats shared by the download engines."""
+    return _stats
+
+
+class Reporter(threading.Thread):
+    """Logs a summary of the shared stats every interval seconds, until
+    stopped.
+
+    """
+    def __init__(self, interval, stats=None):
+        threading.Thread.__init__(self, name="DownloadStatsReporter")
+        self.setDaemon(True)
+        self.interval = interval
+        self.stats = stats or get_stats()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while True:
+            self._stopped.wait(self.interval)
+            if self._stopped.isSet(): break
+
+            log.info("Downloads over the last %.0f seconds:\n%s" % \
+                (self.stats.elapsed(), format_summary(self.stats.summary())))
+
+    def stop(self):
+        self._stopped.set()
+
+def start_reporting(interval):
+    """Start logging a summary of the shared stats every interval
+    seconds. Returns the Reporter, which can be stopped.
+
+    """
+    reporter = Reporter(interval)
+    reporter.start()
+    return reporter
+
+
+class DownloadStatsTests(unittest.TestCase):
+    def setUp(self):
+        self.stats = DownloadStats(samples=100)
+        self.sheet = "http://www.wowarmory.com/character-sheet.xml?r=Ravenholdt&n=Moulin"
+        self.item = "http://www.wowarmory.com/item-info.xml?i=38237"
+
+    def testPercentiles(self):
+        for n in xrange(1, 101):
+            self.stats.record_fetch(self.sheet, n / 1000.0, 200)
+
+        sheet = self.stats.summary()["character-sheet"]
+        self.assertEqual(sheet["fetches"], 100)
+        self.assertAlmostEqual(sheet["latency_p50"], 0.051)
+        self.assertAlmostEqual(sheet["latency_p90"], 0.090)
+        self.assertAlmostEqual(sheet["latency_max"], 0.1)
+
+    def testSamplesBounded(self):
+        for n in xrange(200):
+            self.stats.record_fetch(self.sheet, 1.0, 200)
+
+        self.stats.record_fetch(self.sheet, 2.0, 200)
+        sheet = self.stats.summary()["character-sheet"]
+        self.assertEqual(sheet["fetches"], 201)
+        self.assertEqual(len(self.stats._types["character-sheet"].latencies), 100)
+        self.assertEqual(sheet["latency_max"], 2.0)
+
+    def testByType(self):
+        self.stats.record_fetch(self.sheet, 0.1, 200, 1000, 5000)
+        self.stats.record_fetch(self.sheet, 0.1, 304)
+        self.stats.record_fetch(self.item, 0.1, 503)
+        self.stats.record_fetch(self.item, 0.1, None)
+        self.stats.record_retry(self.item, 30)
+        summary = self.stats.summary()
+
+        self.assertEqual(summary["character-sheet"]["compressed_bytes"], 1000)
+        self.assertEqual(summary["character-sheet"]["decompressed_bytes"], 5000)
+        self.assertEqual(summary["character-sheet"]["not_modified"], 1)
+        self.assertEqual(summary["item"]["errors"], 2)
+        self.assertEqual(summary["item"]["backoff_time"], 30)
+
+    def testCacheAndThrottle(self):
+        self.stats.record_cache(self.sheet, True)
+        self.stats.record_cache(self.sheet, True)
+        self.stats.record_cache(self.sheet, False)
+        self.stats.record_throttle(self.sheet, 0)
+        self.stats.record_throttle(self.sheet, 0.5)
+        sheet = self.stats.summary()["character-sheet"]
+
+        self.assertAlmostEqual(sheet["cache_hit_ratio"], 2 / 3.0)
+        self.assertEqual(sheet["throttles"], 1)
+        self.assertEqual(sheet["latency_p50"], None)
+        self.assertTrue("character-sheet" in format_summary(self.stats.summary()))
+
+    def testReset(self):
+        self.stats.record_fetch(self.sheet, 0.1, 200)
+        self.assertEqual(self.stats.reset()["character-sheet"]["fetches"], 1)
+        self.assertEqual(self.stats.summary(), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+FetchProfile.py
+
+Named choices of what is downloaded for a character besides its sheet:
+its items, its talents and which categories of its statistics and
+achievements. A job that only wants gear and talents then doesn't pay for
+the nineteen statistics and achievements pages every character has.
+
+Copyright (c) 2009, Regents of the University of California
+All rights reserved.
+"""
+
+import sys
+import os
+import unittest
+import WoWSpyderLib
+import Logger
+
+log = Logger.log()
+
+FULL = u"full"
+GEAR = u"gear"
+SHEET = u"sheet"
+
+class FetchProfile(object):
+    """What to download for a character. statistics and achievements are
+    True for every category, False for none or a list of the categories
+    wanted.
+
+    """
+    def __init__(self, name, items=True, talents=True, statistics=True, \
+            achievements=True):
+        self.name = name
+        self.items = items
+        self.talents = talents
+        self.statistics = statistics
+        self.achievements = achievements
+
+    @property
+    def statistic_categories(self):
+        """The statistics categories to download, which may be empty."""
+        return self._categories(self.statistics, \
+            WoWSpyderLib.STATISTIC_CATEGORIES)
+
+    @property
+    def achievement_categories(self):
+        """The achievements categories to download, which may be empty."""
+        return self._categories(self.achievements, \
+            WoWSpyderLib.ACHIEVEMENT_CATEGORIES)
+
+    @property
+    def all_statistics(self):
+        """True if every statistics category is downloaded, so whatever
+        the character had before can be replaced.
+
+        """
+        return set(self.statistic_categories) >= \
+            set(WoWSpyderLib.STATISTIC_CATEGORIES)
+
+    @property
+    def all_achievements(self):
+        return set(self.achievement_categories) >= \
+            set(WoWSpyderLib.ACHIEVEMENT_CATEGORIES)
+
+    def _categories(self, wanted, every):
+        if wanted is True:
+            return list(every)
+
+        if not wanted:
+            return []
+
+        return [int(category) for category in wanted]
+
+    @property
+    def requests(self):
+        """How many pages a character takes, other than its items, which
+        are only downloaded once for everyone wearing them.
+
+        """
+        return 1 + int(bool(self.talents)) + \
+            len(self.statistic_categories) + len(self.achievement_categories)
+
+    def __repr__(self):
+        return unicode("<FetchProfile('%s','%d')>" % (self.name, self.requests))
+
+
+PROFILES = {
+    FULL: FetchProfile(FULL),
+    GEAR: FetchProfile(GEAR, statistics=False, achievements=False),
+    SHEET: FetchProfile(SHEET, items=False, talents=False, statistics=False, \
+        achievements=False),
+}
+
+_profiles = dict(PROFILES)
+_default = FULL
+
+def configure(profiles=None, default=FULL):
+    """Add profiles, a dictionary of options for FetchProfile keyed on
+    name, e.g. {"raid": {"statistics": [14807], "achievements": False}},
+    to those in PROFILES, and make default the profile used when none is
+    asked for.
+
+    """
+    global _default
+    _profiles.clear()
+    _profiles.update(PROFILES)
+
+    for name, options in (profiles or {}).items():
+        options = dict((str(key), value) for key, value in options.items())
+        _profiles[name] = FetchProfile(name, **options)
+
+    if default not in _profiles:
+        log.warning("No fetch profile called " + str(default) + \
+            ", using " + FULL)
+        default = FULL
+
+    _default = default
+
+def get(profile=None):
+    """Return the FetchProfile called profile, the default one if profile
+    is None, or profile itself if it's already a FetchProfile. Raises
+    KeyError if there's no profile by that name.
+
+    """
+    if isinstance(profile, FetchProfile):
+        return profile
+
+    if profile is None:
+        profile = _default
+
+    return _profiles[profile]
+
+
+class FetchProfileTests(unittest.TestCase):
+    def tearDown(self):
+        configure()
+
+    def testProfiles(self):
+        self.assertEqual(get().name, FULL)
+        self.assertEqual(get(FULL).requests, 1 + 1 + \
+            len(WoWSpyderLib.STATISTIC_CATEGORIES) + \
+            len(WoWSpyderLib.ACHIEVEMENT_CATEGORIES))
+        self.assertEqual(get(GEAR).requests, 2)
+        self.assertEqual(get(SHEET).requests, 1)
+        self.assertFalse(get(SHEET).items)
+        self.assertRaises(KeyError, get, u"nothing")
+
+    def testConfigure(self):
+        configure({u"raid": {u"statistics": [14807], u"achievements": False}}, \
+            default=u"raid")
+        raid = get()
+        self.assertEqual(raid.name, u"raid")
+        self.assertEqual(raid.statistic_categories, [14807])
+        self.assertFalse(raid.all_statistics)
+        self.assertEqual(raid.achievement_categories, [])
+        self.assertTrue(raid.items and raid.talents)
+        self.assertEqual(get(GEAR).name, GEAR)
+
+    def testUnknownDefault(self):
+        configure(default=u"nothing")
+        self.assertEqual(get().name, FULL)
+        self.assertTrue(get().all_statistics and get().all_achievements)
+
+    def testCategoryUrls(self):
+        urls = WoWSpyderLib.get_character_statistics_urls(u"Moulin", \
+            u"Ravenholdt", u"us", get(GEAR).statistic_categories)
+        self.assertEqual(urls, [])
+        urls = WoWSpyderLib.get_character_statistics_urls(u"Moulin", \
+            u"Ravenholdt", u"us", [14807])
+        self.assertEqual(len(urls), 1)
+        self.assertTrue(urls[0].endswith("&c=14807"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -15,7 +15,6 @@ file alleivates that problem. This is not to say I am happy about it.
 import sys
 import os
 import unittest
-from xml.dom import minidom
 import Database
 import Logger
 import datetime
@@ -30,17 +29,73 @@ from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relation, backref
 from Enum import Enum
 import urllib2
-import StringIO
 import Preferences
-import re
-from Parser import Parser
+from Parser import Parser, MissingEntityError
 from Item import ItemParser
 from Achievement import AchievementParser
+import NegativeCache
+import DeadLetter
+import GuildRoster
+import DownloadFuture
+import DeepFetch
+import FetchProfile
+import ResponseCache
 
 log = Logger.log()
 
 Base = Database.get_base()
 
+# How guild and team rosters are crawled. FULL_CRAWL downloads every
+# member's character sheet. STUB_CRAWL makes characters from what the
+# roster lists about them, and queues only those that need it for a
+# DeepFetch of their sheets.
+FULL_CRAWL = u"full"
+STUB_CRAWL = u"stub"
+
+# Factions as guild pages number them
+FACTIONS = {u"0": u"Alliance", u"1": u"Horde"}
+
+# How many characters are looked up in the database at once
+STUB_BATCH = 500
+
+# What a roster can tell us about a character
+STUB_FIELDS = ("level", "character_class", "faction", "gender", "race", \
+    "guild", "guild_rank")
+
+def make_listing(node, realm, faction=None, guild=None, guild_rank=None):
+    """Return what stub_characters wants to know about a character, from
+    the attributes a guild or team page lists it with. Anything the page
+    doesn't say is None.
+    
+    """
+    level = node.get("level")
+    
+    return {
+        "name": node["name"],
+        "realm": node.get("realm", realm),
+        "level": level and int(level) or None,
+        "character_class": node.get("class"),
+        "faction": faction,
+        "gender": node.get("gender"),
+        "race": node.get("race"),
+        "guild": node.get("guild") or guild,
+        "guild_rank": guild_rank,
+    }
+
+def _is_valid(field, value):
+    """Return True if value can be saved in the Character column field."""
+    values = getattr(Character.__table__.c[field].type, "values", None)
+    return values is None or value in values
+    
+def _is_complete(listing):
+    """Return True if listing says enough to save a new Character."""
+    for field in ("character_class", "faction", "gender", "race"):
+        if listing[field] is None or not _is_valid(field, listing[field]):
+            return False
+            
+    return True
+    
+
 class CharacterParser(Parser):
     """A class to parse the character sheets from the Armory and return
     character objects. 
@@ -51,65 +106,88 @@ class CharacterParser(Parser):
     which would create a loop.
     
     """
-    def __init__(self, downloader=None):
-        '''Initialize the character parser.'''
+    entity = "character"
+    
+    def __init__(self, downloader=None, profile=None):
+        '''Initialize the character parser. profile is the FetchProfile, or
+        its name, that characters are downloaded with, defaulting to the
+        fetch_profile preference.'''
         log.debug("Creating character parser with downloader " + str(downloader))
         Parser.__init__(self, downloader=downloader)
+        self.profile = FetchProfile.get(profile)
         self._gp = GuildParser(downloader=self._downloader)
         self._ip = ItemParser(downloader=self._downloader)
         self._ap = AchievementParser(downloader=self._downloader)
         Base.metadata.create_all(Database.engine)
         
-    def _check_download(self, source, exception):
-        if exception or source == None:
-            log.error("Unable to download file for character")
-            raise exception
-            
-        if re.search("errCode=\"noCharacter\"", source):
-            log.error("Character was invalid or not returned")
-            raise IOError("Character requested was invalid or not returned")
-            
-        return source
-                        
-    def get_character(self, name, realm, site, cached=False, force_refresh=False):
+    def _is_missing(self, parsed):
+        return parsed.attribute("characterInfo", "errCode") == "noCharacter"
+        
+    def get_character(self, name, realm, site, cached=False, force_refresh=False, \
+            profile=None):
         """Return a character object. This only stubs the guild, which means
-        the guild won't be populated with characters."""
+        the guild won't be populated with characters. profile is the
+        FetchProfile, or its name, saying what to download besides the sheet,
+        defaulting to the parser's. What it leaves out keeps whatever the
+        database had, and as an unchanged sheet isn't parsed again,
+        force_refresh fills in what a smaller profile left out before."""
         log.debug("Getting character " + name + "...")
+        profile = FetchProfile.get(profile or self.profile)
         
         character = self._session.query(Character).get((name, realm, site))
         
-        # cflewis | 2009-04-11 | Check if a character is actually updated
-        # on the armory. If not, return the database version anyway.
-        if character and (cached == True or character.is_updated_on_armory() == False) and not force_refresh:
+        if character and cached == True and not force_refresh:
             return character            
         
-        source = self._download_url(\
-            WoWSpyderLib.get_character_sheet_url(name, realm, site))
-        character = self._parse_character(StringIO.StringIO(source), site)
+        # The sheet is downloaded once, both to see if the character has
+        # changed and to parse it if it has
+        try:
+            source = self._download_entity(\
+                WoWSpyderLib.get_character_sheet_url(name, realm, site), \
+                NegativeCache.make_key(name, realm, site))
+        except MissingEntityError, e:
+            if character and not force_refresh:
+                return character
+            raise
+            
+        # cflewis | 2009-04-11 | Check if a character is actually updated
+        # on the armory. If not, return the database version anyway.
+        if character and not force_refresh:
+            character.read_last_modified_on_armory(source.parsed())
+            
+            if not character.is_updated_on_armory():
+                return character
+            
+        if character and not force_refresh and self._is_unchanged(source):
+            log.debug("Character sheet hasn't changed, not parsing it")
+            return character
+            
+        character = self._parse_character(source.parsed(), site, profile)
             
         return character
         
-    def _parse_character(self, xml_file_object, site):
-        """Parse the XML of a character sheet from the Armory."""
+    def _parse_character(self, parsed, site, profile=None):
+        """Parse a character sheet from the Armory, given its
+        XMLStream.ParsedPage, downloading what profile asks for besides.
+        
+        """
+        profile = FetchProfile.get(profile or self.profile)
         log.debug("Parsing character...")
         
-        xml = minidom.parse(xml_file_object)
-        character_nodes = xml.getElementsByTagName("character")
+        character_node = parsed.first("character")
         
-        try:
-            character_node = character_nodes[0]
-        except IndexError, e:
+        if character_node is None:
             log.debug("No character found in the XML")
-            raise 
+            raise IndexError("No character element in the page")
         
-        name = character_node.attributes["name"].value
-        realm = character_node.attributes["realm"].value
+        name = character_node["name"]
+        realm = character_node["realm"]
         site = site
-        level = character_node.attributes["level"].value
-        character_class = character_node.attributes["class"].value
-        faction = character_node.attributes["faction"].value
-        gender = character_node.attributes["gender"].value
-        race = character_node.attributes["race"].value
+        level = character_node["level"]
+        character_class = character_node["class"]
+        faction = character_node["faction"]
+        gender = character_node["gender"]
+        race = character_node["race"]
         
         # cflewis | 2009-03-28 | Get characters is false to "stub" the Guild
         # into the DB in order to satisfy the foreign key. Creating
@@ -122,14 +200,16 @@ class CharacterParser(Parser):
         log.debug("Working on guild ranks...")
         
         # cflewis | 2009-04-02 | Check if character is in a guild at all
-        if character_node.attributes["guildName"].value != "" or \
-            character_node.attributes["guildName"].value is not None:
+        if character_node["guildName"] != "" or \
+            character_node["guildName"] is not None:
             
             try:
-                guild = self._gp.get_guild(character_node.attributes["guildName"].value, \
+                guild = self._gp.get_guild(character_node["guildName"], \
                     realm, site, get_characters=False, cached=True)
             except Exception, e:
                 log.warning("Couldn't get guild for " + name + ". ERROR: " + str(e))
+                self._defer(self._gp.entity, \
+                    [character_node["guildName"], realm, site], e)
             else:
                 try:
                     guild_rank = self._gp.get_guild_rank(guild.name, realm, site, name)
@@ -145,7 +225,7 @@ class CharacterParser(Parser):
         log.debug("Guilds done, working on last modified date...")
 
         try:
-            last_modified_string = character_node.attributes["lastModified"].value
+            last_modified_string = character_node["lastModified"]
         except KeyError, e:
             log.warning("Couldn't get last modified date. ERROR: " + str(e))
             last_modified = None
@@ -163,63 +243,95 @@ class CharacterParser(Parser):
         
         log.debug("Character done, getting items...")
         
-        items = []
-        
-        for i in range(0, 19):
-            items.append(CharacterItem(name, realm, site, i, None))
-        
-        item_nodes = xml.getElementsByTagName("item")
+        # What the profile doesn't download is kept as it was
+        previous = self._session.query(Character).get((name, realm, site))
+        items = None
         
-        for item_node in item_nodes:
-            try:
-                item = self._ip.get_item(item_node.attributes["id"].value)
-            except Exception, e:
-                continue
-            else:
-                items[int(item_node.attributes["slot"].value)] = CharacterItem(name, realm, site, \
-                    int(item_node.attributes["slot"].value), item.item_id)
+        if profile.items:
+            items = []
+            
+            for i in range(0, 19):
+                items.append(CharacterItem(name, realm, site, i, None))
+            
+            for item_node in parsed.all("item"):
+                try:
+                    item = self._ip.get_item(item_node["id"])
+                except Exception, e:
+                    self._defer(self._ip.entity, [item_node["id"]], e)
+                    continue
+                else:
+                    items[int(item_node["slot"])] = CharacterItem(name, realm, \
+                        site, int(item_node["slot"]), item.item_id)
 
         talents1 = None
         talents2 = None
         
-        try:    
-            talents = self._get_character_talents(name, realm, site)
-        except Exception, e:
-            log.warning("Couldn't get talents for " + name + " " + realm + \
-                " " + site + ". ERROR: " + str(e))
-        else:
-            talents1 = talents[0]
-            talents2 = talents[1]
-            log.debug("Talents 1 is " + str(talents1))
-            log.debug("Talents 2 is " + str(talents2))
+        if profile.talents:
+            try:    
+                talents = self._get_character_talents(name, realm, site)
+            except Exception, e:
+                log.warning("Couldn't get talents for " + name + " " + realm + \
+                    " " + site + ". ERROR: " + str(e))
+                self._defer(self.entity, [name, realm, site], e)
+            else:
+                talents1 = talents[0]
+                talents2 = talents[1]
+                log.debug("Talents 1 is " + str(talents1))
+                log.debug("Talents 2 is " + str(talents2))
+        elif previous:
+            talents1 = previous.talents_1
+            talents2 = previous.talents_2
         
+        # The sheet has just been read, so a stub crawl needn't queue the
+        # character again until it's deep_fetch_max_age old
         character = Character(name, realm, site, level, character_class, faction, \
             gender, race, guild_name, guild_rank, last_modified=last_modified, \
-            items=items, talents1=talents1, talents2=talents2)
+            items=items, talents1=talents1, talents2=talents2, \
+            last_refresh=datetime.datetime.now())
         log.info("Creating character " + unicode(character).encode("utf-8"))
         Database.insert(character)
         
-        statistics = []
-        
-        try:
-            statistics = self._get_character_statistics(name, realm, site)
-        except Exception, e:
-            log.warning("Couldn't get statistics for " + name + " " + realm + \
-                " " + site + ". ERROR: " + str(e))
-        
-        character.statistics = statistics
-        #for statistic in statistics:
-        #    character.statistics.append(statistic)
+        if profile.statistic_categories:
+            statistics = []
             
-        achievements = []
+            try:
+                statistics = self._get_character_statistics(name, realm, site, \
+                    profile.statistic_categories)
+            except Exception, e:
+                log.warning("Couldn't get statistics for " + name + " " + realm + \
+                    " " + site + ". ERROR: " + str(e))
+                self._defer(self.entity, [name, realm, site], e)
+            
+            # Only some categories were downloaded, so the rest stay
+            if previous and not profile.all_statistics:
+                found = set([statistic.statistic for statistic in statistics])
+                statistics.extend([CharacterStatistic(name, realm, site, \
+                    s.statistic, s.quantity, s.highest) \
+                    for s in previous.statistics if s.statistic not in found])
+            
+            character.statistics = statistics
+            #for statistic in statistics:
+            #    character.statistics.append(statistic)
+            
+        if profile.achievement_categories:
+            achievements = []
 
-        try:
-            achievements = self._get_character_achievements(name, realm, site)
-        except Exception, e:
-            log.warning("Couldn't get achievements for " + name + " " + realm + \
-                " " + site + ". ERROR: " + str(e))
+            try:
+                achievements = self._get_character_achievements(name, realm, \
+                    site, profile.achievement_categories)
+            except Exception, e:
+                log.warning("Couldn't get achievements for " + name + " " + realm + \
+                    " " + site + ". ERROR: " + str(e))
+                self._defer(self.entity, [name, realm, site], e)
 
-        character.achievements = achievements
+            if previous and not profile.all_achievements:
+                found = set([a.achievement_id for a in achievements])
+                achievements.extend([CharacterAchievement(name, realm, site, \
+                    a.achievement_id, a.date_completed) \
+                    for a in previous.achievements \
+                    if a.achievement_id not in found])
+
+            character.achievements = achievements
                 
         Database.insert(character)
                 
@@ -229,61 +341,64 @@ class CharacterParser(Parser):
     def _get_character_talents(self, name, realm, site):
         source = self._download_url(\
             WoWSpyderLib.get_character_talents_url(name, realm, site))
-        talents = self._parse_character_talents(StringIO.StringIO(source))
+        talents = self._parse_character_talents(source.parsed())
             
         return talents
         
-    def _parse_character_talents(self, xml_file_object):
-        """Parse the XML of a talents character sheet from the Armory."""
+    def _parse_character_talents(self, parsed):
+        """Parse a talents character sheet from the Armory, given its
+        XMLStream.ParsedPage.
+        
+        """
         log.debug("Parsing character talents...")
         
-        xml = minidom.parse(xml_file_object)
-        talent_tree_nodes = xml.getElementsByTagName("talentSpec")
         talents = []
         
-        for node in talent_tree_nodes:
-            talents.append(node.attributes["value"].value)
+        for node in parsed.all("talentSpec"):
+            talents.append(node["value"])
             
         if len(talents) == 1:
             talents.append(None)
                 
         return talents
         
-    def _get_character_statistics(self, name, realm, site):
-        urls = WoWSpyderLib.get_character_statistics_urls(name, realm, site)
+    def _get_character_statistics(self, name, realm, site, categories=None):
+        urls = WoWSpyderLib.get_character_statistics_urls(name, realm, site, \
+            categories)
         statistics = []
         
-        for url in urls:
-            source = self._download_url(url)
+        # Every category is asked for at once, and parsed as it arrives
+        for url, source in self._download_urls(urls):
             statistics.append(self._parse_character_statistics( \
-                StringIO.StringIO(source), name, realm, site))
+                source.parsed(), name, realm, site))
             
         return WoWSpyderLib.merge(statistics)
             
             
-    def _parse_character_statistics(self, xml_file_object, name, realm, site):
-        """Parse the XML of a statistics character sheet from the Armory."""
+    def _parse_character_statistics(self, parsed, name, realm, site):
+        """Parse a statistics character sheet from the Armory, given its
+        XMLStream.ParsedPage.
+        
+        """
         log.debug("Parsing character statistics...")
-        xml = minidom.parse(xml_file_object)
         statistics = []
-        statistic_nodes = xml.getElementsByTagName("statistic")
 
-        for statistic_node in statistic_nodes:
+        for statistic_node in parsed.all("statistic"):
             try:
-                statistic = statistic_node.attributes["name"].value
+                statistic = statistic_node["name"]
             except KeyError, e:
                 # cflewis | 2009-04-07 | This wasn't a statistic node at all
                 # or a blank one, like <statistic/>
                 continue
                 
-            quantity = statistic_node.attributes["quantity"].value
+            quantity = statistic_node["quantity"]
             
             if quantity == "--": quantity = 0
             
             highest = None
             
             try:
-                highest = statistic_node.attributes["highest"].value
+                highest = statistic_node["highest"]
             except KeyError, e:
                 pass
             
@@ -295,45 +410,46 @@ class CharacterParser(Parser):
                 
         return statistics
         
-    def _get_character_achievements(self, name, realm, site):
-        urls = WoWSpyderLib.get_character_achievement_urls(name, realm, site)
+    def _get_character_achievements(self, name, realm, site, categories=None):
+        urls = WoWSpyderLib.get_character_achievement_urls(name, realm, site, \
+            categories)
         achievements = []
 
-        for url in urls:
-            source = self._download_url(url)
+        for url, source in self._download_urls(urls):
             achievements.append(self._parse_character_achievements( \
-                StringIO.StringIO(source), name, realm, site))
+                source.parsed(), name, realm, site))
 
         return WoWSpyderLib.merge(achievements)
 
 
-    def _parse_character_achievements(self, xml_file_object, name, realm, site):
-        """Parse the XML of a achievements character sheet from the Armory."""
+    def _parse_character_achievements(self, parsed, name, realm, site):
+        """Parse an achievements character sheet from the Armory, given its
+        XMLStream.ParsedPage.
+        
+        """
         log.debug("Parsing character achievements...")
-        xml = minidom.parse(xml_file_object)
         achievements = []
-        achievement_nodes = xml.getElementsByTagName("achievement")
 
-        for achievement_node in achievement_nodes:
+        for achievement_node in parsed.all("achievement"):
             try:
-                achievement = achievement_node.attributes["dateCompleted"].value
+                achievement = achievement_node["dateCompleted"]
             except KeyError, e:
                 # cflewis | 2009-04-23 | This wasn't a completed achievement
                 continue
 
             
-            achievement_id = achievement_node.attributes["id"].value
-            category_id = achievement_node.attributes["categoryId"].value
-            achievement_name = achievement_node.attributes["title"].value
-            description = achievement_node.attributes["desc"].value
+            achievement_id = achievement_node["id"]
+            category_id = achievement_node["categoryId"]
+            achievement_name = achievement_node["title"]
+            description = achievement_node["desc"]
             
             try:
-                points = achievement_node.attributes["points"].value
+                points = achievement_node["points"]
             except KeyError, e:
                 points = None
                 
             date_completed = WoWSpyderLib.convert_date_completed_to_datetime( \
-                achievement_node.attributes["dateCompleted"].value)
+                achievement_node["dateCompleted"])
 
             achievement = self._ap.get_achievement(achievement_id, \
                 category_id, achievement_name, points, description)
@@ -344,6 +460,108 @@ class CharacterParser(Parser):
 
         return achievements
         
+    def stub_characters(self, listings, site):
+        """Create or update characters from listings, made by make_listing
+        from a guild or team page, without downloading their sheets. The
+        database is asked about and saved to a batch at a time. Characters
+        that are new, have levelled or were last fully fetched longer ago
+        than deep_fetch_max_age are queued for a DeepFetch. Returns the
+        characters.
+        
+        """
+        session = Database.session()
+        max_age = datetime.timedelta(seconds=self._prefs.deep_fetch_max_age)
+        now = datetime.datetime.now()
+        characters = []
+        queued = []
+        by_realm = {}
+        
+        for listing in listings:
+            by_realm.setdefault(listing["realm"], []).append(listing)
+            
+        for realm, realm_listings in by_realm.items():
+            names = [listing["name"] for listing in realm_listings]
+            existing = {}
+            
+            for start in xrange(0, len(names), STUB_BATCH):
+                for character in session.query(Character) \
+                    .filter(Character.realm == realm) \
+                    .filter(Character.site == site) \
+                    .filter(Character.name.in_(names[start:start + STUB_BATCH])):
+                    existing[character.name] = character
+                    
+            self._stub_guilds(realm_listings, realm, site)
+            
+            for listing in realm_listings:
+                character = existing.get(listing["name"])
+                reason = None
+                
+                if character is None:
+                    reason = DeepFetch.NEW
+                    
+                    # A character can't be saved without everything its
+                    # enums need, so one the roster says too little about
+                    # waits for its sheet
+                    if _is_complete(listing):
+                        character = Character(listing["name"], realm, site, \
+                            listing["level"], listing["character_class"], \
+                            listing["faction"], listing["gender"], \
+                            listing["race"], listing["guild"], \
+                            listing["guild_rank"])
+                        session.add(character)
+                else:
+                    if character.last_modified is None:
+                        reason = DeepFetch.NEW
+                    elif listing["level"] is not None and \
+                        listing["level"] != character.level:
+                        reason = DeepFetch.LEVEL
+                    elif character.last_refresh is None or \
+                        now - character.last_refresh > max_age:
+                        reason = DeepFetch.STALE
+                        
+                    for field in STUB_FIELDS:
+                        value = listing[field]
+                        
+                        if value is not None and _is_valid(field, value):
+                            setattr(character, field, value)
+                            
+                if reason is not None:
+                    queued.append((listing["name"], realm, site, reason))
+                    
+                if character is not None:
+                    characters.append(character)
+                    
+        try:
+            session.commit()
+        except Exception, e:
+            log.warning("Couldn't save stubbed characters. ERROR: " + str(e))
+            session.rollback()
+            raise
+            
+        log.info("Stubbed %d characters, %d need a deep fetch" % \
+            (len(characters), len(queued)))
+        DeepFetch.enqueue_many(queued)
+        
+        return characters
+        
+    def _stub_guilds(self, listings, realm, site):
+        """Add the guilds listings name that aren't in the database yet, so
+        characters can belong to them. They're left for the guild crawl.
+        
+        """
+        session = Database.session()
+        
+        for name in set([l["guild"] for l in listings if l["guild"]]):
+            if session.query(Guild).get((name, realm, site)) is None:
+                log.debug("Stubbing guild " + name.encode("utf-8"))
+                session.add(Guild(name, realm, site))
+        
+    def redo(self, name, realm, site):
+        """Redo a character that failed, or parts of which did."""
+        return self.get_character(name, realm, site, force_refresh=True)
+
+DeadLetter.register(CharacterParser.entity, CharacterParser)
+        
 class CharacterAchievement(Base):
     """An achievement for a character."""
     __table__ = Table("CHARACTER_ACHIEVEMENT", Base.metadata,
@@ -441,9 +659,9 @@ class Character(Base):
         Column("guild_rank", Integer()),
         Column("talents_1", Unicode(100)),
         Column("talents_2", Unicode(100)),
-        Column("first_seen", DateTime(), default=datetime.datetime.now()),
+        Column("first_seen", DateTime(), default=datetime.datetime.now),
         Column("last_modified", DateTime()),
-        Column("last_refresh", DateTime(), default=datetime.datetime.now(), index=True),
+        Column("last_refresh", DateTime(), default=datetime.datetime.now, index=True),
         ForeignKeyConstraint(['realm', 'site'], ['REALM.name', 'REALM.site']),
         mysql_charset="utf8",
         mysql_engine="InnoDB"
@@ -510,25 +728,37 @@ class Character(Base):
         # cflewis | 2009-04-11 | It's safe to cache because there's no way
         # the lifetime of a character object will exceed that of an armory
         # refresh.
-        downloader = XMLDownloader.XMLDownloader()
-        source = downloader.download_url(self.url)
-
         try:
             if self._last_modified_on_armory != None:
                 return self._last_modified_on_armory
-        except AttributeError:        
-            try:
-                armory_date_string = re.search("lastModified=\"(.*?)\"", source).group(1)
-            except Exception, e:
-                log.debug("Couldn't find last modified, returning what I had")
-                return self.last_modified
-            else:
-                self._last_modified_on_armory = \
-                    WoWSpyderLib.convert_last_modified_to_datetime(armory_date_string)
-                log.debug("Saved last modified on armory as " + str(self._last_modified_on_armory))
-                return self._last_modified_on_armory
+        except AttributeError:
+            pass
+            
+        downloader = XMLDownloader.XMLDownloader()
+        return self.read_last_modified_on_armory( \
+            downloader.download_page(self.url).parsed())
+            
+    def read_last_modified_on_armory(self, parsed):
+        """Save and return when the Armory says the character last changed,
+        read from parsed, the XMLStream.ParsedPage of its sheet.
+        
+        """
+        try:
+            self._last_modified_on_armory = \
+                WoWSpyderLib.convert_last_modified_to_datetime(parsed.last_modified)
+        except Exception, e:
+            log.debug("Couldn't find last modified, returning what I had")
+            return self.last_modified
+            
+        log.debug("Saved last modified on armory as " + str(self._last_modified_on_armory))
+        return self._last_modified_on_armory
         
     def is_updated_on_armory(self):
+        # A character stubbed from a roster has never had its sheet read
+        if self.last_modified is None:
+            log.debug("Character has never been fully fetched")
+            return True
+            
         if self.last_modified_on_armory > self.last_modified:
             log.debug("Character has been updated on the armory")
             return True
@@ -538,11 +768,110 @@ class Character(Base):
 
 class CharacterParserTests(unittest.TestCase):
     def setUp(self):
+        import ArmoryStandIn
+        self.stand_in = ArmoryStandIn.ArmoryStandIn().start().use()
         self.cp = CharacterParser()
         self.c = self.cp.get_character(u"Moulin", u"Ravenholdt", u"us", force_refresh=True)
         
+    def tearDown(self):
+        self.stand_in.stop()
+        
     def testCharacterModifiedDate(self):
         self.assertFalse(self.c.is_updated_on_armory())
+        
+    def testProfileKeepsTheRest(self):
+        key = (u"Moulin", u"Ravenholdt", u"us")
+        before = Database.session().query(Character).get(key)
+        talents = before.talents_1
+        statistics = len(before.statistics)
+        
+        self.cp.get_character(u"Moulin", u"Ravenholdt", u"us", \
+            force_refresh=True, profile=FetchProfile.SHEET)
+        after = Database.session().query(Character).get(key)
+        self.assertEqual(after.talents_1, talents)
+        self.assertEqual(len(after.statistics), statistics)
+        
+    def _stale_sheet(self):
+        """Let the cached sheet go stale, so the next download of it is
+        answered 304 by the stand-in."""
+        ResponseCache.get_cache().configure(ttls={"character-sheet": 0.01})
+        time.sleep(0.02)
+        
+    def testForceRefreshUnchanged(self):
+        key = (u"Moulin", u"Ravenholdt", u"us")
+        refreshed = Database.session().query(Character).get(key).last_refresh
+        self._stale_sheet()
+        
+        self.cp.get_character(u"Moulin", u"Ravenholdt", u"us", \
+            force_refresh=True)
+        self.assertEqual(self.stand_in.responses.get(304), 1)
+        after = Database.session().query(Character).get(key)
+        self.assertTrue(after.last_refresh > refreshed)
+        
+    def testForceRefreshFillsIn(self):
+        key = (u"Moulin", u"Ravenholdt", u"us")
+        session = Database.session()
+        session.delete(session.query(Character).get(key))
+        session.commit()
+        
+        self.cp.get_character(u"Moulin", u"Ravenholdt", u"us", \
+            profile=FetchProfile.SHEET)
+        sheet = session.query(Character).get(key)
+        self.assertEqual(sheet.talents_1, None)
+        self.assertEqual(len(sheet.statistics), 0)
+        self._stale_sheet()
+        
+        self.cp.get_character(u"Moulin", u"Ravenholdt", u"us", \
+            force_refresh=True, profile=FetchProfile.FULL)
+        self.assertEqual(self.stand_in.responses.get(304), 1)
+        full = session.query(Character).get(key)
+        self.assertTrue(full.talents_1)
+        self.assertTrue(len(full.statistics) > 0)
+
+
+class StubCrawlTests(unittest.TestCase):
+    def setUp(self):
+        import ArmoryStandIn
+        self.stand_in = ArmoryStandIn.ArmoryStandIn().start().use()
+        self.cp = CharacterParser()
+        self.key = (u"Shirley", u"Ravenholdt", u"us")
+        session = Database.session()
+        shirley = session.query(Character).get(self.key)
+        
+        if shirley is not None:
+            session.delete(shirley)
+            session.commit()
+        
+    def tearDown(self):
+        DeepFetch.finish(*self.key)
+        self.stand_in.stop()
+        
+    def testStubThenFetch(self):
+        listing = make_listing({"name": u"Shirley", "level": u"72", \
+            "class": u"Priest", "gender": u"Female", "race": u"Dwarf"}, \
+            u"Ravenholdt", faction=u"Alliance", guild=u"Wandering Shadows", \
+            guild_rank=0)
+        self.cp.stub_characters([listing], u"us")
+        stub = Database.session().query(Character).get(self.key)
+        self.assertEqual(stub.last_modified, None)
+        self.assertTrue(stub.is_updated_on_armory())
+        
+        # The stub doesn't stop its sheet being read
+        character = self.cp.get_character(*self.key)
+        self.assertEqual(character.last_modified, datetime.datetime(2009, 3, 30))
+        
+    def testFetchedNotQueued(self):
+        self.cp.get_character(*self.key)
+        fetched = Database.session().query(Character).get(self.key)
+        self.assertTrue(fetched.last_refresh is not None)
+        
+        listing = make_listing({"name": u"Shirley", "level": u"72", \
+            "class": u"Priest", "gender": u"Female", "race": u"Dwarf"}, \
+            u"Ravenholdt", faction=u"Alliance", guild=u"Wandering Shadows", \
+            guild_rank=0)
+        self.cp.stub_characters([listing], u"us")
+        self.assertEqual(Database.session().query(DeepFetch.DeepFetch) \
+            .get(self.key), None)
 
         
 class GuildParser(Parser):
@@ -550,22 +879,19 @@ class GuildParser(Parser):
     also fill out the characters within it.
     
     """
-    def __init__(self, downloader=None):
-        '''Initialize the guild parser.'''
+    entity = "guild"
+    
+    def __init__(self, downloader=None, crawl_mode=None):
+        '''Initialize the guild parser. crawl_mode is FULL_CRAWL or
+        STUB_CRAWL, defaulting to the crawl_mode preference.'''
         Parser.__init__(self, downloader=downloader)
+        self.crawl_mode = crawl_mode or self._prefs.crawl_mode
         Base.metadata.create_all(Database.engine)
         
-    def _check_download(self, source, exception):
-        if exception:
-            log.error("Unable to download file for guild")
-            raise exception
-            
-        if re.search("guildInfo/", source):
-            log.error("Guild was invalid or not returned")
-            raise IOError("Guild requested was invalid or not returned")
-            
-        return source
-
+    def _is_missing(self, parsed):
+        # An empty guildInfo element means there's no such guild
+        return parsed.first("guildHeader") is None
+        
     def get_guild(self, name, realm, site, get_characters=False, cached=False):
         """Get a guild. Setting get_characters=False will disable the
         behavior that causes the guild characters to also be created. You
@@ -582,21 +908,25 @@ class GuildParser(Parser):
 
         # cflewis | 2009-04-02 | If the downloading fails, the whole guild
         # couldn't be found, so the exception should propagate up.
-        source = self._download_url(\
-            WoWSpyderLib.get_guild_url(name, realm, site))
-        guild = self._parse_guild(StringIO.StringIO(source), site, get_characters=get_characters)
+        source = self._download_entity(\
+            WoWSpyderLib.get_guild_url(name, realm, site), \
+            NegativeCache.make_key(name, realm, site))
+            
+        if guild and self._is_unchanged(source):
+            log.debug("Guild hasn't changed, not parsing it")
+            return guild
+            
+        guild = self._parse_guild(source.parsed(), site, get_characters=get_characters)
 
         return guild
         
 
-    def _parse_guild(self, xml_file_object, site, get_characters=False):
-        """Parse a guild page."""
-        xml = minidom.parse(xml_file_object)
-        guild_nodes = xml.getElementsByTagName("guildHeader")
-        guild_node = guild_nodes[0]
+    def _parse_guild(self, parsed, site, get_characters=False):
+        """Parse a guild page, given its XMLStream.ParsedPage."""
+        guild_node = parsed.first("guildHeader")
 
-        name = guild_node.attributes["name"].value
-        realm = guild_node.attributes["realm"].value
+        name = guild_node["name"]
+        realm = guild_node["realm"]
         site = site
         guild = Guild(name, realm, site)
         log.info("Creating guild " + unicode(guild).encode("utf-8"))
@@ -605,7 +935,7 @@ class GuildParser(Parser):
         # cflewis | 2009-03-28 | Now need to put in guild's characters
         if get_characters:
             log.debug("Parsing guild character")
-            characters = self._parse_guild_characters(name, realm, site)
+            characters = self._parse_guild_characters(name, realm, site, parsed)
             #guild.characters = characters
         else:
             log.debug("Not parsing guild characters")
@@ -616,38 +946,112 @@ class GuildParser(Parser):
 
         return guild
 
-    def _parse_guild_characters(self, name, realm, site):
-        """Page through a guild, creating characters."""
+    def _parse_guild_characters(self, name, realm, site, parsed=None):
+        """Page through a guild, creating characters. parsed is the first
+        page of the guild, if it has been downloaded already. Each page's
+        characters are made as soon as the page arrives.
+        
+        """
         character_list = []
+        # One character parser makes every page's characters
+        cp = CharacterParser(downloader=self._downloader)
 
-        log.debug(name + " " + realm + ": Downloading guild page")
-
-        source = self._download_url( \
-            WoWSpyderLib.get_guild_url(name, realm, site, page=1))
-
-        character_list.append(self._parse_guild_file(StringIO.StringIO(source), site))
+        for page in self._get_guild_pages(name, realm, site, parsed):
+            character_list.append(self._parse_guild_file(page, site, cp))
 
         return WoWSpyderLib.merge(character_list)
+        
+    def _get_guild_pages(self, name, realm, site, parsed=None, roster=None):
+        """Yield the XMLStream.ParsedPage of each page of a guild's roster.
+        parsed is the first page, if it has been downloaded already. Once
+        the first page says how many there are, the rest are asked for
+        together and yielded as they arrive. Pages that fail are recorded
+        to be retried, and skipped.
+        
+        Each page is added to roster, a new GuildRoster unless one is
+        given, as it goes by. The roster is kept from the first page on,
+        so ranks can be looked up while the rest are still downloading.
+        
+        """
+        if parsed is None:
+            log.debug(name + " " + realm + ": Downloading guild page")
+            parsed = self._download_url( \
+                WoWSpyderLib.get_guild_url(name, realm, site, page=1)).parsed()
+                
+        max_pages = parsed.max_pages or 1
+        futures = {}
+        
+        if max_pages > 1:
+            log.debug(name + " " + realm + ": Downloading " + \
+                str(max_pages - 1) + " more guild pages")
+        
+        # Asked for before the first page is handed over, so they download
+        # while its characters are being made
+        for page in range(2, max_pages + 1):
+            futures[self._downloader.submit(WoWSpyderLib.get_guild_url( \
+                name, realm, site, page=page))] = page
+                
+        if roster is None:
+            roster = GuildRoster.GuildRoster(name, realm, site)
+            
+        GuildRoster.store(roster.add_page(parsed))
+        yield parsed
+                
+        for future in DownloadFuture.as_completed(futures.keys()):
+            page = futures[future]
+            error = future.exception()
+            source = None
+            
+            if error is None:
+                source = future.result()
+            
+            try:
+                source = self._check_download(source, error)
+            except Exception, e:
+                log.warning("Couldn't get page " + str(page) + " of guild " + \
+                    name + ", continuing. ERROR: " + str(e))
+                self._defer(self.entity, [name, realm, site, page], e)
+                continue
+                
+            roster.add_page(source.parsed())
+            yield source.parsed()
 
-    def _parse_guild_file(self, xml_file_object, site):
-        """Create characters from a single guild page."""
-        xml = minidom.parse(xml_file_object)
-        guild_nodes = xml.getElementsByTagName("guildHeader")
-        guild_node = guild_nodes[0]
-        cp = CharacterParser(downloader=self._downloader)
+    def _parse_guild_file(self, parsed, site, cp=None):
+        """Create characters from a single guild page, given its
+        XMLStream.ParsedPage, with the CharacterParser cp if there is one.
         
-        realm = guild_node.attributes["realm"].value
+        """
+        guild_node = parsed.first("guildHeader")
+        if cp is None: cp = CharacterParser(downloader=self._downloader)
         
-        character_nodes = xml.getElementsByTagName("character")
+        realm = guild_node["realm"]
+        
+        character_nodes = parsed.all("character")
         characters = []
         
+        if self.crawl_mode == STUB_CRAWL:
+            return cp.stub_characters([make_listing(node, realm, \
+                faction=FACTIONS.get(guild_node.get("faction")), \
+                guild=guild_node["name"], guild_rank=int(node["rank"])) \
+                for node in character_nodes], site)
+        
+        # Ask for the whole roster's character sheets up front, so they
+        # download together while the characters are made one by one.
+        # Characters the Armory has said it doesn't have are left out.
+        names = [node["name"] for node in character_nodes]
+        self._downloader.download_many([WoWSpyderLib.get_character_sheet_url( \
+            name, realm, site) for name in names \
+            if NegativeCache.lookup(cp.entity, \
+            NegativeCache.make_key(name, realm, site)) is None])
+        
         for character_node in character_nodes:
-            name = character_node.attributes["name"].value
+            name = character_node["name"]
             
             try:
                 character = cp.get_character(name, realm, site)
             except Exception, e:
                 log.warning("Couldn't get character " + name + ", continuing. ERROR: " + str(e))
+                self._defer(cp.entity, [name, realm, site], e)
                 continue
             else:
                 characters.append(character)
@@ -667,16 +1071,44 @@ class GuildParser(Parser):
         in a guild.
         
         """
-        source = self._download_url( \
-            WoWSpyderLib.get_guild_url(guild_name, realm, site, page=1))
-
-        guild_rank_search = re.search("name=\"" + character_name + \
-            "\".*rank=\"(\d*)\"", unicode(source, "utf-8"))
-        if guild_rank_search:
-            return int(guild_rank_search.group(1))
-
-        raise IOError("No character in that guild")
+        rank = self.get_roster(guild_name, realm, site).get_rank(character_name)
+        
+        if rank is None:
+            raise IOError("No character in that guild")
+            
+        return rank
+        
+    def get_roster(self, name, realm, site):
+        """Returns the GuildRoster of a guild, downloading the guild's page
+        only if its roster wasn't built recently.
+        
+        """
+        roster = GuildRoster.lookup(name, realm, site)
+        
+        if roster is None:
+            roster = GuildRoster.GuildRoster(name, realm, site)
+            
+            # Reading every page builds and keeps the roster
+            for page in self._get_guild_pages(name, realm, site, roster=roster):
+                pass
+            
+        return roster
+        
+    def redo(self, name, realm, site, page=None):
+        """Redo a guild, or a page of its roster, that failed."""
+        if page is None:
+            return self.get_guild(name, realm, site, get_characters=False)
+            
+        parsed = self._download_url( \
+            WoWSpyderLib.get_guild_url(name, realm, site, page=page)).parsed()
+        roster = GuildRoster.lookup(name, realm, site)
+        
+        if roster is not None:
+            roster.add_page(parsed)
+            
+        return self._parse_guild_file(parsed, site)
 
+DeadLetter.register(GuildParser.entity, GuildParser)
 
 class Guild(Base):
     """A guild."""
@@ -767,6 +1199,25 @@ class Guild(Base):
 #         guild2 = guild1.refresh()
 #         
 #         self.assertEqual(guild1, guild2)
+
+class GuildCrawlTests(unittest.TestCase):
+    def setUp(self):
+        import ArmoryStandIn
+        self.stand_in = ArmoryStandIn.ArmoryStandIn().start().use()
+        self.gp = GuildParser(crawl_mode=FULL_CRAWL)
+        
+    def tearDown(self):
+        GuildRoster.clear()
+        self.stand_in.stop()
+        
+    def testEveryPageSaved(self):
+        # Long Roster has Moulin on its first page and Shirley on its second
+        characters = self.gp._parse_guild_characters(u"Long Roster", \
+            u"Ravenholdt", u"us")
+        self.assertEqual(sorted([c.name for c in characters]), \
+            [u"Moulin", u"Shirley"])
+        self.assertTrue(Database.session().query(Character).get( \
+            (u"Shirley", u"Ravenholdt", u"us")) is not None)
         
 if __name__ == '__main__':
     unittest.main()
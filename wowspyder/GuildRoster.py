@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+GuildRoster.py
+
+Indexes of guild rosters, kept for the guilds crawled most recently, so
+the rank of each member can be looked up without downloading and
+searching the guild's page once for every member.
+
+Copyright (c) 2009, Regents of the University of California
+All rights reserved.
+"""
+
+import sys
+import os
+import unittest
+import time
+import threading
+import collections
+import StringIO
+import XMLStream
+import Logger
+
+log = Logger.log()
+
+# How many guilds' rosters are kept, and how many seconds a roster is used
+# for before the guild page is downloaded again.
+MAX_GUILDS = 500
+MAX_AGE = 60 * 60
+
+class Member(object):
+    """A character as the guild's roster lists them."""
+    def __init__(self, name, rank, character_class, level):
+        self.name = name
+        self.rank = rank
+        self.character_class = character_class
+        self.level = level
+
+    def __repr__(self):
+        return unicode("<Member('%s','%d')>" % (self.name, self.rank))
+
+
+class GuildRoster(object):
+    """The members of a guild, by name, from one or more of its pages."""
+    def __init__(self, name, realm, site):
+        self.name = name
+        self.realm = realm
+        self.site = site
+        self.built = time.time()
+        self._members = {}
+
+    def add_page(self, parsed):
+        """Add the members listed on parsed, the XMLStream.ParsedPage of a
+        page of the guild. Returns the roster.
+
+        """
+        for node in parsed.all("character"):
+            try:
+                member = Member(node["name"], int(node["rank"]), \
+                    node.get("class"), int(node.get("level", 0)))
+            except (KeyError, ValueError), e:
+                log.debug("Skipping roster entry without a name or rank")
+                continue
+
+            self._members[member.name] = member
+
+        return self
+
+    def get(self, name):
+        """Return the Member called name, or None."""
+        return self._members.get(name)
+
+    def get_rank(self, name):
+        """Return the rank of the member called name, or None."""
+        member = self._members.get(name)
+
+        if member is None:
+            return None
+
+        return member.rank
+
+    @property
+    def key(self):
+        return (self.name, self.realm, self.site)
+
+    def __contains__(self, name):
+        return name in self._members
+
+    def __len__(self):
+        return len(self._members)
+
+    def __repr__(self):
+        return unicode("<GuildRoster('%s','%s','%s','%d')>" % (self.name, \
+            self.realm, self.site, len(self)))
+
+
+class LRUCache(object):
+    """A mapping holding at most max_size entries. Adding one more throws
+    away the one used longest ago.
+
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            # Put it back as the most recently used
+            self._entries[key] = value
+            self.hits += 1
+            return value
+        finally:
+            self._lock.release()
+
+    def put(self, key, value):
+        self._lock.acquire()
+        try:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            self._evict()
+        finally:
+            self._lock.release()
+
+    def remove(self, key):
+        self._lock.acquire()
+        try:
+            self._entries.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def resize(self, max_size):
+        self._lock.acquire()
+        try:
+            self.max_size = max_size
+            self._evict()
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+        finally:
+            self._lock.release()
+
+    def _evict(self):
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_rosters = LRUCache(MAX_GUILDS)
+_max_age = MAX_AGE
+
+def configure(max_guilds=MAX_GUILDS, max_age=MAX_AGE):
+    """Set how many guilds' rosters are kept and for how long. The rosters
+    already kept stay, unless there are now too many of them.
+
+    """
+    global _max_age
+    _rosters.resize(max_guilds)
+    _max_age = max_age
+
+def lookup(name, realm, site):
+    """Return the roster of the guild if one was built recently enough,
+    or None.
+
+    """
+    roster = _rosters.get((name, realm, site))
+
+    if roster is None or time.time() - roster.built > _max_age:
+        return None
+
+    return roster
+
+def store(roster):
+    """Keep roster, replacing any the guild had before."""
+    log.debug("Keeping roster " + unicode(roster).encode("utf-8"))
+    _rosters.put(roster.key, roster)
+
+def forget(name, realm, site):
+    _rosters.remove((name, realm, site))
+
+def clear():
+    _rosters.clear()
+
+
+class GuildRosterTests(unittest.TestCase):
+    def setUp(self):
+        self.page = "<page><guildInfo><guildHeader name=\"Wandering Shadows\" " + \
+            "realm=\"Ravenholdt\"/><guild><members maxPage=\"1\">" + \
+            "<character class=\"Priest\" level=\"80\" name=\"Moulin\" rank=\"2\"/>" + \
+            "<character class=\"Rogue\" level=\"71\" name=\"Sk\xc3\xa5di\" rank=\"4\"/>" + \
+            "<character name=\"Nobody\"/>" + \
+            "</members></guild></guildInfo></page>"
+        clear()
+
+    def tearDown(self):
+        configure()
+        clear()
+
+    def roster(self, name=u"Wandering Shadows"):
+        parsed = XMLStream.ParsedPage(StringIO.StringIO(self.page))
+        return GuildRoster(name, u"Ravenholdt", u"us").add_page(parsed)
+
+    def testRoster(self):
+        roster = self.roster()
+        self.assertEqual(len(roster), 2)
+        self.assertEqual(roster.get_rank(u"Moulin"), 2)
+        self.assertEqual(roster.get_rank(u"Sk\xe5di"), 4)
+        self.assertEqual(roster.get(u"Sk\xe5di").level, 71)
+        self.assertEqual(roster.get_rank(u"Nobody"), None)
+
+    def testStore(self):
+        store(self.roster())
+        self.assertEqual(lookup(u"Wandering Shadows", u"Ravenholdt", \
+            u"us").get_rank(u"Moulin"), 2)
+        self.assertEqual(lookup(u"Wandering Shadows", u"Mug'Thol", u"us"), None)
+
+    def testEviction(self):
+        configure(max_guilds=2)
+
+        for name in (u"First", u"Second", u"Third"):
+            store(self.roster(name))
+
+            # Using the first keeps it from being thrown away
+            lookup(u"First", u"Ravenholdt", u"us")
+
+        self.assertTrue(lookup(u"First", u"Ravenholdt", u"us") is not None)
+        self.assertEqual(lookup(u"Second", u"Ravenholdt", u"us"), None)
+        self.assertTrue(lookup(u"Third", u"Ravenholdt", u"us") is not None)
+
+    def testMaxAge(self):
+        configure(max_age=0)
+        roster = self.roster()
+        roster.built -= 1
+        store(roster)
+        self.assertEqual(lookup(u"Wandering Shadows", u"Ravenholdt", u"us"), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -11,7 +11,6 @@ import sys
 import os
 import unittest
 from Parser import Parser
-from xml.dom import minidom
 import Database
 import Logger
 import datetime
@@ -23,29 +22,25 @@ from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relation, backref
 from Enum import Enum
 import urllib2
-import StringIO
 import re
+import NegativeCache
+import DeadLetter
 
 log = Logger.log()
 
 Base = Database.get_base()
 
 class ItemParser(Parser):
+    entity = "item"
+    
     def __init__(self, downloader=None):
         '''Initialize the team parser.'''
         log.debug("Creating ItemParser with " + str(downloader))
         Parser.__init__(self, downloader=downloader)
         
-    def _check_download(self, source, exception):
-        if exception:
-            log.error("Unable to download item file")
-            raise exception
-            
-        if re.search("itemInfo/", source):
-            log.error("Item was invalid or not returned")
-            raise IOError("Item requested was invalid or not returned")
-        
-        return source
+    def _is_missing(self, parsed):
+        # An empty itemInfo element means there's no such item
+        return parsed.first("item") is None
         
     def get_item(self, item_id, cached=True):
         """Returns an item object.
@@ -65,29 +60,28 @@ class ItemParser(Parser):
             
         # cflewis | 2009-04-02 | If downloading fails, the whole team
         # couldn't be found, so the exception should propagate up.
-        source = self._download_url(WoWSpyderLib.get_item_url(item_id))
-        item = self._parse_item(StringIO.StringIO(source))
+        source = self._download_entity(WoWSpyderLib.get_item_url(item_id), \
+            NegativeCache.make_key(item_id))
+        item = self._parse_item(source.parsed())
         
         return item
         
-    def _parse_item(self, xml_file_object):
-        """Parse an item."""
+    def _parse_item(self, parsed):
+        """Parse an item, given its XMLStream.ParsedPage."""
         log.debug("Parsing item...")
-        xml = minidom.parse(xml_file_object)
-        item_nodes = xml.getElementsByTagName("item")
-        item_node = item_nodes[0]
+        item_node = parsed.first("item")
+        
+        if item_node is None:
+            raise IndexError("No item element in the page")
         
-        item_id = int(item_node.attributes["id"].value)
-        level = int(item_node.attributes["level"].value)
-        name = item_node.attributes["name"].value
-        quality = int(item_node.attributes["quality"].value)
-        item_type = item_node.attributes["type"].value
+        item_id = int(item_node["id"])
+        level = int(item_node["level"])
+        name = item_node["name"]
+        quality = int(item_node["quality"])
+        item_type = item_node["type"]
 
         try:
-            cost_nodes = item_node.getElementsByTagName("cost")
-            cost_node = cost_nodes[0]
-        
-            sell_price = cost_node.attributes["sellPrice"].value
+            sell_price = parsed.first("cost")["sellPrice"]
         except Exception, e:
             # cflewis | 2009-04-06 | No sell price available
             sell_price = None
@@ -98,12 +92,22 @@ class ItemParser(Parser):
         Database.insert(item)
 
         return item
+        
+    def redo(self, item_id):
+        """Redo an item that failed."""
+        return self.get_item(item_id, cached=False)
 
+DeadLetter.register(ItemParser.entity, ItemParser)
 
 class ItemParserTests(unittest.TestCase):
     def setUp(self):
+        import ArmoryStandIn
+        self.stand_in = ArmoryStandIn.ArmoryStandIn().start().use()
         self.ip = ItemParser()
         
+    def tearDown(self):
+        self.stand_in.stop()
+        
     def testGetItem(self):
         item = self.ip.get_item(38237)
         self.assertEqual("Axe of Frozen Death", item.name)
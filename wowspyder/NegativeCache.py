@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+NegativeCache.py
+
+Remembers characters, guilds, teams and items the Armory has said it
+doesn't have, so they aren't asked for again on every team page, guild
+roster and refresh pass.
+
+Copyright (c) 2009, Regents of the University of California
+All rights reserved.
+"""
+
+import sys
+import os
+import unittest
+import datetime
+import Database
+import Logger
+from sqlalchemy import Table, Column, DateTime, Unicode, Integer
+
+log = Logger.log()
+
+Base = Database.get_base()
+
+# The Armory answered with a page saying it doesn't have the entity.
+MISSING = u"missing"
+# The Armory answered with a 404.
+NOT_FOUND = u"not-found"
+
+# How long, in seconds, each kind of failure is remembered for. Characters
+# that are missing have usually been deleted, transferred or renamed, but
+# a 404 is as likely to be the Armory having a bad day.
+DEFAULT_TTLS = {
+    MISSING: 3 * 24 * 60 * 60,
+    NOT_FOUND: 6 * 60 * 60,
+}
+
+_ttls = dict(DEFAULT_TTLS)
+
+def configure(ttls=None):
+    """Set how long each kind of failure is remembered, overriding the
+    defaults in DEFAULT_TTLS.
+
+    """
+    _ttls.clear()
+    _ttls.update(DEFAULT_TTLS)
+
+    if ttls:
+        _ttls.update(ttls)
+
+def make_key(*parts):
+    """Return the key for an entity from the parts of its primary key."""
+    return u"/".join([unicode(part) for part in parts])
+
+def lookup(entity, key):
+    """Return the MissingEntity for key if the Armory said it doesn't have
+    it recently enough for that to still hold, or None.
+
+    """
+    missing = Database.session().query(MissingEntity).get((entity, key))
+
+    if missing is None or missing.expires <= datetime.datetime.now():
+        return None
+
+    return missing
+
+def record(entity, key, reason, url=None):
+    """Remember that the Armory doesn't have the entity at key, for as
+    long as reason's TTL.
+
+    """
+    now = datetime.datetime.now()
+    missing = Database.session().query(MissingEntity).get((entity, key))
+
+    if missing is None:
+        missing = MissingEntity(entity, key, reason, url)
+
+    missing.reason = reason
+    missing.url = url
+    missing.failures = (missing.failures or 0) + 1
+    missing.last_seen = now
+    missing.expires = now + datetime.timedelta(seconds=_ttls[reason])
+    log.info("Remembering %s %s as %s until %s" % (entity, \
+        key.encode("utf-8"), reason, missing.expires))
+    Database.insert(missing)
+
+def forget(entity, key):
+    """Forget that the Armory didn't have the entity at key."""
+    session = Database.session()
+    session.query(MissingEntity).filter(MissingEntity.entity == entity) \
+        .filter(MissingEntity.entity_key == key).delete()
+    session.commit()
+
+def purge():
+    """Delete everything that has expired, returning how many there were."""
+    session = Database.session()
+    count = session.query(MissingEntity) \
+        .filter(MissingEntity.expires <= datetime.datetime.now()).delete()
+    session.commit()
+    return count
+
+
+class MissingEntity(Base):
+    """Something the Armory said it doesn't have."""
+    __table__ = Table("MISSING_ENTITY", Base.metadata,
+        Column("entity", Unicode(20), primary_key=True),
+        Column("entity_key", Unicode(300), primary_key=True),
+        Column("reason", Unicode(20)),
+        Column("url", Unicode(500)),
+        Column("failures", Integer()),
+        Column("first_seen", DateTime(), default=datetime.datetime.now),
+        Column("last_seen", DateTime()),
+        Column("expires", DateTime(), index=True),
+        mysql_charset="utf8",
+        mysql_engine="InnoDB"
+    )
+
+    def __init__(self, entity, entity_key, reason, url=None):
+        self.entity = entity
+        self.entity_key = entity_key
+        self.reason = reason
+        self.url = url
+        self.failures = 0
+
+    def __repr__(self):
+        return unicode("<MissingEntity('%s','%s','%s')>" % (self.entity, \
+            self.entity_key, self.reason))
+
+
+class NegativeCacheTests(unittest.TestCase):
+    def setUp(self):
+        Base.metadata.create_all(Database.engine)
+        self.key = make_key(u"Nobody", u"Ravenholdt", u"us")
+        forget(u"character", self.key)
+
+    def tearDown(self):
+        forget(u"character", self.key)
+        configure()
+
+    def testRecord(self):
+        self.assertEqual(lookup(u"character", self.key), None)
+        record(u"character", self.key, MISSING)
+        self.assertEqual(lookup(u"character", self.key).reason, MISSING)
+        self.assertEqual(lookup(u"guild", self.key), None)
+
+    def testExpires(self):
+        configure({NOT_FOUND: 0})
+        record(u"character", self.key, NOT_FOUND)
+        self.assertEqual(lookup(u"character", self.key), None)
+        self.assertTrue(purge() >= 1)
+
+    def testFailuresCounted(self):
+        record(u"character", self.key, NOT_FOUND)
+        record(u"character", self.key, MISSING)
+        self.assertEqual(lookup(u"character", self.key).failures, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -10,29 +10,114 @@ Copyright (c) 2009 Chris Lewis. All rights reserved.
 import sys
 import os
 import unittest
+import urllib2
+import threading
 import Database
 import XMLDownloader
+import AsyncDownloader
+import ResponseCache
+import RateLimiter
+import ConcurrencyController
+import CircuitBreaker
 import Preferences
+import WoWSpyderLib
+import DownloadFuture
+import ArmoryPage
+import NegativeCache
+import GuildRoster
+import FetchProfile
+import RetryPolicy
+import DeadLetter
 import Logger
 
 Base = Database.get_base()
 log = Logger.log()
 
+# The rate limiters, concurrency windows, circuit breakers and response
+# caches are shared by the whole process, so they're set up from the
+# preferences by the first downloader made, not reset by every later one
+_shared_lock = threading.Lock()
+_shared_configured = False
+_configured_caches = set()
+
+def _configure_shared(prefs, max_in_flight):
+    """Configure what every downloader shares from prefs, the first time
+    it's called, and return the response cache to use. A cache is only
+    given its size and TTLs the first time it's seen.
+
+    """
+    global _shared_configured
+    _shared_lock.acquire()
+
+    try:
+        if not _shared_configured:
+            RateLimiter.configure(rate=prefs.rate_limit, \
+                burst=prefs.rate_burst, path=prefs.rate_limit_file)
+            # The threads (or async slots) are only an upper bound; how
+            # many requests are really out is up to how the Armory is coping.
+            ConcurrencyController.configure(initial=prefs.initial_concurrency, \
+                maximum=max_in_flight)
+            CircuitBreaker.configure(failures=prefs.circuit_failures, \
+                reset_time=prefs.circuit_reset_time)
+            _shared_configured = True
+
+        cache = ResponseCache.get_cache(prefs.cache_path)
+
+        if cache.path not in _configured_caches:
+            cache.configure(max_bytes=prefs.cache_max_bytes, \
+                ttls=prefs.cache_ttls)
+            _configured_caches.add(cache.path)
+
+        return cache
+    finally:
+        _shared_lock.release()
+
+class MissingEntityError(IOError):
+    """The Armory answered, but doesn't have the character, guild, team,
+    item or realm that was asked for, so asking again won't help.
+    
+    """
+    def __init__(self, entity, url):
+        IOError.__init__(self, entity.capitalize() + \
+            " requested was invalid or not returned")
+        self.entity = entity
+        self.url = url
+
+
 class Parser(object):
-    def __init__(self, number_of_threads=20, sleep_time=2, downloader=None, \
+    # What the parser makes. Subclasses set this.
+    entity = "page"
+    
+    def __init__(self, number_of_threads=20, downloader=None, \
             no_downloader=False):
+        self._prefs = Preferences.Preferences()
         self._downloader = downloader
+        # Only a downloader the parser made is closed with it, as one that
+        # was handed in is shared with other parsers
+        self._owns_downloader = False
+        
+        for site, url in (self._prefs.site_urls or {}).items():
+            WoWSpyderLib.set_site_url(site, url)
+            
+        NegativeCache.configure(self._prefs.negative_cache_ttls)
+        GuildRoster.configure(self._prefs.roster_cache_guilds, \
+            self._prefs.roster_max_age)
+        FetchProfile.configure(self._prefs.fetch_profiles, \
+            self._prefs.fetch_profile)
 
-        if self._downloader is None:
+        if self._downloader is None and not no_downloader:
             log.debug("Creating new downloader...")
-            self._downloader = XMLDownloader.XMLDownloaderThreaded( \
-                number_of_threads=number_of_threads, sleep_time=sleep_time)
+            self._downloader = self._create_downloader( \
+                number_of_threads=number_of_threads)
+            self._owns_downloader = True
 
         self._session = Database.session()
         Base.metadata.create_all(Database.engine)
-        self._prefs = Preferences.Preferences()
         
     def __del__(self):
+        if not getattr(self, "_owns_downloader", False):
+            return
+            
         try:
             self._downloader.close()
         except AttributeError, e:
@@ -40,38 +125,229 @@ class Parser(object):
         
     def _refresh_downloader(self):
         log.debug("Refreshing downloader")
-        self._downloader = XMLDownloader.XMLDownloaderThreaded( \
-            number_of_threads=20, sleep_time=2)
+        self._downloader = self._create_downloader(number_of_threads=20)
+        self._owns_downloader = True
+            
+    def _create_downloader(self, number_of_threads=20):
+        """Create the download engine chosen in the preferences."""
+        max_in_flight = self._prefs.max_in_flight
+        if max_in_flight is None: max_in_flight = number_of_threads
+        
+        cache = _configure_shared(self._prefs, max_in_flight)
+        
+        if self._prefs.download_engine == "async":
+            log.debug("Using the async download engine")
+            return AsyncDownloader.XMLDownloaderAsync( \
+                max_in_flight=max_in_flight, cache=cache, \
+                priorities=self._prefs.url_priorities, \
+                timeout=self._prefs.request_timeout, \
+                deadline=self._prefs.download_deadline)
+            
+        return XMLDownloader.XMLDownloaderThreaded( \
+            number_of_threads=number_of_threads, cache=cache, \
+            priorities=self._prefs.url_priorities, \
+            retry_policy=RetryPolicy.RetryPolicy( \
+            timeout=self._prefs.request_timeout, \
+            deadline=self._prefs.download_deadline), \
+            max_requests=self._prefs.thread_max_requests, \
+            max_memory_growth=self._prefs.thread_max_memory_growth)
         
-    def _download_url(self, url):
+    def _download_url(self, url, priority=None):
+        """Download url once and check it, returning the page, an
+        ArmoryPage.Page whose unchanged flag says if the Armory reported it
+        hasn't changed. Raises MissingEntityError if the Armory doesn't have
+        what was asked for, or whatever the download raised.
+        
+        """
         log.debug("Parser downloading " + url)
         source = None
         error = None
                 
         try:
-            source = self._downloader.download_url(url)
+            source = self._downloader.download_page(url, priority=priority)
         except Exception, e:
             log.warning("Parser downloading returned an exception " + str(e))
             error = e
             source = None
             
         log.debug("Parser returning download source...")
-        return self._check_download(self._downloader.download_url(url), error)
+        # Downloading again here would turn a "not modified" answer into
+        # an ordinary cache hit, hiding it from the parsers.
+        return self._check_download(source, error)
+        
+    def _download_entity(self, url, key, priority=None):
+        """_download_url for the page of the entity with NegativeCache key
+        key. If the Armory has said recently that it doesn't have the
+        entity, MissingEntityError is raised without asking it again, and
+        if it says so now, that's remembered.
+        
+        """
+        missing = NegativeCache.lookup(self.entity, key)
+        
+        if missing is not None:
+            log.debug("Armory didn't have %s %s last time, not asking " \
+                "again" % (self.entity, key.encode("utf-8")))
+            raise MissingEntityError(self.entity, url)
+        
+        try:
+            return self._download_url(url, priority=priority)
+        except MissingEntityError, e:
+            NegativeCache.record(self.entity, key, NegativeCache.MISSING, url)
+            raise
+        except urllib2.HTTPError, e:
+            if e.code == 404:
+                NegativeCache.record(self.entity, key, \
+                    NegativeCache.NOT_FOUND, url)
+            raise
+        
+    def _download_urls(self, urls, priority=None):
+        """Ask for all of urls at once, then yield each URL with its
+        checked source as the downloads finish, in whatever order that is.
+        Anything _check_download raises comes out of the loop.
+        
+        """
+        futures = {}
+        
+        for url in urls:
+            futures[self._downloader.submit(url, priority=priority)] = url
+            
+        for future in DownloadFuture.as_completed(futures.keys()):
+            error = future.exception()
+            source = None
+            
+            if error is None:
+                source = future.result()
+            else:
+                log.warning("Parser downloading returned an exception " + str(error))
+                
+            yield futures[future], self._check_download(source, error)
+        
+    def _defer(self, kind, args, error, url=None):
+        """Record work of kind, with arguments args, that failed with
+        error in the dead-letter store, for the retry pass to redo. Failures
+        retrying won't fix, like the Armory not having what was asked for,
+        aren't kept.
+        
+        """
+        if isinstance(error, MissingEntityError):
+            return
+            
+        if isinstance(error, urllib2.HTTPError) and error.code == 404:
+            return
+        
+        try:
+            DeadLetter.record(kind, args, error, url)
+        except Exception, e:
+            log.warning("Couldn't record failed " + kind + ". ERROR: " + str(e))
+            
+    def redo(self, *args):
+        """Redo work that failed, given the arguments it was recorded in
+        the dead-letter store with. Subclasses that record work implement
+        this.
+        
+        """
+        raise NotImplementedError("Can't redo " + self.entity + " work")
+        
+    def _is_unchanged(self, source):
+        """Returns True if the Armory said the page hasn't changed since it
+        was last downloaded, meaning whatever was made from it last time
+        is still good.
+        
+        """
+        return XMLDownloader.is_unchanged(source)
+        
+    def _is_missing(self, parsed):
+        """Returns True if parsed, the XMLStream.ParsedPage of a downloaded
+        page, says the Armory doesn't have what was asked for. Subclasses
+        override this, reading no further into the page than they must.
+        
+        """
+        return False
         
     def _check_download(self, source, exception):
-        """A virtual function that forces parsers to try and detect integrity
-        errors with the XML early, separating out error checking from the
-        logic when everything is fine. This should stop yucky exceptions
-        propagating down to the logic, which they have a habit of doing,
-        seeing how shaky the WoW Armory is.
+        """Detect integrity errors with the XML early, separating out error
+        checking from the logic when everything is fine. This should stop
+        yucky exceptions propagating down to the logic, which they have a
+        habit of doing, seeing how shaky the WoW Armory is.
+        
+        source is an ArmoryPage.Page. The check reads the page's parsed(),
+        which the parsers go on to read, so the page is tokenized once, and
+        a page that has been checked already isn't checked again.
+        Subclasses with other checks to make can override this.
         
         """
-        raise NotImplementedError("This should be implemented by the subclass!")
+        if exception:
+            log.error("Unable to download file for " + self.entity)
+            raise exception
+            
+        if source is None:
+            raise IOError("No " + self.entity + " page was downloaded")
+            
+        parsed = source.parsed()
+        
+        if self.entity not in parsed.checked:
+            if self._is_missing(parsed):
+                log.error(self.entity.capitalize() + " was invalid or not returned")
+                raise MissingEntityError(self.entity, source.url)
+                
+            parsed.checked.add(self.entity)
+            
+        return source
 
 
+class _CharacterChecker(Parser):
+    """Just the checks of a character parser, without a database."""
+    entity = "character"
+    
+    def __init__(self):
+        pass
+        
+    def _is_missing(self, parsed):
+        return parsed.attribute("characterInfo", "errCode") == "noCharacter"
+        
+
 class ParserTests(unittest.TestCase):
     def setUp(self):
-        pass
+        self.parser = _CharacterChecker()
+        self.url = "http://www.wowarmory.com/character-sheet.xml?r=Ravenholdt&n=Nobody"
+        
+    def testMissingEntity(self):
+        page = ArmoryPage.Page(self.url, \
+            data="<page><characterInfo errCode=\"noCharacter\"/></page>")
+        
+        try:
+            self.parser._check_download(page, None)
+        except MissingEntityError, e:
+            self.assertEqual(e.entity, "character")
+            self.assertEqual(e.url, self.url)
+        else:
+            self.fail("Expected a MissingEntityError")
+            
+    def testCheckedPage(self):
+        page = ArmoryPage.Page(self.url, data="<page><characterInfo/></page>")
+        self.assertTrue(self.parser._check_download(page, None) is page)
+        self.assertTrue("character" in page.parsed().checked)
+        
+    def testDownloadError(self):
+        self.assertRaises(ValueError, self.parser._check_download, None, \
+            ValueError("Bad response"))
+        self.assertRaises(IOError, self.parser._check_download, None, None)
+        
+    def testSharedConfiguredOnce(self):
+        import ArmoryStandIn
+        stand_in = ArmoryStandIn.ArmoryStandIn().start().use()
+        
+        try:
+            self.parser._prefs = Preferences.Preferences()
+            self.parser._prefs.cache_ttls = {"character-sheet": 60}
+            self.parser._create_downloader(number_of_threads=1).close()
+            cache = ResponseCache.get_cache()
+            cache.configure(ttls={"character-sheet": 5})
+            
+            self.parser._create_downloader(number_of_threads=1).close()
+            self.assertEqual(cache.ttls["character-sheet"], 5)
+        finally:
+            stand_in.stop()
 
 
 if __name__ == '__main__':
@@ -36,8 +36,291 @@ class Preferences(object):
     def set_database_url(self, value):
         self.__options__["database_url"] = value
         
+    def get_download_engine(self):
+        """Either "threaded" (the default) or "async"."""
+        return self.__options__.get("download_engine", "threaded")
+        
+    def set_download_engine(self, value):
+        self.__options__["download_engine"] = value
+        
+    def get_max_in_flight(self):
+        """How many requests the async engine keeps on the wire. None
+        means the same as the number of threads the threaded engine would
+        have used.
+        
+        """
+        return self.__options__.get("max_in_flight", None)
+        
+    def set_max_in_flight(self, value):
+        self.__options__["max_in_flight"] = value
+        
+    def get_cache_path(self):
+        """Where the response cache lives. None means the user's cache
+        directory, ~/.cache/wowspyder.
+        
+        """
+        return self.__options__.get("cache_path", None)
+        
+    def set_cache_path(self, value):
+        self.__options__["cache_path"] = value
+        
+    def get_cache_max_bytes(self):
+        return self.__options__.get("cache_max_bytes", None)
+        
+    def set_cache_max_bytes(self, value):
+        self.__options__["cache_max_bytes"] = value
+        
+    def get_cache_ttls(self):
+        """Seconds each type of page stays fresh in the cache, overriding
+        the defaults in ResponseCache, e.g. {"character-sheet": 600}.
+        
+        """
+        return self.__options__.get("cache_ttls", None)
+        
+    def set_cache_ttls(self, value):
+        self.__options__["cache_ttls"] = value
+        
+    def get_rate_limit(self):
+        """Requests per second allowed to each Armory host."""
+        return self.__options__.get("rate_limit", 5.0)
+        
+    def set_rate_limit(self, value):
+        self.__options__["rate_limit"] = value
+        
+    def get_rate_burst(self):
+        return self.__options__.get("rate_burst", 10)
+        
+    def set_rate_burst(self, value):
+        self.__options__["rate_burst"] = value
+        
+    def get_rate_limit_file(self):
+        """A file for sharing the rate limit between processes on this
+        host. None keeps the limit to this process.
+        
+        """
+        return self.__options__.get("rate_limit_file", None)
+        
+    def set_rate_limit_file(self, value):
+        self.__options__["rate_limit_file"] = value
+        
+    def get_initial_concurrency(self):
+        """How many requests to each host are allowed out at once before
+        the Armory's responses have shown how many it will take. The
+        window never grows past the number of threads (or max_in_flight).
+        
+        """
+        return self.__options__.get("initial_concurrency", 4)
+        
+    def set_initial_concurrency(self, value):
+        self.__options__["initial_concurrency"] = value
+        
+    def get_url_priorities(self):
+        """Priority classes for types of page, overriding the defaults in
+        WoWSpyderLib, e.g. {"character-statistics": 5}. Lower goes first.
+        
+        """
+        return self.__options__.get("url_priorities", None)
+        
+    def set_url_priorities(self, value):
+        self.__options__["url_priorities"] = value
+        
+    def get_site_urls(self):
+        """Armories to use instead of wowarmory.com, keyed on site, e.g.
+        {"us": "http://localhost:8080/us/"} for an ArmoryStandIn.
+        
+        """
+        return self.__options__.get("site_urls", None)
+        
+    def set_site_urls(self, value):
+        self.__options__["site_urls"] = value
+        
+    def get_stats_interval(self):
+        """How often, in seconds, a summary of the download stats is
+        logged while crawling. None turns the summary off.
+        
+        """
+        return self.__options__.get("stats_interval", 300)
+        
+    def set_stats_interval(self, value):
+        self.__options__["stats_interval"] = value
+        
+    def get_negative_cache_ttls(self):
+        """Seconds the Armory saying it doesn't have a character, guild,
+        team or item is remembered, overriding the defaults in
+        NegativeCache, e.g. {"not-found": 3600}.
+        
+        """
+        return self.__options__.get("negative_cache_ttls", None)
+        
+    def set_negative_cache_ttls(self, value):
+        self.__options__["negative_cache_ttls"] = value
+        
+    def get_request_timeout(self):
+        """Seconds a request to the Armory can go without an answer before
+        it's given up on and retried.
+        
+        """
+        return self.__options__.get("request_timeout", 60)
+        
+    def set_request_timeout(self, value):
+        self.__options__["request_timeout"] = value
+        
+    def get_download_deadline(self):
+        """Seconds after which a download is no longer retried, however
+        many retries it has left. None leaves it to the retries.
+        
+        """
+        return self.__options__.get("download_deadline", None)
+        
+    def set_download_deadline(self, value):
+        self.__options__["download_deadline"] = value
+        
+    def get_thread_max_requests(self):
+        """How many requests a download thread makes before it's replaced
+        with a fresh one. None keeps threads for as long as they last.
+        
+        """
+        return self.__options__.get("thread_max_requests", 5000)
+        
+    def set_thread_max_requests(self, value):
+        self.__options__["thread_max_requests"] = value
+        
+    def get_thread_max_memory_growth(self):
+        """How many bytes the process can grow by before the download
+        threads are all replaced. None never replaces them for that.
+        
+        """
+        return self.__options__.get("thread_max_memory_growth", None)
+        
+    def set_thread_max_memory_growth(self, value):
+        self.__options__["thread_max_memory_growth"] = value
+        
+    def get_dead_letter_interval(self):
+        """How often, in seconds, failed work is looked at to see if any
+        of it is due a retry. None leaves it for the next crawl.
+        
+        """
+        return self.__options__.get("dead_letter_interval", 60)
+        
+    def set_dead_letter_interval(self, value):
+        self.__options__["dead_letter_interval"] = value
+        
+    def get_roster_cache_guilds(self):
+        """How many guilds' rosters are kept for looking up their members'
+        ranks.
+        
+        """
+        return self.__options__.get("roster_cache_guilds", 500)
+        
+    def set_roster_cache_guilds(self, value):
+        self.__options__["roster_cache_guilds"] = value
+        
+    def get_roster_max_age(self):
+        """Seconds a guild's roster is used for before the guild's page is
+        downloaded again to look up a rank.
+        
+        """
+        return self.__options__.get("roster_max_age", 3600)
+        
+    def set_roster_max_age(self, value):
+        self.__options__["roster_max_age"] = value
+        
+    def get_crawl_mode(self):
+        """How guild and team rosters are crawled: "full" downloads every
+        member's character sheet, "stub" makes characters from the roster
+        and queues for a deep fetch only those that need their sheets.
+        
+        """
+        return self.__options__.get("crawl_mode", u"full")
+        
+    def set_crawl_mode(self, value):
+        self.__options__["crawl_mode"] = value
+        
+    def get_deep_fetch_max_age(self):
+        """Seconds after a character's sheet was last downloaded that a
+        stub crawl queues it to be downloaded again.
+        
+        """
+        return self.__options__.get("deep_fetch_max_age", 7 * 24 * 60 * 60)
+        
+    def set_deep_fetch_max_age(self, value):
+        self.__options__["deep_fetch_max_age"] = value
+        
+    def get_fetch_profile(self):
+        """The FetchProfile characters are downloaded with unless another
+        is asked for: "full", "gear" (sheet, items and talents), "sheet"
+        or one of fetch_profiles.
+        
+        """
+        return self.__options__.get("fetch_profile", u"full")
+        
+    def set_fetch_profile(self, value):
+        self.__options__["fetch_profile"] = value
+        
+    def get_fetch_profiles(self):
+        """FetchProfiles to add to the built in ones, keyed on name, e.g.
+        {"raid": {"statistics": [14807], "achievements": False}}.
+        
+        """
+        return self.__options__.get("fetch_profiles", None)
+        
+    def set_fetch_profiles(self, value):
+        self.__options__["fetch_profiles"] = value
+        
+    def get_circuit_failures(self):
+        """How many 5xx answers, timeouts or refused connections in a row
+        from an Armory host stop requests being sent to it for a while.
+        
+        """
+        return self.__options__.get("circuit_failures", 5)
+        
+    def set_circuit_failures(self, value):
+        self.__options__["circuit_failures"] = value
+        
+    def get_circuit_reset_time(self):
+        """Seconds a failing host is left alone before it is tried again."""
+        return self.__options__.get("circuit_reset_time", 60)
+        
+    def set_circuit_reset_time(self, value):
+        self.__options__["circuit_reset_time"] = value
+        
     refresh_all = property(get_refresh_all, set_refresh_all)
     database_url = property(get_database_url, set_database_url)
+    download_engine = property(get_download_engine, set_download_engine)
+    max_in_flight = property(get_max_in_flight, set_max_in_flight)
+    cache_path = property(get_cache_path, set_cache_path)
+    cache_max_bytes = property(get_cache_max_bytes, set_cache_max_bytes)
+    cache_ttls = property(get_cache_ttls, set_cache_ttls)
+    rate_limit = property(get_rate_limit, set_rate_limit)
+    rate_burst = property(get_rate_burst, set_rate_burst)
+    rate_limit_file = property(get_rate_limit_file, set_rate_limit_file)
+    initial_concurrency = property(get_initial_concurrency, \
+        set_initial_concurrency)
+    url_priorities = property(get_url_priorities, set_url_priorities)
+    site_urls = property(get_site_urls, set_site_urls)
+    stats_interval = property(get_stats_interval, set_stats_interval)
+    negative_cache_ttls = property(get_negative_cache_ttls, \
+        set_negative_cache_ttls)
+    request_timeout = property(get_request_timeout, set_request_timeout)
+    download_deadline = property(get_download_deadline, \
+        set_download_deadline)
+    thread_max_requests = property(get_thread_max_requests, \
+        set_thread_max_requests)
+    thread_max_memory_growth = property(get_thread_max_memory_growth, \
+        set_thread_max_memory_growth)
+    dead_letter_interval = property(get_dead_letter_interval, \
+        set_dead_letter_interval)
+    roster_cache_guilds = property(get_roster_cache_guilds, \
+        set_roster_cache_guilds)
+    roster_max_age = property(get_roster_max_age, set_roster_max_age)
+    crawl_mode = property(get_crawl_mode, set_crawl_mode)
+    deep_fetch_max_age = property(get_deep_fetch_max_age, \
+        set_deep_fetch_max_age)
+    fetch_profile = property(get_fetch_profile, set_fetch_profile)
+    fetch_profiles = property(get_fetch_profiles, set_fetch_profiles)
+    circuit_failures = property(get_circuit_failures, set_circuit_failures)
+    circuit_reset_time = property(get_circuit_reset_time, \
+        set_circuit_reset_time)
 
 class PreferencesTests(unittest.TestCase):
     def setUp(self):
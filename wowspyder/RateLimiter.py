@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+RateLimiter.py
+
+Token buckets that keep the whole crawler, however many threads and
+processes it has, inside a request budget for each Armory host.
+
+Copyright (c) 2009, Regents of the University of California
+All rights reserved.
+"""
+
+import sys
+import os
+import unittest
+import threading
+import time
+import fcntl
+import tempfile
+import shutil
+import urlparse
+import Logger
+
+log = Logger.log()
+
+DEFAULT_RATE = 5.0
+DEFAULT_BURST = 10
+
+_settings = {"rate": DEFAULT_RATE, "burst": DEFAULT_BURST, "path": None}
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def configure(rate=DEFAULT_RATE, burst=DEFAULT_BURST, path=None):
+    """Set the budget for every host, in requests per second, with bursts
+    of up to burst requests. A rate of None turns limiting off. Giving a
+    path shares each host's budget with every other process using the
+    same path.
+
+    """
+    _limiters_lock.acquire()
+
+    try:
+        if path != _settings["path"]:
+            _limiters.clear()
+
+        _settings["rate"] = rate
+        _settings["burst"] = burst
+        _settings["path"] = path
+
+        for limiter in _limiters.values():
+            limiter.rate = rate
+            limiter.burst = burst
+    finally:
+        _limiters_lock.release()
+
+def get_limiter(host):
+    """Return the limiter shared by everything requesting from host."""
+    _limiters_lock.acquire()
+
+    try:
+        limiter = _limiters.get(host)
+
+        if limiter is None:
+            if _settings["path"]:
+                limiter = FileTokenBucket(_settings["path"] + "." + host, \
+                    _settings["rate"], _settings["burst"])
+            else:
+                limiter = TokenBucket(_settings["rate"], _settings["burst"])
+
+            _limiters[host] = limiter
+
+        return limiter
+    finally:
+        _limiters_lock.release()
+
+def get_limiter_for_url(url):
+    """Return the limiter for the host url points at."""
+    return get_limiter(urlparse.urlsplit(url)[1])
+
+
+class TokenBucket(object):
+    """A token bucket filled at rate tokens a second, holding at most
+    burst tokens.
+
+    Callers that find the bucket empty still take their token, leaving
+    the bucket in debt, and are told how long to wait. That keeps callers
+    in the order they arrived without anyone polling.
+
+    """
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens=1):
+        """Take tokens from the bucket, returning how many seconds the
+        caller has to wait before using them.
+
+        """
+        if not self.rate:
+            return 0
+
+        self._lock.acquire()
+
+        try:
+            self._tokens, self._last = _take(self._tokens, self._last, \
+                self.rate, self.burst, tokens)
+            return _wait(self._tokens, self.rate)
+        finally:
+            self._lock.release()
+
+    def acquire(self, tokens=1):
+        """Block until tokens are available. Returns the time spent
+        waiting.
+
+        """
+        wait = self.reserve(tokens)
+
+        if wait > 0:
+            time.sleep(wait)
+
+        return wait
+
+
+class FileTokenBucket(TokenBucket):
+    """A token bucket whose state lives in a file, so that every process
+    on the host using the same file shares it.
+
+    """
+    def __init__(self, path, rate=DEFAULT_RATE, burst=DEFAULT_BURST):
+        TokenBucket.__init__(self, rate, burst)
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+
+    def __del__(self):
+        try:
+            os.close(self._fd)
+        except (AttributeError, OSError), e:
+            pass
+
+    def reserve(self, tokens=1):
+        if not self.rate:
+            return 0
+
+        # flock only keeps other processes out; threads in this one share
+        # the descriptor, so they need the lock as well.
+        self._lock.acquire()
+
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+
+            try:
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                state = os.read(self._fd, 64).split()
+
+                try:
+                    bucket_tokens, last = float(state[0]), float(state[1])
+                except (IndexError, ValueError), e:
+                    bucket_tokens, last = self.burst, time.time()
+
+                bucket_tokens, last = _take(bucket_tokens, last, self.rate, \
+                    self.burst, tokens)
+
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                os.ftruncate(self._fd, 0)
+                os.write(self._fd, "%f %f" % (bucket_tokens, last))
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+            return _wait(bucket_tokens, self.rate)
+        finally:
+            self._lock.release()
+
+
+def _take(bucket_tokens, last, rate, burst, tokens):
+    now = time.time()
+    bucket_tokens = min(burst, bucket_tokens + (now - last) * rate)
+    return bucket_tokens - tokens, now
+
+def _wait(bucket_tokens, rate):
+    if bucket_tokens >= 0:
+        return 0
+
+    return -bucket_tokens / rate
+
+
+class RateLimiterTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        configure()
+
+    def testBurst(self):
+        bucket = TokenBucket(rate=10, burst=5)
+
+        for _ in xrange(5):
+            self.assertEqual(bucket.reserve(), 0)
+
+        self.assertTrue(0.09 < bucket.reserve() <= 0.1)
+
+    def testRate(self):
+        bucket = TokenBucket(rate=100, burst=1)
+        start = time.time()
+
+        for _ in xrange(11):
+            bucket.acquire()
+
+        self.assertTrue(time.time() - start >= 0.09)
+
+    def testUnlimited(self):
+        bucket = TokenBucket(rate=None)
+
+        for _ in xrange(100):
+            self.assertEqual(bucket.reserve(), 0)
+
+    def testShared(self):
+        configure(rate=10, burst=2)
+        limiter = get_limiter_for_url("http://eu.wowarmory.com/team-info.xml")
+        self.assertTrue(limiter is get_limiter("eu.wowarmory.com"))
+        self.assertFalse(limiter is get_limiter("www.wowarmory.com"))
+
+    def testFileShared(self):
+        path = os.path.join(self.directory, "bucket")
+        first = FileTokenBucket(path, rate=10, burst=2)
+        second = FileTokenBucket(path, rate=10, burst=2)
+
+        self.assertEqual(first.reserve(), 0)
+        self.assertEqual(second.reserve(), 0)
+        self.assertTrue(first.reserve() > 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
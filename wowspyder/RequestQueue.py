@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+RequestQueue.py
+
+A thread-safe queue that hands out the most important download first,
+without letting anything wait forever.
+
+Copyright (c) 2009, Regents of the University of California
+All rights reserved.
+"""
+
+import sys
+import os
+import unittest
+import threading
+import heapq
+import time
+import Queue
+import Logger
+
+log = Logger.log()
+
+# Put something in with this priority and it comes out after everything
+# else, however long the other things have waited.
+LAST = float("inf")
+
+class PriorityRequestQueue(object):
+    """A queue ordered by priority class, lowest first, and then by
+    arrival.
+
+    Priorities age: an item of priority p is due p * aging seconds after
+    it arrives, and items come out in order of when they're due. A
+    priority 0 item arriving now goes before a priority 4 item that
+    arrived a moment ago, but not before one that has already waited
+    4 * aging seconds, so a steady stream of important requests can't
+    starve the rest.
+
+    get() and put() behave like Queue.Queue's.
+
+    """
+    def __init__(self, aging=5):
+        self.aging = aging
+        self._heap = []
+        self._sequence = 0
+        self._condition = threading.Condition()
+
+    def __len__(self):
+        self._condition.acquire()
+
+        try:
+            return len(self._heap)
+        finally:
+            self._condition.release()
+
+    def due(self, priority):
+        """Return when an item of priority arriving now is due."""
+        if priority == LAST:
+            return LAST
+
+        return time.time() + priority * self.aging
+
+    def put(self, item, priority=0):
+        self.put_at(item, self.due(priority))
+
+    def put_at(self, item, due):
+        """Put item back in the queue keeping when it was due, for items
+        taken out that couldn't be dealt with yet.
+
+        """
+        self._condition.acquire()
+
+        try:
+            self._sequence += 1
+            heapq.heappush(self._heap, (due, self._sequence, item))
+            self._condition.notify()
+        finally:
+            self._condition.release()
+
+    def get(self, block=True, timeout=None):
+        return self.get_entry(block, timeout)[1]
+
+    def get_entry(self, block=True, timeout=None):
+        """Remove the next item, returning when it was due and the item.
+        Raises Queue.Empty if there's nothing to get without blocking,
+        or nothing arrives within timeout.
+
+        """
+        self._condition.acquire()
+
+        try:
+            if timeout is not None:
+                end = time.time() + timeout
+
+            while not self._heap:
+                if not block:
+                    raise Queue.Empty
+
+                if timeout is None:
+                    self._condition.wait()
+                else:
+                    remaining = end - time.time()
+                    if remaining <= 0:
+                        raise Queue.Empty
+                    self._condition.wait(remaining)
+
+            due, sequence, item = heapq.heappop(self._heap)
+            return due, item
+        finally:
+            self._condition.release()
+
+
+class RequestQueueTests(unittest.TestCase):
+    def setUp(self):
+        self.queue = PriorityRequestQueue(aging=10)
+
+    def testPriorityOrder(self):
+        self.queue.put("statistics", 4)
+        self.queue.put("sheet", 2)
+        self.queue.put("arena", 1)
+        self.queue.put("team", 2)
+
+        self.assertEqual([self.queue.get() for _ in xrange(4)], \
+            ["arena", "sheet", "team", "statistics"])
+
+    def testAging(self):
+        self.queue.put_at("statistics", time.time() - 1)
+        self.queue.put("arena", 0)
+        self.assertEqual(self.queue.get(), "statistics")
+
+    def testLast(self):
+        self.queue.put(None, LAST)
+        self.queue.put("statistics", 1000)
+        self.assertEqual(self.queue.get(), "statistics")
+        self.assertEqual(self.queue.get(), None)
+
+    def testEmpty(self):
+        self.assertRaises(Queue.Empty, self.queue.get, False)
+        self.assertRaises(Queue.Empty, self.queue.get, True, 0.01)
+
+    def testBlockingGet(self):
+        threading.Timer(0.05, self.queue.put, args=("arena",)).start()
+        self.assertEqual(self.queue.get(), "arena")
+        self.assertEqual(len(self.queue), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+ResponseCache.py
+
+A persistent cache of gzipped Armory responses, kept in SQLite so it
+survives restarts and can be shared by several crawler processes.
+
+Copyright (c) 2009, Regents of the University of California
+All rights reserved.
+"""
+
+import sys
+import os
+import unittest
+import sqlite3
+import threading
+import time
+import tempfile
+import shutil
+import Logger
+import WoWSpyderLib
+
+log = Logger.log()
+
+# How long, in seconds, each type of page can be served from the cache.
+# None means forever; items never change once they're in the game.
+DEFAULT_TTLS = {
+    "arena": 30 * 60,
+    "team": 60 * 60,
+    "guild": 60 * 60,
+    "character-sheet": 15 * 60,
+    "character-talents": 6 * 60 * 60,
+    "character-statistics": 6 * 60 * 60,
+    "character-achievements": 6 * 60 * 60,
+    "item": None,
+    "login": 0,
+    "other": 60 * 60,
+}
+
+def _user_cache_path():
+    """Return where the cache lives unless told otherwise: the user's
+    cache directory, or the temporary directory if there's no home.
+
+    """
+    directory = os.environ.get("XDG_CACHE_HOME") or \
+        os.path.join(os.path.expanduser("~"), ".cache")
+
+    if directory.startswith("~"):
+        directory = tempfile.gettempdir()
+
+    return os.path.join(directory, "wowspyder", "response-cache.sqlite")
+
+DEFAULT_PATH = _user_cache_path()
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+_caches = {}
+_caches_lock = threading.Lock()
+_default_path = None
+
+def set_default_path(path):
+    """Keep the cache get_cache() returns at path, such as a scratch file
+    for tests, or back in DEFAULT_PATH if path is None.
+
+    """
+    global _default_path
+    _default_path = path
+
+def get_cache(path=None, max_bytes=None, ttls=None):
+    """Return the cache stored at path, shared by everything in this
+    process that asks for it. max_bytes and ttls, if given, are applied
+    to the cache even if it was made already.
+
+    """
+    if path is None: path = _default_path or DEFAULT_PATH
+    path = os.path.abspath(path)
+
+    _caches_lock.acquire()
+
+    try:
+        cache = _caches.get(path)
+
+        if cache is None:
+            cache = ResponseCache(path, max_bytes=max_bytes, ttls=ttls)
+            _caches[path] = cache
+        elif max_bytes is not None or ttls is not None:
+            cache.configure(max_bytes=max_bytes, ttls=ttls)
+
+        return cache
+    finally:
+        _caches_lock.release()
+
+
+class ResponseCache(object):
+    """A size-bounded, least recently used cache of gzipped responses,
+    keyed on URL.
+
+    Each thread gets its own SQLite connection, and every write happens in
+    an immediate transaction, so threads and processes sharing the file
+    never see a half-written entry. When the cache grows past max_bytes the
+    least recently read entries are evicted.
+
+    """
+    def __init__(self, path=DEFAULT_PATH, max_bytes=None, ttls=None):
+        self.path = path
+        self.max_bytes = max_bytes or DEFAULT_MAX_BYTES
+        self.ttls = dict(DEFAULT_TTLS)
+
+        if ttls:
+            self.ttls.update(ttls)
+
+        directory = os.path.dirname(os.path.abspath(path))
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self._local = threading.local()
+        self._create_tables()
+
+    def configure(self, max_bytes=None, ttls=None):
+        """Change the size the cache is kept to, evicting entries if it's
+        now too big, and how long each type of page stays fresh, overriding
+        DEFAULT_TTLS. Whichever is None is left as it was.
+
+        """
+        if ttls is not None:
+            self.ttls = dict(DEFAULT_TTLS)
+            self.ttls.update(ttls)
+
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+            connection = self._connection()
+            connection.execute("BEGIN IMMEDIATE")
+
+            try:
+                self._evict(connection)
+            except:
+                connection.execute("ROLLBACK")
+                raise
+            else:
+                connection.execute("COMMIT")
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=60, \
+                isolation_level=None)
+            connection.text_factory = str
+            self._local.connection = connection
+
+        return connection
+
+    def _create_tables(self):
+        connection = self._connection()
+        connection.execute("CREATE TABLE IF NOT EXISTS response (" + \
+            "url TEXT PRIMARY KEY, url_type TEXT, body BLOB, " + \
+            "size INTEGER, stored REAL, accessed REAL, etag TEXT, " + \
+            "last_modified TEXT)")
+        connection.execute("CREATE INDEX IF NOT EXISTS response_accessed " + \
+            "ON response (accessed)")
+        connection.execute("CREATE TABLE IF NOT EXISTS cache_size (" + \
+            "id INTEGER PRIMARY KEY, bytes INTEGER)")
+        connection.execute("INSERT OR IGNORE INTO cache_size VALUES (1, 0)")
+
+        # Caches made before validators were stored don't have the columns
+        columns = [row[1] for row in connection.execute("PRAGMA table_info(response)")]
+
+        for column in ("etag", "last_modified"):
+            if column not in columns:
+                connection.execute("ALTER TABLE response ADD COLUMN " + column + " TEXT")
+
+    def ttl(self, url):
+        """Return how long url can be served from the cache."""
+        return self.ttls.get(WoWSpyderLib.get_url_type(url), self.ttls["other"])
+
+    def get(self, url):
+        """Return the gzipped body cached for url, or None if there isn't
+        one or it has gone stale.
+
+        """
+        entry = self.lookup(url)
+
+        if entry is None or not entry.fresh:
+            return None
+
+        return entry.body
+
+    def lookup(self, url):
+        """Return the CacheEntry for url, stale or not, or None if
+        nothing has been cached for it.
+
+        """
+        connection = self._connection()
+        row = connection.execute("SELECT body, stored, accessed, etag, " + \
+            "last_modified FROM response WHERE url = ?", (url,)).fetchone()
+
+        if row is None:
+            return None
+
+        body, stored, accessed, etag, last_modified = row
+        ttl = self.ttl(url)
+        now = time.time()
+        fresh = ttl is None or now - stored < ttl
+
+        if not fresh:
+            log.debug("Cached version of " + url + " is stale")
+
+        # Recording every read would turn every hit into a write. A minute
+        # is precise enough for choosing what to evict.
+        if now - accessed > 60:
+            connection.execute("UPDATE response SET accessed = ? WHERE url = ?", \
+                (now, url))
+
+        return CacheEntry(str(body), fresh, etag, last_modified)
+
+    def revalidate(self, url):
+        """Mark the entry for url as fresh again, because the Armory said
+        it hasn't changed.
+
+        """
+        now = time.time()
+        self._connection().execute("UPDATE response SET stored = ?, " + \
+            "accessed = ? WHERE url = ?", (now, now, url))
+
+    def put(self, url, body, etag=None, last_modified=None):
+        """Cache the gzipped body for url, along with the validators the
+        Armory sent for it, evicting old entries if the cache is now too big.
+
+        """
+        if self.ttl(url) == 0:
+            return
+
+        connection = self._connection()
+        now = time.time()
+        connection.execute("BEGIN IMMEDIATE")
+
+        try:
+            row = connection.execute("SELECT size FROM response WHERE url = ?", \
+                (url,)).fetchone()
+            old_size = 0
+            if row: old_size = row[0]
+
+            connection.execute("INSERT OR REPLACE INTO response (url, " + \
+                "url_type, body, size, stored, accessed, etag, last_modified) " + \
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (url, \
+                WoWSpyderLib.get_url_type(url), sqlite3.Binary(body), len(body), \
+                now, now, etag, last_modified))
+            connection.execute("UPDATE cache_size SET bytes = bytes + ? WHERE id = 1", \
+                (len(body) - old_size,))
+            self._evict(connection)
+        except:
+            connection.execute("ROLLBACK")
+            raise
+        else:
+            connection.execute("COMMIT")
+
+    def _evict(self, connection):
+        size = self.size(connection)
+
+        if size <= self.max_bytes:
+            return
+
+        log.debug("Cache is %d bytes, evicting" % size)
+        rows = connection.execute("SELECT url, size FROM response " + \
+            "ORDER BY accessed")
+        evicted = []
+
+        for url, entry_size in rows:
+            if size <= self.max_bytes:
+                break
+            evicted.append((url,))
+            size -= entry_size
+
+        connection.executemany("DELETE FROM response WHERE url = ?", evicted)
+        connection.execute("UPDATE cache_size SET bytes = ? WHERE id = 1", (size,))
+
+    def size(self, connection=None):
+        """Return the number of bytes of responses in the cache."""
+        if connection is None: connection = self._connection()
+        return connection.execute("SELECT bytes FROM cache_size WHERE id = 1").fetchone()[0]
+
+    def clear(self):
+        """Remove everything from the cache."""
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+
+        try:
+            connection.execute("DELETE FROM response")
+            connection.execute("UPDATE cache_size SET bytes = 0 WHERE id = 1")
+        except:
+            connection.execute("ROLLBACK")
+            raise
+        else:
+            connection.execute("COMMIT")
+
+
+class CacheEntry(object):
+    """A cached response, with the validators needed to ask the Armory
+    whether it has changed.
+
+    """
+    def __init__(self, body, fresh, etag=None, last_modified=None):
+        self.body = body
+        self.fresh = fresh
+        self.etag = etag
+        self.last_modified = last_modified
+
+    def has_validators(self):
+        return bool(self.etag or self.last_modified)
+
+
+class ResponseCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "cache.sqlite")
+        self.cache = ResponseCache(self.path, max_bytes=100)
+        self.sheet = "http://www.wowarmory.com/character-sheet.xml?r=Ravenholdt&n=Moulin"
+        self.item = "http://www.wowarmory.com/item-info.xml?i=38237"
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testPutGet(self):
+        self.cache.put(self.sheet, "sheet")
+        self.assertEqual(self.cache.get(self.sheet), "sheet")
+        self.assertEqual(self.cache.get(self.item), None)
+
+    def testSurvivesRestart(self):
+        self.cache.put(self.item, "item")
+        self.assertEqual(ResponseCache(self.path).get(self.item), "item")
+
+    def testStale(self):
+        self.cache.ttls["character-sheet"] = 0.01
+        self.cache.put(self.sheet, "sheet")
+        time.sleep(0.02)
+        self.assertEqual(self.cache.get(self.sheet), None)
+
+    def testValidators(self):
+        self.cache.ttls["character-sheet"] = 0.01
+        self.cache.put(self.sheet, "sheet", etag="\"abc\"", \
+            last_modified="Wed, 15 Apr 2009 10:00:00 GMT")
+        time.sleep(0.02)
+
+        entry = self.cache.lookup(self.sheet)
+        self.assertFalse(entry.fresh)
+        self.assertEqual(entry.body, "sheet")
+        self.assertEqual(entry.etag, "\"abc\"")
+        self.assertTrue(entry.has_validators())
+
+        self.cache.ttls["character-sheet"] = 60
+        self.cache.revalidate(self.sheet)
+        self.assertEqual(self.cache.get(self.sheet), "sheet")
+
+    def testLoginNotCached(self):
+        self.cache.put("http://www.wowarmory.com/login-status.xml", "login")
+        self.assertEqual(self.cache.size(), 0)
+
+    def testEviction(self):
+        self.cache.put(self.item, "i" * 40)
+        self.cache.put(self.sheet, "s" * 40)
+        self.cache.put(self.item + "1", "j" * 40)
+
+        self.assertEqual(self.cache.get(self.item), None)
+        self.assertEqual(self.cache.size(), 80)
+
+    def testReplace(self):
+        self.cache.put(self.item, "i" * 40)
+        self.cache.put(self.item, "i" * 10)
+        self.assertEqual(self.cache.size(), 10)
+
+    def testThreads(self):
+        def put(n):
+            for x in xrange(20):
+                self.cache.put(self.item + str(n) + "-" + str(x), "x")
+
+        threads = [threading.Thread(target=put, args=(n,)) for n in xrange(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.cache.size(), 100)
+
+    def testGetCacheReconfigures(self):
+        path = os.path.join(self.directory, "shared.sqlite")
+        cache = get_cache(path)
+        cache.put(self.item, "i" * 40)
+        cache.put(self.sheet, "s" * 40)
+
+        self.assertTrue(get_cache(path, max_bytes=50, \
+            ttls={"character-sheet": 5}) is cache)
+        self.assertEqual(cache.max_bytes, 50)
+        self.assertEqual(cache.size(), 40)
+        self.assertEqual(cache.ttl(self.sheet), 5)
+        self.assertEqual(cache.ttl(self.item), None)
+
+    def testDefaultPath(self):
+        self.assertFalse(DEFAULT_PATH.startswith( \
+            os.path.dirname(os.path.abspath(__file__))))
+        set_default_path(self.path)
+
+        try:
+            self.assertEqual(get_cache().path, os.path.abspath(self.path))
+        finally:
+            set_default_path(None)
+
+
+if __name__ == '__main__':
+    unittest.main()
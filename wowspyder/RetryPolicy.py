@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+RetryPolicy.py
+
+How the download engines retry a request the Armory didn't answer: how
+many times, how long to back off in between, how long to wait on a single
+request and how long to keep trying altogether.
+
+Copyright (c) 2009, Regents of the University of California
+All rights reserved.
+"""
+
+import sys
+import os
+import unittest
+import random
+import time
+import Logger
+
+log = Logger.log()
+
+class RetryPolicy(object):
+    """Retries up to attempts times after the first try. The first backoff
+    is initial seconds, and each one after that adds twice as much as the
+    last did, starting from increment, so with the defaults the backoffs
+    are 30, 90 and 210 seconds. Each backoff is capped at maximum and
+    stretched by up to jitter of itself, so downloaders that were blocked
+    together don't all come back together.
+
+    A single request is given up on after timeout seconds, and no request
+    is tried again once deadline seconds (None for no limit) have passed
+    since the first try.
+
+    """
+    def __init__(self, attempts=3, initial=30, increment=60, maximum=600, \
+            jitter=0.5, timeout=60, deadline=None):
+        self.attempts = attempts
+        self.initial = initial
+        self.increment = increment
+        self.maximum = maximum
+        self.jitter = jitter
+        self.timeout = timeout
+        self.deadline = deadline
+
+    def delay(self, retry):
+        """Return how long to back off before retry number retry, counting
+        from 0, without the jitter.
+
+        """
+        return min(self.maximum, \
+            self.initial + self.increment * (2 ** retry - 1))
+
+    def longest(self):
+        """Return the longest a request can take, tries and backoffs
+        included, leaving out any wait for the rate limiter.
+
+        """
+        longest = self.timeout * (self.attempts + 1) + \
+            sum([self.delay(n) for n in xrange(self.attempts)]) * \
+            (1 + self.jitter)
+
+        if self.deadline is not None:
+            longest = min(longest, self.deadline + self.timeout)
+
+        return longest
+
+    def begin(self, attempts=None, initial=None):
+        """Return a Retry for a new request, optionally overriding the
+        number of attempts and the first backoff.
+
+        """
+        return Retry(self, attempts, initial)
+
+
+class Retry(object):
+    """The retries left for one request."""
+    def __init__(self, policy, attempts=None, initial=None):
+        if attempts is None: attempts = policy.attempts
+        if initial is None: initial = policy.initial
+
+        self.policy = policy
+        self.attempts = attempts
+        self.initial = initial
+        self.retries = 0
+        self.started = time.time()
+
+    def time_left(self):
+        """Return the seconds left before the deadline, or None."""
+        if self.policy.deadline is None:
+            return None
+
+        return self.started + self.policy.deadline - time.time()
+
+    def timeout(self):
+        """Return how long the next try may take."""
+        left = self.time_left()
+
+        if left is None:
+            return self.policy.timeout
+
+        return max(0.001, min(self.policy.timeout, left))
+
+    def backoff(self):
+        """Return how many seconds to back off before trying again, or
+        None if the request should be given up on.
+
+        """
+        if self.retries >= self.attempts:
+            return None
+
+        delay = self.policy.delay(self.retries) - self.policy.initial + \
+            self.initial
+        delay = max(0, delay) * random.uniform(1, 1 + self.policy.jitter)
+        left = self.time_left()
+
+        if left is not None and delay >= left:
+            log.debug("Backing off would pass the deadline, giving up")
+            return None
+
+        self.retries += 1
+        return delay
+
+
+class RetryPolicyTests(unittest.TestCase):
+    def testDelays(self):
+        policy = RetryPolicy(attempts=5, initial=30, increment=60, \
+            maximum=300)
+        self.assertEqual([policy.delay(n) for n in xrange(5)], \
+            [30, 90, 210, 300, 300])
+
+    def testLongest(self):
+        policy = RetryPolicy(attempts=2, initial=1, increment=1, jitter=0, \
+            timeout=10)
+        self.assertEqual(policy.longest(), 33)
+        policy.deadline = 5
+        self.assertEqual(policy.longest(), 15)
+
+    def testAttempts(self):
+        retry = RetryPolicy(attempts=2, initial=1, increment=1, \
+            jitter=0.5).begin()
+        first = retry.backoff()
+        self.assertTrue(1 <= first <= 1.5)
+        self.assertTrue(2 <= retry.backoff() <= 3)
+        self.assertEqual(retry.backoff(), None)
+
+    def testOverrides(self):
+        retry = RetryPolicy(jitter=0).begin(attempts=2, initial=0)
+        self.assertEqual(retry.backoff(), 0)
+        self.assertEqual(retry.backoff(), 60)
+        self.assertEqual(retry.backoff(), None)
+
+    def testDeadline(self):
+        retry = RetryPolicy(initial=0.05, increment=10, jitter=0, timeout=60, \
+            deadline=1).begin()
+        self.assertTrue(retry.timeout() <= 1)
+        self.assertEqual(retry.backoff(), 0.05)
+        self.assertEqual(retry.backoff(), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
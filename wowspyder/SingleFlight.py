@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+SingleFlight.py
+
+Coalesces identical calls that are in flight at the same time, so that
+the work is done once and everyone asking gets the one result.
+
+Copyright (c) 2009, Regents of the University of California
+All rights reserved.
+"""
+
+import sys
+import os
+import unittest
+import threading
+import time
+import DownloadFuture
+import Logger
+
+log = Logger.log()
+
+class SingleFlight(object):
+    """Runs at most one call for each key at a time. Anyone calling with a
+    key that's already being worked on waits for that call and gets its
+    result, or its exception, instead of making their own.
+
+    Keys are forgotten as soon as their call finishes, so this is not a
+    cache; it only catches callers that overlap.
+
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.calls = 0
+        self.shared = 0
+
+    def do(self, key, function, *args, **kwargs):
+        """Return function(*args, **kwargs), unless a call for key is
+        already running, in which case return what that call returns.
+
+        """
+        future, leader = self._join(key)
+
+        if not leader:
+            log.debug("Sharing in-flight call for " + str(key))
+            return future.result()
+
+        result = None
+        error = None
+
+        try:
+            result = function(*args, **kwargs)
+            return result
+        except Exception, e:
+            error = e
+            raise
+        finally:
+            self._forget(key, future)
+
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def submit(self, key, start, *args, **kwargs):
+        """Like do(), but return a DownloadFuture.Future for the call
+        instead of waiting for it. start(future, *args, **kwargs) is called
+        to begin the work and must finish the future, from whichever thread
+        the work ends up in. If a call for key is already running, its
+        future is returned and start isn't called.
+
+        """
+        future, leader = self._join(key)
+
+        if not leader:
+            log.debug("Sharing in-flight call for " + str(key))
+            return future
+
+        future.add_done_callback(lambda future: self._forget(key, future))
+
+        try:
+            start(future, *args, **kwargs)
+        except Exception, e:
+            future.set_exception(e)
+
+        return future
+
+    def _join(self, key):
+        """Return the future for key's call, and whether the caller has
+        to make the call because there wasn't one running.
+
+        """
+        self._lock.acquire()
+
+        try:
+            future = self._calls.get(key)
+
+            # A call that has finished but not been forgotten yet, as its
+            # waiters wake before its callbacks run, isn't shared
+            if future is not None and not future.done():
+                self.shared += 1
+                return future, False
+
+            future = DownloadFuture.Future()
+            self._calls[key] = future
+            self.calls += 1
+            return future, True
+        finally:
+            self._lock.release()
+
+    def _forget(self, key, future):
+        self._lock.acquire()
+
+        try:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """Return how many calls were made and how many were saved by
+        sharing one already in flight.
+
+        """
+        self._lock.acquire()
+
+        try:
+            return {"calls": self.calls, "shared": self.shared}
+        finally:
+            self._lock.release()
+
+    def reset_stats(self):
+        """Return the stats and start counting again."""
+        self._lock.acquire()
+
+        try:
+            stats = {"calls": self.calls, "shared": self.shared}
+            self.calls = 0
+            self.shared = 0
+            return stats
+        finally:
+            self._lock.release()
+
+
+# Every downloader in the process coalesces through the same group, so
+# a URL being fetched by one engine isn't fetched again by another.
+_downloads = SingleFlight()
+
+def get_downloads():
+    """Return the group shared by the download engines."""
+    return _downloads
+
+
+class SingleFlightTests(unittest.TestCase):
+    def setUp(self):
+        self.group = SingleFlight()
+        self.runs = 0
+
+    def slow(self, result):
+        self.runs += 1
+        time.sleep(0.1)
+        return result
+
+    def failing(self):
+        self.runs += 1
+        time.sleep(0.1)
+        raise IOError("Armory is down")
+
+    def run_together(self, function, *args):
+        results = []
+
+        def call():
+            try:
+                results.append(self.group.do("key", function, *args))
+            except Exception, e:
+                results.append(e)
+
+        threads = [threading.Thread(target=call) for _ in xrange(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return results
+
+    def testCoalesced(self):
+        results = self.run_together(self.slow, "page")
+        self.assertEqual(results, ["page"] * 5)
+        self.assertEqual(self.runs, 1)
+        self.assertEqual(self.group.stats(), {"calls": 1, "shared": 4})
+
+    def testExceptionShared(self):
+        results = self.run_together(self.failing)
+        self.assertEqual(self.runs, 1)
+        self.assertEqual(len(results), 5)
+
+        for result in results:
+            self.assertTrue(isinstance(result, IOError))
+
+    def testNotCached(self):
+        self.group.do("key", self.slow, "first")
+        self.assertEqual(self.group.do("key", self.slow, "second"), "second")
+        self.assertEqual(self.runs, 2)
+
+    def testSubmit(self):
+        futures = []
+
+        def start(future, result):
+            self.runs += 1
+            futures.append(future)
+
+        first = self.group.submit("key", start, "page")
+        second = self.group.submit("key", start, "page")
+        self.assertTrue(first is second)
+        self.assertEqual(self.runs, 1)
+
+        threading.Timer(0.05, first.set_result, args=("page",)).start()
+        self.assertEqual(self.group.do("key", self.slow, "other"), "page")
+        self.assertEqual(self.runs, 1)
+
+        # Once it's done, the key is free again
+        self.assertFalse(self.group.submit("key", start, "page") is first)
+
+    def testFinishedNotShared(self):
+        # Finished, but its callbacks haven't forgotten it yet
+        self.group._calls["key"] = DownloadFuture.completed("old")
+        self.assertEqual(self.group.do("key", self.slow, "new"), "new")
+        self.assertEqual(self.runs, 1)
+
+    def testSubmitFails(self):
+        def start(future):
+            raise IOError("Downloader has been closed")
+
+        self.assertRaises(IOError, self.group.submit("key", start).result)
+        self.assertEqual(self.group._calls, {})
+
+    def testResetStats(self):
+        self.group.do("key", self.slow, "page")
+        self.assertEqual(self.group.reset_stats(), {"calls": 1, "shared": 0})
+        self.assertEqual(self.group.stats(), {"calls": 0, "shared": 0})
+
+
+if __name__ == '__main__':
+    unittest.main()
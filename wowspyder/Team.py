@@ -10,7 +10,6 @@ Copyright (c) 2009 Regents of University of Califonia. All rights reserved.
 import sys
 import os
 import unittest
-from xml.dom import minidom
 import Database
 import Logger
 import datetime
@@ -26,32 +25,31 @@ from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relation, backref
 from Enum import Enum
 import urllib2
-import StringIO
 import Preferences
 from Parser import Parser
 import re
+import NegativeCache
+import DeadLetter
 
 log = Logger.log()
 
 Base = Database.get_base()
 
 class TeamParser(Parser):
-    def __init__(self, downloader=None):
-        '''Initialize the team parser.'''
+    entity = "team"
+    
+    def __init__(self, downloader=None, crawl_mode=None):
+        '''Initialize the team parser. crawl_mode is
+        GuildCharacter.FULL_CRAWL or STUB_CRAWL, defaulting to the
+        crawl_mode preference.'''
         log.debug("Creating TeamParser with " + str(downloader))
         Parser.__init__(self, downloader=downloader)
+        self.crawl_mode = crawl_mode or self._prefs.crawl_mode
         self._cp = GuildCharacter.CharacterParser(downloader=self._downloader)        
         
-    def _check_download(self, source, exception):
-        if exception:
-            log.error("Unable to download team file")
-            raise exception
-            
-        if re.search("arenaTeam.*?teamUrlEscape=\"\"", source):
-            log.error("Team was invalid or not returned")
-            raise IOError("Team requested was invalid or not returned")
-        
-        return source
+    def _is_missing(self, parsed):
+        # The Armory leaves the escaped name blank for teams it doesn't have
+        return parsed.attribute("arenaTeam", "teamUrlEscape") == ""
         
     def get_team(self, name, realm, site, size=None, get_characters=False, cached=False):
         """Returns a team object. Setting get_characters to True will
@@ -74,30 +72,38 @@ class TeamParser(Parser):
             
         # cflewis | 2009-04-02 | If downloading fails, the whole team
         # couldn't be found, so the exception should propagate up.
-        source = self._download_url(\
-            WoWSpyderLib.get_team_url(name, realm, site, size))
-        team = self._parse_team(StringIO.StringIO(source), site, get_characters=get_characters)
+        source = self._download_entity(\
+            WoWSpyderLib.get_team_url(name, realm, site, size), \
+            NegativeCache.make_key(name, realm, site))
+            
+        if team and self._is_unchanged(source):
+            log.debug("Team hasn't changed, not parsing it")
+            return team
+            
+        team = self._parse_team(source.parsed(), site, get_characters=get_characters)
         
         return team
         
-    def _parse_team(self, xml_file_object, site, get_characters=False):
-        """Parse a team and add its characters if necessary."""
+    def _parse_team(self, parsed, site, get_characters=False):
+        """Parse a team, given its XMLStream.ParsedPage, and add its
+        characters if necessary.
+        
+        """
         log.debug("Parsing team...")
-        xml = minidom.parse(xml_file_object)
-        team_nodes = xml.getElementsByTagName("arenaTeam")
-        team_node = team_nodes[0]
+        team_node = parsed.all("arenaTeam")[0]
         
-        name = team_node.attributes["name"].value
-        realm = team_node.attributes["realm"].value
-        size = int(team_node.attributes["teamSize"].value)
-        faction = team_node.attributes["faction"].value
+        name = team_node["name"]
+        realm = team_node["realm"]
+        size = int(team_node["teamSize"])
+        faction = team_node["faction"]
         
         team = Team(name, realm, site, size, faction)
         log.info("Creating team " + unicode(team).encode("utf-8"))
         Database.insert(team)
         
         if get_characters:
-            characters = self._parse_team_characters(StringIO.StringIO(xml_file_object.getvalue()), site)
+            characters = self._parse_team_characters(parsed.all("character"), \
+                site, faction=faction)
         
             # cflewis | 2009-03-28 | Add the characters to the team
             for character in characters:
@@ -122,17 +128,24 @@ class TeamParser(Parser):
 
         return team
         
-    def _parse_team_characters(self, xml_file_object, site):
-        """Parse a list of characters associated with a team"""
+    def _parse_team_characters(self, character_nodes, site, faction=None):
+        """Parse a list of characters associated with a team, from the
+        attributes of the team page's character elements. faction is the
+        team's.
+        
+        """
         log.debug("Parsing team characters...")
-        xml = minidom.parse(xml_file_object)
-        character_nodes = xml.getElementsByTagName("character")
         characters = []
+        
+        if self.crawl_mode == GuildCharacter.STUB_CRAWL:
+            return self._cp.stub_characters([GuildCharacter.make_listing( \
+                node, node["realm"], faction=faction) \
+                for node in character_nodes], site)
                 
         for character_node in character_nodes:
             log.debug("Looping through character nodes")
-            name = character_node.attributes["name"].value
-            realm = character_node.attributes["realm"].value
+            name = character_node["name"]
+            realm = character_node["realm"]
                         
             try:
                 log.debug("Getting character...")
@@ -142,11 +155,19 @@ class TeamParser(Parser):
                 character = self._cp.get_character(name, realm, site)
             except Exception, e:
                 log.warning("Couldn't get character " + name + ", continuing. ERROR: " + str(e))
+                self._defer(self._cp.entity, [name, realm, site], e)
                 continue
             else:
                 characters.append(character)
             
         return characters
+        
+    def redo(self, name, realm, site, size, get_characters):
+        """Redo a team that failed."""
+        return self.get_team(name, realm, site, size, \
+            get_characters=get_characters)
+
+DeadLetter.register(TeamParser.entity, TeamParser)
 
 
 team_characters = Table("TEAM_CHARACTERS", Base.metadata,
@@ -224,7 +245,12 @@ class Team(Base):
                 
 class TeamParserTests(unittest.TestCase):
     def setUp(self):
+        import ArmoryStandIn
+        self.stand_in = ArmoryStandIn.ArmoryStandIn().start().use()
         self.tp = TeamParser()
+        
+    def tearDown(self):
+        self.stand_in.stop()
     
     # def testCharacterTeam(self):
     #     team = self.tp.get_team(u"JUST DIED IN ONE HIT", u"Mug'Thol", 
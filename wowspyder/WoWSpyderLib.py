@@ -19,10 +19,67 @@ except ImportError, e:
 import re
 import datetime
 import time
+import urlparse
+import threading
 log = Logger.log()
 
+# The kind of page each Armory URL returns, keyed on the page name.
+URL_TYPES = {
+    "arena-ladder.xml": "arena",
+    "team-info.xml": "team",
+    "guild-info.xml": "guild",
+    "character-sheet.xml": "character-sheet",
+    "character-talents.xml": "character-talents",
+    "character-statistics.xml": "character-statistics",
+    "character-achievements.xml": "character-achievements",
+    "item-info.xml": "item",
+    "login-status.xml": "login",
+}
+
+# Which priority class each type of page is downloaded in; lower goes
+# first. Arena ladders, teams, guilds and character sheets lead to more
+# pages, so the crawl keeps finding work while the bulk pages catch up.
+URL_PRIORITIES = {
+    "login": 0,
+    "arena": 1,
+    "team": 1,
+    "guild": 1,
+    "character-sheet": 2,
+    "character-talents": 3,
+    "item": 3,
+    "other": 3,
+    "character-statistics": 4,
+    "character-achievements": 4,
+}
+
+# The categories of the character statistics and achievements pages,
+# each of which is its own download.
+STATISTIC_CATEGORIES = [130, 141, 128, 122, 133, 14807, 132, 134, 131, 21]
+ACHIEVEMENT_CATEGORIES = [92, 96, 97, 95, 168, 169, 201, 155, 81]
+
+# A priority class for everything one thread downloads, whatever the
+# type of page, such as the dead-letter retries running behind the crawl.
+_thread_priority = threading.local()
+
+# Armories to use instead of wowarmory.com, keyed on site, such as an
+# ArmoryStandIn for tests and benchmarks.
+_site_urls = {}
+
+def set_site_url(site, url):
+    """Send requests for site to url (ending in a slash) instead of the
+    real Armory. A url of None goes back to the real one.
+    
+    """
+    if url is None:
+        _site_urls.pop(site, None)
+    else:
+        _site_urls[site] = url
+
 def get_site_url(site):
     """Return the domain name for the relevant Armory."""
+    if site in _site_urls:
+        return _site_urls[site]
+        
     server = "www"
     if site == "eu": server = "eu"
         
@@ -82,23 +139,68 @@ def get_guild_url(name, realm, site, page=1):
         "&n=" + quote(name.encode("utf-8")) + \
         "&p=" + str(page)
     
+def get_url_type(url):
+    """Return the kind of page a URL points to, such as "guild" or
+    "character-sheet". URLs that aren't Armory pages are "other".
+    
+    """
+    page = urlparse.urlsplit(url)[2].rsplit("/", 1)[-1]
+    return URL_TYPES.get(page, "other")
+    
+def set_thread_priority(priority):
+    """Download everything the calling thread asks for in priority. None
+    goes back to each URL's own priority.
+    
+    """
+    _thread_priority.priority = priority
+    
+def get_url_priority(url, priorities=None):
+    """Return the priority class of a URL, from priorities if it has an
+    entry for the URL's type and from URL_PRIORITIES otherwise. The
+    calling thread's priority, if it has one, overrides both.
+    
+    """
+    priority = getattr(_thread_priority, "priority", None)
+    
+    if priority is not None:
+        return priority
+        
+    url_type = get_url_type(url)
+    
+    if priorities and url_type in priorities:
+        return priorities[url_type]
+        
+    return URL_PRIORITIES.get(url_type, URL_PRIORITIES["other"])
+    
 def get_max_pages(source):
     """Return the max pages for pages that paginate."""
     return int(re.search("maxPage=\"(\d*)\"", source).group(1))
     
-def get_character_statistics_urls(name, realm, site):
+def get_character_statistics_urls(name, realm, site, categories=None):
+    """Return the URLs of the character's statistics pages, one for each
+    of categories, or every category in STATISTIC_CATEGORIES if None.
+    
+    """
     urls = []
     
-    for category in [130,141,128,122,133,14807,132,134,131,21]:
+    if categories is None: categories = STATISTIC_CATEGORIES
+    
+    for category in categories:
         urls.append(_get_character_statistic_base_url(name, realm, site) + \
             "&c=" + str(category))
             
     return urls
     
-def get_character_achievement_urls(name, realm, site):
+def get_character_achievement_urls(name, realm, site, categories=None):
+    """Return the URLs of the character's achievements pages, one for
+    each of categories, or every category in ACHIEVEMENT_CATEGORIES if None.
+    
+    """
     urls = []
 
-    for category in [92,96,97,95,168,169,201,155,81]:
+    if categories is None: categories = ACHIEVEMENT_CATEGORIES
+
+    for category in categories:
         urls.append(_get_character_achievement_base_url(name, realm, site) + \
             "&c=" + str(category))
 
@@ -14,134 +14,291 @@ import sys
 import os
 import unittest
 import re
-from xml.dom import minidom
 import urllib2
 import Logger
-import StringIO
 import gzip
-import cookielib
 import time
-import random
 import threading
-import Queue
-#from shove import Shove
-#import signal
-import gc
+import ConnectionPool
+import ResponseCache
+import RateLimiter
+import ConcurrencyController
+import SingleFlight
+import RequestQueue
+import WoWSpyderLib
+import ArmoryPage
+import ArmorySession
+import DownloadStats
+import DownloadFuture
+import CircuitBreaker
+import RetryPolicy
+import urlparse
+import weakref
+import traceback
 
 log = Logger.log()
 
-# cflewis | 2009-04-08 | I think storing this in memory is causing
-# memory exhaustion, which is what could be contributing to scaling issues.
-cache = {}
+USER_AGENT = "WoWSpyder 0.1, \
+like Mozilla/5.0 Gecko/20081201 Firefox/3.1b2. \
+http://github.com/Lewisham/wowspyder"
 
-def refresh_cache(signum, frame):
-    cache.clear()
-    gc.collect()
+def refresh_cache(signum=None, frame=None):
+    """Empty the shared response cache."""
+    ResponseCache.get_cache().clear()
     log.debug("Refreshed cache")
-    # signal.signal(signal.SIGALRM, refresh_cache)
-    # signal.alarm(300)
-    t = threading.Timer(300, refresh_cache)
-    t.start()
+    
+def is_unchanged(source):
+    """Return True if source is a page the Armory said hasn't changed
+    since it was last downloaded. source can be an ArmoryPage.Page or the
+    source of one.
+    
+    """
+    return isinstance(source, UnchangedSource) or \
+        getattr(source, "unchanged", False)
+    
+def page_source(page):
+    """Return the XML of a page, keeping track of whether it changed."""
+    if page.unchanged:
+        return UnchangedSource(page.read())
+        
+    return page.read()
+    
+
+class UnchangedSource(str):
+    """The source of a page that the Armory answered with a 304. It's the
+    cached copy, so it can be used like any other source, but parsers can
+    skip the work they did when they first saw it.
+    
+    """
+    pass
 
-log.debug("Setting alarm")
-t = threading.Timer(300, refresh_cache)
-t.start()
 
 class XMLDownloader(object):
-    ''' A class that creates a session with the WoW Armory, saving a cookie
-    and using it whenever this object is asked to download from the Armory.
+    ''' A class that downloads from the WoW Armory using the session cookie
+    for each Armory host. Sessions are shared with every other downloader
+    in the process, and nobody logs in until a page from the host is
+    actually needed.
     
     '''
     def __init__(self, backoff_attempts=3, backoff_initial_time=30, \
-            backoff_increment = 60):
-        self._cj = cookielib.CookieJar()
-        h = urllib2.HTTPHandler(debuglevel=0)
-        self._opener = urllib2.build_opener(h, urllib2.HTTPCookieProcessor(self._cj))
+            backoff_increment = 60, keep_alive=True, pool_size=4, \
+            pool_idle_timeout=30, cache=None, timeout=60, deadline=None, \
+            retry_policy=None):
+        # The cache lives on disk and is shared by every downloader (and
+        # every process) pointed at the same file.
+        if cache is None: cache = ResponseCache.get_cache()
+        self._cache = cache
         
-        self.backoff_attempts = backoff_attempts
-        self.backoff_initial_time = backoff_initial_time
-        self.backoff_increment = backoff_increment
+        # Connections are pooled per host and shared with every other
+        # downloader, so there's no need to close the opener after a fetch.
+        if keep_alive:
+            h = ConnectionPool.KeepAliveHandler(pool_size=pool_size, \
+                idle_timeout=pool_idle_timeout)
+        else:
+            h = urllib2.HTTPHandler(debuglevel=0)
+            
+        self._opener = urllib2.build_opener(h, \
+            ArmorySession.SessionCookieProcessor())
         
-        self.refresh_login()
+        # A retry_policy replaces the backoff arguments, timeout and deadline
+        if retry_policy is None:
+            retry_policy = RetryPolicy.RetryPolicy(attempts=backoff_attempts, \
+                initial=backoff_initial_time, increment=backoff_increment, \
+                timeout=timeout, deadline=deadline)
+        self.retry_policy = retry_policy
         
     def __del__(self):
         pass
         
-    def refresh_login(self):
-        """Refresh the login, getting a new session cookie from the Armory."""
-        # cflewis | 2009-03-13 | Get the cookie saved.
-        self.download_url("http://www.wowarmory.com/login-status.xml", cached=False)
-        log.debug("Got cookie " + str(self._cj))
+    def refresh_login(self, site_url=None):
+        """Refresh the login, getting a new session cookie from the Armory
+        at site_url (the US Armory by default).
+        
+        """
+        if site_url is None: site_url = WoWSpyderLib.get_site_url(u"us")
+        session = ArmorySession.get_session_for_url(site_url)
+        session.expire()
+        session.ensure_login(self._login)
+        
+    def _login(self, login_url):
+        self.download_url(login_url, cached=False)
         
     def download_url(self, url, backoffs_allowed=None, backoff_time=None, cached=True):
-        """Download a URL and return the source. Specifying
-        backoffs_allowed and backoff_time allows the downloader to retry
-        downloading URLs on failure.
+        """Download a URL and return the source. backoffs_allowed and
+        backoff_time override the retry policy's number of attempts and
+        first backoff.
+        
+        """
+        return page_source(self.download_page(url, backoffs_allowed, \
+            backoff_time, cached))
+        
+    def download_page(self, url, backoffs_allowed=None, backoff_time=None, cached=True):
+        """Download a URL and return it as an ArmoryPage.Page, which is
+        only decompressed as it's read.
         
         """
+        entry = None
+        stats = DownloadStats.get_stats()
+        
         if cached:
-            try:
-                cached_source = cache[url]
-            except Exception, e:
+            entry = self._cache.lookup(url)
+            
+            if entry is None or not entry.fresh:
                 log.debug("Retrieving " + url)
+                stats.record_cache(url, False)
             else:
                 log.debug("Returning cached version of " + url)
-                source = self.decompress_gzip(cached_source)
-                unicode_source = unicode(source, "utf-8").encode("utf-8")
-                return unicode_source
+                stats.record_cache(url, True)
+                return ArmoryPage.Page(url, gzip_data=entry.body)
+        
+        if not ArmorySession.is_login_url(url):
+            ArmorySession.get_session_for_url(url).ensure_login(self._login)
+        
+        # Fail fast rather than wait on a host that isn't answering
+        breaker = CircuitBreaker.get_breaker_for_url(url)
+        breaker.check()
         
         log.debug("Downloading " + url)
-        if backoffs_allowed is None: backoffs_allowed = self.backoff_attempts
-        if backoff_time is None: backoff_time = self.backoff_initial_time
+        retry = self.retry_policy.begin(attempts=backoffs_allowed, \
+            initial=backoff_time)
                 
         request = urllib2.Request(url)
-        request.add_header("User-Agent", "WoWSpyder 0.1, \
-like Mozilla/5.0 Gecko/20081201 Firefox/3.1b2. \
-http://github.com/Lewisham/wowspyder")
+        request.add_header("User-Agent", USER_AGENT)
         request.add_header('Accept-encoding', 'gzip')
+        
+        # A stale copy can still be used if the Armory says it hasn't
+        # changed, which saves sending the whole page again.
+        if entry is not None:
+            if entry.etag:
+                request.add_header("If-None-Match", entry.etag)
+            if entry.last_modified:
+                request.add_header("If-Modified-Since", entry.last_modified)
 
-        try:
-            datastream = self._opener.open(request)
-        except urllib2.HTTPError, error:
-            warning = "Download URL failed, got HTTP %d. URL: %s" % (error.code, url)
-            log.warning(warning)
+        while True:
+            # Every downloader in the process (and maybe on the host) shares
+            # the same budget for each Armory.
+            stats.record_throttle(url, RateLimiter.get_limiter_for_url(url).acquire())
+
+            try:
+                info, body = self._fetch(request, retry.timeout())
+                break
+            except urllib2.HTTPError, error:
+                failure = sys.exc_info()
+                
+                if error.code == 304 and entry is not None:
+                    log.debug("Not modified, returning cached version of " + url)
+                    self._cache.revalidate(url)
+                    return ArmoryPage.Page(url, gzip_data=entry.body, unchanged=True)
+                    
+                warning = "Download URL failed, got HTTP %d. URL: %s" % (error.code, url)
+                log.warning(warning)
+                
+                if error.code == 404:
+                    # cflewis | 2009-03-15 | Can't do anything about this
+                    log.debug("couldn't find page")
+                    raise
+                
+                # cflewis | 2009-03-15 | Blizzard blocked us. Back off.
+            except urllib2.URLError, error:
+                failure = sys.exc_info()
+                log.warning("Time out")
             
-            self._opener.close()
+            # Unless the host has had enough failures to be given a rest,
+            # in which case there's no point waiting on it.
+            delay = None
+            if not breaker.is_open(): delay = retry.backoff()
             
-            if error.code == 404:
-                # cflewis | 2009-03-15 | Can't do anything about this
-                log.debug("couldn't find page")
-                raise
-            else:
-                # cflewis | 2009-03-15 | Blizzard blocked us. Back off.
-                if backoffs_allowed > 0:
-                    log.warning("Sleeping for: %d" % (backoff_time))
-                    time.sleep(backoff_time)
-                    return self.download_url(url, \
-                    backoffs_allowed=backoffs_allowed - 1, \
-                    backoff_time=(backoff_time + (self.backoff_increment * random.uniform(1, 1.5))))
-                else:
-                    raise
-        except urllib2.URLError, error:
-            log.warning("Time out")
-            self._opener.close
-            return self.download_url(url, backoffs_allowed=backoffs_allowed, \
-                backoff_time=backoff_time)
-        
-        gzipped_source = datastream.read()
-        source = self.decompress_gzip(gzipped_source)
-        self._opener.close()
+            if delay is None:
+                # Raised with its own traceback, which shows where it failed
+                raise failure[0], failure[1], failure[2]
+                
+            log.warning("Sleeping for: %d" % (delay))
+            stats.record_retry(url, delay)
+            time.sleep(delay)
+        
         log.debug("Downloaded %s" % url)
-        unicode_source = unicode(source, "utf-8").encode("utf-8")
-        if cached: cache[url] = gzipped_source
         
-        return unicode_source
+        # The page is kept as it came off the wire; it's decompressed as
+        # the parser reads it, and never decoded, as the parsers take UTF-8.
+        if info.getheader("Content-Encoding") != "gzip":
+            return ArmoryPage.Page(url, data=body)
         
+        if cached:
+            self._cache.put(url, body, \
+                etag=info.getheader("ETag"), \
+                last_modified=info.getheader("Last-Modified"))
+
+        return ArmoryPage.Page(url, gzip_data=body)
+
+    def submit(self, url, priority=None):
+        """Download a URL, returning a DownloadFuture.Future for the page.
+        This downloader has no threads of its own, so the download is done
+        before submit returns; priority is ignored.
+        
+        """
+        future = DownloadFuture.Future()
+        
+        try:
+            future.set_result(self.download_page(url))
+        except Exception, e:
+            future.set_exception(e)
+            
+        return future
+        
+    def download_many(self, urls, priority=None):
+        """Download URLs, returning a future for each, in the same order."""
+        return [self.submit(url, priority) for url in urls]
+
+    def _fetch(self, request, timeout):
+        """Send request and read the response, returning its headers and
+        body. The request holds a place in the host's concurrency window
+        while it's out, and how it went widens or narrows the window. A
+        socket waiting more than timeout seconds raises URLError.
+
+        """
+        url = request.get_full_url()
+        controller = ConcurrencyController.get_controller_for_url(url)
+        controller.acquire()
+        outcome = ConcurrencyController.FAILED
+        status = None
+        body = ""
+        size = 0
+        start = time.time()
+
+        try:
+            datastream = self._opener.open(request, timeout=timeout)
+            body = datastream.read()
+            info = datastream.info()
+            status = 200
+            outcome = ConcurrencyController.SUCCEEDED
+
+            if info.getheader("Content-Encoding") == "gzip":
+                size = ArmoryPage.gzip_size(body)
+            else:
+                size = len(body)
+
+            return info, body
+        except urllib2.HTTPError, error:
+            status = error.code
+
+            if error.code >= 500:
+                outcome = ConcurrencyController.THROTTLED
+            elif error.code in (304, 404):
+                outcome = ConcurrencyController.SUCCEEDED
+            raise
+        except urllib2.URLError, error:
+            outcome = ConcurrencyController.THROTTLED
+            raise
+        finally:
+            latency = time.time() - start
+            controller.release(outcome, latency)
+            CircuitBreaker.get_breaker_for_url(url).record(outcome)
+            DownloadStats.get_stats().record_fetch(url, latency, status, \
+                len(body), size)
+
     def decompress_gzip(self, compressed_data):
         """Decompress gzipped data."""
-        compressed_stream = StringIO.StringIO(compressed_data)
-        gzipper = gzip.GzipFile(fileobj = compressed_stream)
-        return gzipper.read()
+        return ArmoryPage.GzipStream(compressed_data).read()
 
         
 class XMLDownloaderThreaded(object):
@@ -149,72 +306,422 @@ class XMLDownloaderThreaded(object):
     
     Calling close() when this object is no longer needed would be nice,
     but it closes threads when the object is destroyed.
-    '''
-    def __init__(self, number_of_threads=20, sleep_time=10):
-        self.threads = []
-        self.request_queue = Queue.Queue()
-        self.sleep_time = sleep_time
     
-        for x in xrange(number_of_threads):
-            thread = XMLDownloaderThread(self.request_queue, sleep_time=sleep_time)
-            self.threads.append(thread)
-            thread.start()
+    Each Armory host gets a pool of its own, number_of_threads threads
+    and a queue, started the first time the host is asked for. A host
+    that's backing off or failing only ties up its own threads, and the
+    other host's requests carry on.
+    
+    The threads don't sleep between requests. How fast they go is up to
+    the RateLimiter, which every thread in the process shares, so adding
+    threads doesn't add to the request rate.
+    
+    How many of them are waiting on the Armory at once is up to each
+    host's ConcurrencyController, so the thread count is only a ceiling.
+    
+    Requests are handed to the threads by priority class (see
+    WoWSpyderLib.URL_PRIORITIES, overridden by priorities), with a request
+    moving up a class for every aging seconds it waits.
+    
+    A supervisor keeps each pool at number_of_threads live threads,
+    looking the threads over every supervise_interval seconds and as soon
+    as one ends. A thread that has been on one request for more than
+    hung_after seconds (by default, five minutes longer than the retry
+    policy allows) is given up on: its request fails with an IOError and a
+    new thread takes its place, so a stuck socket can't wear the pool down
+    over a long run. Threads are also retired, and replaced with fresh
+    ones and fresh downloaders, after max_requests requests, or all at
+    once when the process has grown by more than max_memory_growth bytes
+    since they were last retired. health() says how the pools are doing.
+    '''
+    def __init__(self, number_of_threads=20, pool_size=None, \
+            pool_idle_timeout=30, cache=None, priorities=None, aging=5, \
+            retry_policy=None, hung_after=None, supervise_interval=10, \
+            max_requests=None, max_memory_growth=None):
+        self.number_of_threads = number_of_threads
+        self.cache = cache
+        self.priorities = priorities
+        self.aging = aging
+        
+        if retry_policy is None: retry_policy = RetryPolicy.RetryPolicy()
+        if hung_after is None: hung_after = retry_policy.longest() + 300
+        self.retry_policy = retry_policy
+        self.hung_after = hung_after
+        self.supervise_interval = supervise_interval
+        self.max_requests = max_requests
+        self.max_memory_growth = max_memory_growth
+        
+        # One pooled connection per thread, so threads never wait on each
+        # other for a socket.
+        if pool_size is None: pool_size = number_of_threads
+        self.pool_size = pool_size
+        self.pool_idle_timeout = pool_idle_timeout
+        
+        self._pools = {}
+        self._pools_lock = threading.Lock()
+        self._closed = False
+        self._supervisor = None
+        self._memory = None
             
     def __del__(self):
         self.close()
         
-    def download_url(self, url):
-        """Download a URL from one of the threads."""
-        response_queue = Queue.Queue()
-        self.request_queue.put((url, response_queue))
-        result = response_queue.get()
-        
-        if isinstance(result, Exception):
-            log.debug("Got exception, starting up new thread in it's place")
-            thread = XMLDownloaderThread(self.request_queue, sleep_time=self.sleep_time)
-            self.threads.append(thread)
-            raise result
-        else:
-            return result
+    def download_url(self, url, priority=None):
+        """Download a URL from one of the threads and return the source."""
+        return page_source(self.download_page(url, priority))
+        
+    def download_page(self, url, priority=None):
+        """Download a URL from one of the threads, returning an
+        ArmoryPage.Page. If the URL is already being downloaded, wait for
+        that download instead. priority overrides the URL's priority class.
+        
+        """
+        return self.submit(url, priority).result()
+        
+    def submit(self, url, priority=None):
+        """Queue a URL for the threads and return a DownloadFuture.Future
+        for its page straight away. If the URL is already being downloaded,
+        return that download's future instead.
+        
+        """
+        if priority is None:
+            priority = WoWSpyderLib.get_url_priority(url, self.priorities)
+            
+        return SingleFlight.get_downloads().submit(url, self._queue, url, \
+            priority)
+        
+    def download_many(self, urls, priority=None):
+        """Queue all of urls at once, returning a future for each, in the
+        same order. DownloadFuture.as_completed() hands them back as they
+        finish.
+        
+        """
+        return [self.submit(url, priority) for url in urls]
+        
+    def _queue(self, future, url, priority):
+        self._get_pool(url).request_queue.put((url, future), priority)
+        
+    def _get_pool(self, url):
+        """Return the pool for the host url points at, starting it if
+        this is the host's first request.
+        
+        """
+        host = urlparse.urlsplit(url)[1]
+        self._pools_lock.acquire()
+        
+        try:
+            if self._closed:
+                raise IOError("Downloader has been closed")
+                
+            pool = self._pools.get(host)
+            
+            if pool is None:
+                log.debug("Starting %d threads for %s" % \
+                    (self.number_of_threads, host))
+                pool = _HostPool(RequestQueue.PriorityRequestQueue( \
+                    aging=self.aging))
+                self._pools[host] = pool
+                
+                if self._supervisor is None:
+                    self._memory = _resident_memory()
+                    self._supervisor = _Supervisor(self, \
+                        self.supervise_interval)
+                    self._supervisor.start()
+                    
+                self._fill(pool)
+                
+            return pool
+        finally:
+            self._pools_lock.release()
+            
+    def _fill(self, pool):
+        """Start threads until pool has as many as it should. Call with
+        the pools lock held.
+        
+        """
+        while len(pool.threads) < self.number_of_threads:
+            thread = self._create_thread(pool.request_queue)
+            pool.threads.append(thread)
+            thread.start()
+    
+    def close(self, wait=False):
+        """Close the object, ending the threads once the requests already
+        queued have been downloaded. If wait is True, return only once
+        they have.
+        
+        """
+        self._pools_lock.acquire()
+        
+        try:
+            self._closed = True
+            pools, self._pools = self._pools.values(), {}
+        finally:
+            self._pools_lock.release()
+            
+        if self._supervisor is not None:
+            self._supervisor.stop()
+        
+        for pool in pools:
+            for _ in pool.threads:
+                pool.request_queue.put((None, None), RequestQueue.LAST)
+                
+        if not wait:
+            return
+            
+        for pool in pools:
+            for thread in pool.threads:
+                thread.join()
+            
+    def _create_thread(self, request_queue):
+        wake = None
+        if self._supervisor is not None: wake = self._supervisor.wake
+        
+        return XMLDownloaderThread(request_queue, \
+            pool_size=self.pool_size, pool_idle_timeout=self.pool_idle_timeout, \
+            cache=self.cache, retry_policy=self.retry_policy, \
+            max_requests=self.max_requests, on_exit=wake)
+            
+    def supervise(self):
+        """Replace threads that have ended or hung, and retire every
+        thread if the process has grown by more than max_memory_growth
+        since the last time. The supervisor calls this.
+        
+        """
+        recycle = False
+        
+        if self.max_memory_growth is not None:
+            memory = _resident_memory()
+            
+            if memory is not None and self._memory is not None and \
+                    memory - self._memory > self.max_memory_growth:
+                log.info("Grown by %d bytes, retiring the download threads" % \
+                    (memory - self._memory))
+                self._memory = memory
+                recycle = True
+                
+        self._pools_lock.acquire()
+        
+        try:
+            if self._closed:
+                return
+                
+            for host, pool in self._pools.items():
+                replaced = pool.restarts + pool.hung + pool.recycled
+                
+                for thread in list(pool.threads):
+                    if thread.abandon(self.hung_after):
+                        pool.threads.remove(thread)
+                        pool.hung += 1
+                    elif not thread.isAlive():
+                        pool.threads.remove(thread)
+                        
+                        if thread.retiring:
+                            pool.recycled += 1
+                        else:
+                            log.warning("Download thread died, replacing it")
+                            pool.restarts += 1
+                    elif recycle:
+                        thread.retire()
+                        
+                self._fill(pool)
+                
+                if pool.restarts + pool.hung + pool.recycled > replaced:
+                    log.info("%s: %d threads, %d restarted, %d hung, %d " \
+                        "recycled, %d requests queued" % (host, \
+                        len(pool.threads), pool.restarts, pool.hung, \
+                        pool.recycled, len(pool.request_queue)))
+        finally:
+            self._pools_lock.release()
+            
+    def health(self):
+        """Return how each host's pool is doing, keyed on host: how many
+        of its threads are alive, how many it should have, how many have
+        been replaced after dying, hanging or being retired, and how many
+        requests are waiting for a thread.
+        
+        """
+        self._pools_lock.acquire()
+        
+        try:
+            return dict((host, {
+                "workers": len([t for t in pool.threads if t.isAlive()]),
+                "target": self.number_of_threads,
+                "restarts": pool.restarts,
+                "hung": pool.hung,
+                "recycled": pool.recycled,
+                "queued": len(pool.request_queue),
+            }) for host, pool in self._pools.items())
+        finally:
+            self._pools_lock.release()
+
+
+class _HostPool(object):
+    """The queue and threads serving one Armory host."""
+    def __init__(self, request_queue):
+        self.request_queue = request_queue
+        self.threads = []
+        self.restarts = 0
+        self.hung = 0
+        self.recycled = 0
+
+
+def _resident_memory():
+    """Return how many bytes of memory the process is using, or None
+    where that can't be found out.
     
-    def close(self):
-        """Close the object, ending the threads."""
-        for _ in self.threads:
-            self.request_queue.put((None, None))
+    """
+    try:
+        statm = open("/proc/self/statm")
+        
+        try:
+            pages = int(statm.read().split()[1])
+        finally:
+            statm.close()
+    except (IOError, OSError, IndexError, ValueError), e:
+        return None
+        
+    return pages * os.sysconf("SC_PAGE_SIZE")
+
+
+class _Supervisor(threading.Thread):
+    """Has an XMLDownloaderThreaded look over its threads every interval
+    seconds, or as soon as one of them ends. It only holds a weak
+    reference to the downloader, so it doesn't keep it from being closed
+    when it's thrown away.
+    
+    """
+    def __init__(self, downloader, interval):
+        threading.Thread.__init__(self, name="XMLDownloaderSupervisor")
+        self.setDaemon(True)
+        self.interval = interval
+        self.wake = threading.Event()
+        self._downloader = weakref.ref(downloader)
+        self._stopped = False
+        
+    def run(self):
+        while True:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            if self._stopped: break
+            
+            downloader = self._downloader()
+            if downloader is None: break
+            
+            downloader.supervise()
+            del downloader
+            
+    def stop(self):
+        self._stopped = True
+        self.wake.set()
 
 
 class XMLDownloaderThread(threading.Thread):
-    """A thread to the XMLDownloader."""
-    def __init__(self, request_queue, sleep_time=10):
+    """A thread to the XMLDownloader. It ends after max_requests requests,
+    if that isn't None, or after the next one once it's retired, setting
+    on_exit (a threading.Event) as it does.
+    
+    """
+    def __init__(self, request_queue, pool_size=4, pool_idle_timeout=30, \
+            cache=None, retry_policy=None, max_requests=None, on_exit=None):
         threading.Thread.__init__(self)
-        self.downloader = XMLDownloader()
+        self.downloader = XMLDownloader(pool_size=pool_size, \
+            pool_idle_timeout=pool_idle_timeout, cache=cache, \
+            retry_policy=retry_policy)
         self.request_queue = request_queue
-        self.sleep_time = sleep_time
-        
-        log.debug("Sleep time is set to " + str(self.sleep_time))
+        self.max_requests = max_requests
+        self.on_exit = on_exit
+        self.requests = 0
+        self.url = None
+        self.busy_since = None
+        self.abandoned = False
+        self.retiring = False
+        self._future = None
+        self._lock = threading.Lock()
         
     def run(self):
-        while 1:
-            url, response_queue = self.request_queue.get()
+        try:
+            self._run()
+        finally:
+            if self.on_exit is not None: self.on_exit.set()
+            
+    def _run(self):
+        while not self.abandoned and not self.retiring:
+            url, future = self.request_queue.get()
             if url is None:
                 break
+            
+            self._busy(url, future)
+            
+            try:
+                page = self.downloader.download_page(url)
+            except Exception, e:
+                log.debug("Got exception from downloader, passing it on")
+                future.set_exception(e)
             else:
-                try:
-                    result = self.downloader.download_url(url)
-                except Exception, e:
-                    log.debug("Got exception from downloader, putting it on queue")
-                    result = e
+                future.set_result(page)
                 
-                response_queue.put(result)
-                    
-                time.sleep(self.sleep_time * random.uniform(1, 1.5))    
+            self._busy(None, None)
+            self.requests += 1
+            
+            if self.max_requests is not None and \
+                    self.requests >= self.max_requests:
+                self.retire()
+                
+    def retire(self):
+        """Have the thread end after the request it's on, or the next one
+        it gets if it's waiting.
+        
+        """
+        self.retiring = True
+                
+    def _busy(self, url, future):
+        self._lock.acquire()
+        
+        try:
+            self.url = url
+            self._future = future
+            self.busy_since = None
+            if url is not None: self.busy_since = time.time()
+        finally:
+            self._lock.release()
+            
+    def abandon(self, hung_after):
+        """If the thread has been on its request for more than hung_after
+        seconds, fail the request and have the thread end once (if ever)
+        its download returns. Returns True if the thread was abandoned.
+        
+        """
+        self._lock.acquire()
+        
+        try:
+            if self.busy_since is None or \
+                    time.time() - self.busy_since < hung_after:
+                return False
+                
+            log.warning("Download of %s has hung for %d seconds, giving up " \
+                "on it" % (self.url, time.time() - self.busy_since))
+            self.abandoned = True
+            self._future.set_exception(IOError("Download of " + self.url + \
+                " hung"))
+            return True
+        finally:
+            self._lock.release()
 
 
 class XMLDownloaderTests(unittest.TestCase):
     def setUp(self):
+        import ArmoryStandIn
+        self.stand_in = ArmoryStandIn.ArmoryStandIn().start().use()
         self.downloader = XMLDownloader()
-        self.moulin = "http://www.wowarmory.com/character-sheet.xml?r=Ravenholdt&n=Moulin&p=1"
-        self.shirley = "http://www.wowarmory.com/character-sheet.xml?r=Ravenholdt&n=Shirley&p=1"
+        self.moulin = WoWSpyderLib.get_character_sheet_url(u"Moulin", \
+            u"Ravenholdt", u"us")
+        self.shirley = WoWSpyderLib.get_character_sheet_url(u"Shirley", \
+            u"Ravenholdt", u"us")
+        self.missing = WoWSpyderLib.get_character_sheet_url(u"Nobody", \
+            u"Ravenholdt", u"us")
+
+    def tearDown(self):
+        self.stand_in.stop()
 
     def testDownloadSomething(self):
         source = self.downloader.download_url(self.moulin)
@@ -227,7 +734,7 @@ class XMLDownloaderTests(unittest.TestCase):
 
     def testDownloadFakeSource(self):
         self.assertRaises(urllib2.HTTPError, self.downloader.download_url, \
-            "http://chris.to/fakeurl")
+            self.missing)
 
     def testDownloadHTMLSource(self):
         source = self.downloader.download_url(self.moulin)
@@ -253,12 +760,102 @@ class XMLDownloaderTests(unittest.TestCase):
 
         # cflewis | 2009-03-14 | Getting anything but one cookie means
         # something went wrong.
-        self.assertEqual(len(self.downloader._cj), 1)
+        session = ArmorySession.get_session_for_url(self.moulin)
+        self.assertEqual(len(session.cookie_jar), 1)
+        
+    def testStats(self):
+        DownloadStats.get_stats().reset()
+        self.downloader.download_url(self.moulin)
+        self.downloader.download_url(self.moulin)
+        
+        sheet = DownloadStats.get_stats().summary()["character-sheet"]
+        self.assertEqual(sheet["cache_hits"], 1)
+        self.assertEqual(sheet["fetches"], 1)
+        self.assertTrue(sheet["decompressed_bytes"] > sheet["compressed_bytes"])
+        
+    def testCircuitBreaker(self):
+        CircuitBreaker.configure(failures=2)
+        
+        try:
+            downloader = XMLDownloader(backoff_attempts=5, \
+                backoff_initial_time=0, backoff_increment=0)
+            downloader.download_url(self.moulin, cached=False)
+            self.stand_in.error_rate = 1.0
+            
+            # Two failures open the circuit, which stops the backing off.
+            self.assertRaises(urllib2.HTTPError, downloader.download_url, \
+                self.shirley, cached=False)
+            self.assertEqual(self.stand_in.responses[500], 2)
+            self.assertRaises(CircuitBreaker.CircuitOpenError, \
+                downloader.download_url, self.missing)
+            self.assertEqual(self.stand_in.responses[500], 2)
+        finally:
+            CircuitBreaker.configure()
+        
+    def testTimeout(self):
+        self.stand_in.latency = 0.5
+        downloader = XMLDownloader(backoff_attempts=1, backoff_initial_time=0, \
+            timeout=0.1)
+        start = time.time()
+        self.assertRaises(urllib2.URLError, downloader.download_url, \
+            self.shirley, cached=False)
+        self.assertTrue(time.time() - start < 0.5)
+        
+    def testRetriesKeepTraceback(self):
+        self.stand_in.latency = 0.5
+        downloader = XMLDownloader(backoff_attempts=1, backoff_initial_time=0, \
+            timeout=0.1)
+        
+        try:
+            downloader.download_url(self.shirley, cached=False)
+        except urllib2.URLError, e:
+            functions = [frame[2] for frame in \
+                traceback.extract_tb(sys.exc_info()[2])]
+            self.assertTrue("_fetch" in functions)
+        else:
+            self.fail("Expected a URLError")
+        
+    def testHungThread(self):
+        self.stand_in.latency = 1.0
+        self.dt = XMLDownloaderThreaded(number_of_threads=1, hung_after=0.2, \
+            supervise_interval=0.05)
+        self.assertRaises(IOError, self.dt.download_url, self.shirley)
+        health = self.dt.health().values()[0]
+        self.assertEqual(health["hung"], 1)
+        self.assertEqual(health["workers"], 1)
+        self.dt.close()
+        
+    def testRecycle(self):
+        self.dt = XMLDownloaderThreaded(number_of_threads=2, max_requests=1)
+        self.dt.download_url(self.moulin)
+        self.dt.download_url(self.shirley)
+        time.sleep(0.1)
+        health = self.dt.health().values()[0]
+        self.assertEqual(health["workers"], 2)
+        self.assertTrue(health["recycled"] >= 1)
+        self.assertEqual(health["restarts"], 0)
+        self.dt.close(wait=True)
+        
+    def testThreadedPools(self):
+        self.dt = XMLDownloaderThreaded(number_of_threads=2)
+        self.dt.download_url(self.moulin)
+        self.assertEqual(len(self.dt._pools), 1)
+        self.dt.close()
+        self.assertRaises(IOError, self.dt.download_url, self.shirley)
         
     def testThreaded(self):
         self.dt = XMLDownloaderThreaded()
-        self.assertRaises(Exception, self.dt.download_url, \
-            "http://chris.to/fakeurl")
+        self.assertRaises(Exception, self.dt.download_url, self.missing)
+        
+    def testThreadedDownloadMany(self):
+        self.dt = XMLDownloaderThreaded(number_of_threads=4)
+        futures = self.dt.download_many([self.moulin, self.shirley, \
+            self.missing])
+        self.assertTrue("Moulin" in futures[0].result().head())
+        self.assertTrue("Shirley" in futures[1].result().head())
+        self.assertTrue(isinstance(futures[2].exception(), urllib2.HTTPError))
+        self.assertEqual(len(list(DownloadFuture.as_completed(futures))), 3)
+        self.dt.close()
         
     def testThreadedException(self):
         self.dt = XMLDownloaderThreaded()
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+XMLStream.py
+
+Reads Armory pages as a stream of elements rather than building a DOM of
+the whole page, so a page is parsed as it's decompressed. Everything the
+parsers want from a page is in its elements' attributes, which is all this
+hands back.
+
+iter_elements and the functions built on it keep only the elements still
+open in memory. A ParsedPage keeps the attributes, though not the
+elements, of everything it has read, so whatever reads the page next
+doesn't parse it again; that is a dictionary per element, which is still
+far smaller than a DOM of the page.
+
+Copyright (c) 2009, Regents of the University of California
+All rights reserved.
+"""
+
+import sys
+import os
+import unittest
+import StringIO
+import threading
+import Logger
+
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+
+log = Logger.log()
+
+def iter_elements(stream, tags=None):
+    """Yield (tag, attributes) for each element in stream whose tag is in
+    tags (every element if tags is None), in the order they start. The
+    attributes are a dictionary of unicode strings, as minidom gave. Stop
+    iterating and the rest of the page is never read.
+
+    """
+    if isinstance(tags, basestring): tags = (tags,)
+    depth = 0
+    root = None
+
+    for event, element in ElementTree.iterparse(stream, ("start", "end")):
+        if event == "start":
+            if root is None: root = element
+            depth += 1
+
+            if tags is None or element.tag in tags:
+                yield element.tag, dict((name, unicode(value)) for name, value \
+                    in element.attrib.items())
+            continue
+
+        depth -= 1
+
+        # Elements are thrown away as soon as they end, and the root lets
+        # go of its children, so only the elements still open are kept.
+        element.clear()
+        if depth == 1: root.clear()
+
+def iter_attributes(stream, tag):
+    """Yield the attributes of each tag element in stream."""
+    for name, attributes in iter_elements(stream, (tag,)):
+        yield attributes
+
+def find_first(stream, tag):
+    """Return the attributes of the first tag element in stream, reading
+    no further than it. Raises IndexError if there isn't one, just as
+    indexing minidom's list of elements would.
+
+    """
+    for attributes in iter_attributes(stream, tag):
+        return attributes
+
+    raise IndexError("No " + tag + " element in the page")
+
+def collect(stream, tags):
+    """Return a dictionary of the attributes of every element in stream
+    whose tag is in tags, keyed on tag, each a list in page order. Every
+    tag gets a list, even if it's empty.
+
+    """
+    found = dict((tag, []) for tag in tags)
+
+    for tag, attributes in iter_elements(stream, tags):
+        found[tag].append(attributes)
+
+    return found
+
+
+class ParsedPage(object):
+    """A page tokenized once and shared by everything that reads it: the
+    checks made as it's downloaded, the parser that makes something of it
+    and anything else that wants one of its attributes.
+
+    Elements are only read as far into the page as has been asked for, so
+    a check on the page's header doesn't read the rest. The attributes of
+    every element read are kept for whoever asks next, for as long as the
+    page is, so a page read to the end costs a dictionary per element.
+    checked holds the entities the page has been checked for, so it isn't
+    checked twice.
+
+    """
+    def __init__(self, stream):
+        self.checked = set()
+        self._elements = iter_elements(stream)
+        self._found = {}
+        self._values = {}
+        self._finished = False
+        self._error = None
+        self._lock = threading.Lock()
+
+    def _read(self, until=None):
+        """Read elements until until(tag, attributes) is True, or to the
+        end of the page. The lock must be held.
+
+        """
+        if self._error is not None:
+            raise self._error
+
+        if self._finished:
+            return
+
+        try:
+            for tag, attributes in self._elements:
+                self._found.setdefault(tag, []).append(attributes)
+
+                for name, value in attributes.iteritems():
+                    self._values.setdefault(name, value)
+
+                if until is not None and until(tag, attributes):
+                    return
+        except SyntaxError, e:
+            # Whoever asks next is told the page was broken too
+            self._error = e
+            raise
+
+        self._finished = True
+
+    def first(self, tag):
+        """Return the attributes of the first tag element, or None if the
+        page has none.
+
+        """
+        self._lock.acquire()
+        try:
+            if tag not in self._found:
+                self._read(lambda found_tag, attributes: found_tag == tag)
+
+            return self._found.get(tag, [None])[0]
+        finally:
+            self._lock.release()
+
+    def all(self, tag):
+        """Return the attributes of every tag element, in page order."""
+        self._lock.acquire()
+        try:
+            self._read()
+            return list(self._found.get(tag, []))
+        finally:
+            self._lock.release()
+
+    def attribute(self, tag, name, default=None):
+        """Return the name attribute of the first tag element."""
+        attributes = self.first(tag)
+
+        if attributes is None:
+            return default
+
+        return attributes.get(name, default)
+
+    def value(self, name, default=None):
+        """Return the first value the page gives the name attribute,
+        whichever element it's on.
+
+        """
+        self._lock.acquire()
+        try:
+            if name not in self._values:
+                self._read(lambda tag, attributes: name in attributes)
+
+            return self._values.get(name, default)
+        finally:
+            self._lock.release()
+
+    @property
+    def root(self):
+        """The attributes of the page element."""
+        return self.first("page")
+
+    @property
+    def max_pages(self):
+        """How many pages there are of a paged list, or None if the page
+        isn't one.
+
+        """
+        max_pages = self.value("maxPage")
+
+        if max_pages is None:
+            return None
+
+        return int(max_pages)
+
+    @property
+    def last_modified(self):
+        """When the Armory says the character on the page last changed, as
+        it wrote it, or None.
+
+        """
+        return self.attribute("character", "lastModified")
+
+
+class XMLStreamTests(unittest.TestCase):
+    def setUp(self):
+        self.page = "<?xml version=\"1.0\" encoding=\"UTF-8\"?>" + \
+            "<?xml-stylesheet type=\"text/xsl\" href=\"/layout/guild-info.xsl\"?>" + \
+            "<page><guildInfo><guildHeader name=\"Wandering Shadows\" " + \
+            "realm=\"Ravenholdt\"/><guild><members>" + \
+            "<character name=\"Moulin\" rank=\"2\"/>" + \
+            "<character name=\"Sk\xc3\xa5di\" rank=\"4\"/>" + \
+            "</members></guild></guildInfo></page>"
+
+    def stream(self):
+        return StringIO.StringIO(self.page)
+
+    def testIterElements(self):
+        found = list(iter_elements(self.stream(), ("guildHeader", "character")))
+        self.assertEqual([tag for tag, attributes in found], \
+            ["guildHeader", "character", "character"])
+        self.assertEqual(found[1][1], {u"name": u"Moulin", u"rank": u"2"})
+
+    def testUnicode(self):
+        names = [a["name"] for a in iter_attributes(self.stream(), "character")]
+        self.assertEqual(names, [u"Moulin", u"Sk\xe5di"])
+        self.assertTrue(isinstance(names[0], unicode))
+
+    def testFindFirst(self):
+        self.assertEqual(find_first(self.stream(), "guildHeader")["realm"], \
+            u"Ravenholdt")
+        self.assertRaises(IndexError, find_first, self.stream(), "arenaTeam")
+
+    def testStopsEarly(self):
+        # Everything after the header is broken, but is never read
+        self.page = self.page.replace("</members>", "</broken>")
+        self.assertEqual(find_first(self.stream(), "guildHeader")["name"], \
+            u"Wandering Shadows")
+        self.assertRaises(SyntaxError, collect, self.stream(), ("character",))
+
+    def testCollect(self):
+        found = collect(self.stream(), ("character", "arenaTeam"))
+        self.assertEqual(len(found["character"]), 2)
+        self.assertEqual(found["arenaTeam"], [])
+
+    def testParsedPage(self):
+        parsed = ParsedPage(self.stream())
+        self.assertEqual(parsed.attribute("guildHeader", "realm"), u"Ravenholdt")
+        self.assertEqual(parsed.first("arenaTeam"), None)
+        self.assertEqual([a["name"] for a in parsed.all("character")], \
+            [u"Moulin", u"Sk\xe5di"])
+        self.assertEqual(parsed.value("rank"), u"2")
+        self.assertEqual(parsed.max_pages, None)
+
+    def testParsedPageReadsOnce(self):
+        self.page = self.page.replace("</members>", "</broken>")
+        parsed = ParsedPage(self.stream())
+        self.assertEqual(parsed.first("guildHeader")["name"], \
+            u"Wandering Shadows")
+        self.assertRaises(SyntaxError, parsed.all, "character")
+        # The page isn't read again, and stays broken
+        self.assertRaises(SyntaxError, parsed.first, "arenaTeam")
+        self.assertEqual(parsed.first("guildHeader")["realm"], u"Ravenholdt")
+
+    def testMissingAttribute(self):
+        header = find_first(self.stream(), "guildHeader")
+        self.assertRaises(KeyError, lambda: header["battleGroup"])
+
+
+if __name__ == '__main__':
+    unittest.main()